@@ -0,0 +1,276 @@
+"""Time the recorder's hot paths on synthetic sessions.
+
+Sessions are generated into a temporary directory, then each benchmark is
+run several times and its median time, and for reports the peak memory
+traced while rendering, is compared with the baselines tracked in
+hot_paths_baseline.json. A benchmark fails when it is more than the
+baseline's tolerance slower or bigger. Baselines are machine specific,
+record them on the machine that checks them with --update.
+
+    python benchmarks/bench_hot_paths.py [--runs N] [--quick] [--only NAME]
+                                         [--update]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from test_session.log_entry import EntryKind, LogEntry  # noqa: E402
+from test_session.session import Session  # noqa: E402
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'hot_paths_baseline.json')
+# Sizes run by default and with --quick, in entries per session
+SESSION_SIZES = (1000, 10000, 100000)
+QUICK_SESSION_SIZES = (1000, 10000)
+REPORT_SIZES = (10000, 100000)
+QUICK_REPORT_SIZES = (10000,)
+LIST_SESSIONS = 1000
+COMMANDS = 5000
+# Every BUG_EVERY-th generated entry is a bug
+BUG_EVERY = 20
+START_EPOCH = 1577872800
+
+
+def generate_entries(count, start=START_EPOCH):
+    """Yield count log entries a second apart, a bug every BUG_EVERY"""
+    for index in range(count):
+        kind = EntryKind.BUG if index % BUG_EVERY == 0 else EntryKind.NOTE
+        yield LogEntry(start + index, kind,
+                       'Entry {} checked the login form with user{}'.format(
+                           index, index % 97))
+
+
+def generate_session(session_dir, session_name, entries):
+    """Write a finished session of entries log entries, as left by quit"""
+    if not os.path.exists(session_dir):
+        os.makedirs(session_dir)
+    session = Session(session_name, session_dir)
+    store = session.store
+    store.set(Session.MISSION_KEY, 'Synthetic mission for ' + session_name)
+    store.set(Session.AREAS_KEY, ['Login', 'Search', 'Checkout'])
+    store.set(Session.TIMEBOX_KEY, 3600)
+    log = generate_entries(entries)
+    while True:
+        with store.batch():
+            written = 0
+            for entry in log:
+                store.append(Session.LOG_KEY, entry)
+                written += 1
+                if written == Session.INGEST_BATCH_SIZE:
+                    break
+        if written < Session.INGEST_BATCH_SIZE:
+            break
+    store.set(Session.DURATION_KEY, entries)
+    session.close()
+
+
+def session_name(entries):
+    return 'bench-{}'.format(entries)
+
+
+def median_time(function, runs, setup=None):
+    """Median seconds of function() over runs, setup() runs untimed before
+    each call"""
+    timings = []
+    for _ in range(runs):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def peak_memory(function, setup=None):
+    """Peak bytes allocated while function() runs"""
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_process_cmd(work_dir, runs):
+    """process_session_cmd throughput, written directly and write-behind"""
+    results = {}
+    for mode in ('sync', 'write-behind'):
+        def record():
+            name = 'bench-cmd-' + mode
+            path = os.path.join(work_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+            session = Session(name, work_dir)
+            if mode == 'write-behind':
+                session.store.start_write_behind()
+            for index in range(COMMANDS):
+                command = 'Entry {}'.format(index)
+                if index % BUG_EVERY == 0:
+                    command = Session.BUG_CMD + ' ' + command
+                session.process_session_cmd(START_EPOCH + index, command)
+            session.store.close()
+        seconds = median_time(record, runs)
+        results['process_cmd[{}]'.format(mode)] = {
+            'ms': seconds * 1000, 'ops_per_sec': COMMANDS / seconds}
+    return results
+
+
+def bench_open_close(session_dir, runs, sizes):
+    """Open a session for recording and close it again"""
+    results = {}
+    for entries in sizes:
+        def open_close():
+            Session(session_name(entries), session_dir).close()
+        results['open_close[{}]'.format(entries)] = {
+            'ms': median_time(open_close, runs) * 1000}
+    return results
+
+
+def bench_load(session_dir, runs, sizes):
+    """Read a whole session with get_session_data, as show does"""
+    results = {}
+    for entries in sizes:
+        def load():
+            Session.get_session_data(session_name(entries), session_dir)
+        results['get_session_data[{}]'.format(entries)] = {
+            'ms': median_time(load, runs) * 1000}
+    return results
+
+
+def bench_list(work_dir, runs):
+    """list and tab completion over LIST_SESSIONS sessions"""
+    from test_session.test_session_recorder import TestSessionRecorder
+    session_dir = os.path.join(work_dir, 'list')
+    for index in range(LIST_SESSIONS):
+        generate_session(session_dir, 'session-{:05d}'.format(index), 10)
+    recorder = TestSessionRecorder()
+    recorder.SESSION_DIR = session_dir
+
+    def list_sessions():
+        with contextlib.redirect_stdout(io.StringIO()):
+            recorder.do_list('')
+
+    def complete():
+        for prefix in ('', 'session-00', 'session-009', 'missing'):
+            recorder.complete_open(prefix, 'open ' + prefix, 5, 5)
+    results = {'list[{}]'.format(LIST_SESSIONS): {
+                   'ms': median_time(list_sessions, runs) * 1000},
+               'complete[{}]'.format(LIST_SESSIONS): {
+                   'ms': median_time(complete, runs) * 1000}}
+    recorder.catalog.close()
+    return results
+
+
+def bench_report(session_dir, work_dir, runs, sizes):
+    """Render session reports in full, timed and then memory traced"""
+    from test_session.report_generator import SessionReportGenerator
+    reports_dir = os.path.join(work_dir, 'reports')
+    generator = SessionReportGenerator(reports_dir, 'test_session')
+    results = {}
+    for entries in sizes:
+        name = session_name(entries)
+        report_path = os.path.join(reports_dir, name + '.html')
+
+        def render():
+            if not generator.generate_session_report(name, session_dir):
+                raise RuntimeError('Report failed to generate: ' + name)
+
+        def remove_report():
+            # Otherwise the report is only brought up to date
+            if os.path.exists(report_path):
+                os.remove(report_path)
+        results['report[{}]'.format(entries)] = {
+            'ms': median_time(render, runs, remove_report) * 1000,
+            'peak_kb': peak_memory(render, remove_report) / 1024}
+    return results
+
+
+def compare(results, baselines, default_tolerance):
+    """Print every result against its baseline, return True if any
+    regressed. A baseline may set its own tolerance."""
+    regressed = False
+    for name, metrics in sorted(results.items()):
+        baseline = baselines.get(name, {})
+        tolerance = baseline.get('tolerance', default_tolerance)
+        line = []
+        for metric, value in sorted(metrics.items()):
+            expected = baseline.get(metric)
+            text = '{} {:.1f}'.format(metric, value)
+            # Throughput is derived from ms, only time and size are checked
+            if expected is not None and metric != 'ops_per_sec':
+                text += ' (baseline {:.1f})'.format(expected)
+                if value > expected * tolerance:
+                    text += ' REGRESSED'
+                    regressed = True
+            line.append(text)
+        print('{:32} {}'.format(name, ', '.join(line)))
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--quick', action='store_true',
+                        help='Leave out the largest sessions')
+    parser.add_argument('--only', help='Run the benchmarks whose name '
+                        'starts with ONLY, eg. report')
+    parser.add_argument('--update', action='store_true',
+                        help='Record the results as the new baselines')
+    args = parser.parse_args(argv)
+    sizes = QUICK_SESSION_SIZES if args.quick else SESSION_SIZES
+    report_sizes = QUICK_REPORT_SIZES if args.quick else REPORT_SIZES
+    with open(BASELINE_FILE) as baseline_file:
+        baselines = json.load(baseline_file)
+
+    def selected(name):
+        return not args.only or name.startswith(args.only)
+    work_dir = tempfile.mkdtemp(prefix='bench-hot-paths-')
+    try:
+        session_dir = os.path.join(work_dir, 'sessions')
+        for entries in sorted(set(sizes) | set(report_sizes)):
+            generate_session(session_dir, session_name(entries), entries)
+        results = {}
+        if selected('process_cmd'):
+            results.update(bench_process_cmd(work_dir, args.runs))
+        if selected('open_close'):
+            results.update(bench_open_close(session_dir, args.runs, sizes))
+        if selected('get_session_data'):
+            results.update(bench_load(session_dir, args.runs, sizes))
+        if selected('list') or selected('complete'):
+            results.update(bench_list(work_dir, args.runs))
+        if selected('report'):
+            results.update(bench_report(session_dir, work_dir, args.runs,
+                                        report_sizes))
+    finally:
+        shutil.rmtree(work_dir)
+    if args.update:
+        for name, metrics in results.items():
+            baseline = baselines['benchmarks'].setdefault(name, {})
+            baseline.update({metric: round(value, 1) for metric, value
+                             in metrics.items() if metric != 'ops_per_sec'})
+        with open(BASELINE_FILE, 'w') as baseline_file:
+            json.dump(baselines, baseline_file, indent=4, sort_keys=True)
+            baseline_file.write('\n')
+        print('Baselines updated')
+        return 0
+    if compare(results, baselines['benchmarks'], baselines['tolerance']):
+        print('FAIL: benchmarks regressed against their baselines')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+"""Measure how long the testrecorder entry point takes to import.
+
+Runs ``python -X importtime`` in fresh interpreters and compares the median
+cumulative import time of the entry point module with the budget tracked in
+startup_budget.json. Also fails if a module that should only be imported on
+demand (such as jinja2) is pulled in at startup.
+
+    python benchmarks/bench_startup.py [--runs N]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BUDGET_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'startup_budget.json')
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(module):
+    """Return the cumulative import time of module in microseconds and the
+    names of every module imported with it"""
+    result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+            cwd=REPO_ROOT, stderr=subprocess.PIPE, check=True,
+            universal_newlines=True)
+    cumulative = None
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, self_us, cumulative_us, name = [
+                field.strip() for field in line.replace(
+                    'import time:', '|', 1).split('|')]
+        if not cumulative_us.isdigit():
+            continue
+        imported.add(name)
+        if name == module:
+            cumulative = int(cumulative_us)
+    return cumulative, imported
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args(argv)
+    with open(BUDGET_FILE) as budget_file:
+        budget = json.load(budget_file)
+    timings = []
+    imported = set()
+    for _ in range(args.runs):
+        cumulative, imported = measure(budget['module'])
+        timings.append(cumulative / 1000)
+    median = statistics.median(timings)
+    print('{}: median import {:.1f}ms over {} runs (budget {}ms)'.format(
+        budget['module'], median, args.runs, budget['import_budget_ms']))
+    failed = False
+    if median > budget['import_budget_ms']:
+        print('FAIL: startup import time is over budget')
+        failed = True
+    eager = sorted(set(budget['forbidden_modules']) & imported)
+    if eager:
+        print('FAIL: imported at startup: ' + ', '.join(eager))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,27 @@
+import os
 import sys
 try:
     from setuptools import setup, find_packages
+    from setuptools.command.build_py import build_py
 except ImportError:
     from distutils.core import setup
+    from distutils.command.build_py import build_py
+
+
+class BuildPyPrecompiled(build_py):
+    """Precompile the report templates into Python modules so reports skip
+    template parsing. Skipped when jinja2 is not available at build time."""
+
+    def run(self):
+        build_py.run(self)
+        try:
+            from test_session.report_generator import SessionReportGenerator
+        except ImportError:
+            return
+        SessionReportGenerator.precompile_templates(os.path.join(
+            self.build_lib, 'test_session',
+            SessionReportGenerator.TEMPLATES_DIR))
+
 
 setup(name='test_session',
       version='0.1',
@@ -17,6 +36,7 @@ setup(name='test_session',
       python_requires='>=3',
       install_requires=['datetime', 'jinja2'],
       include_package_data=True,
+      cmdclass={'build_py': BuildPyPrecompiled},
       entry_points={
           'console_scripts': [
               'testrecorder = test_session.start:main'
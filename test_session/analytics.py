@@ -0,0 +1,82 @@
+class SessionAnalytics:
+    """Rollups over the sessions in a SessionCatalog.
+
+    Every figure is aggregated by SQLite over the catalog's per-session
+    summary rows, so no session file is read to answer a query. Before each
+    query the catalog re-reads the sessions whose file mtime changed since
+    they were summarised, which keeps repeat queries incremental.
+    """
+
+    # Sessions without test areas are counted under this name
+    NO_AREA = '(none)'
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def where(self, pattern=None, area=None, since=None, until=None):
+        """SQL filter on the sessions table for a name glob pattern, a test
+        area and an mtime range in epoch seconds"""
+        clauses = []
+        params = []
+        if pattern:
+            clauses.append('s.name GLOB ?')
+            params.append(pattern)
+        if area:
+            clauses.append('s.name IN (SELECT name FROM session_areas '
+                           'WHERE area = ?)')
+            params.append(area)
+        if since is not None:
+            clauses.append('s.mtime >= ?')
+            params.append(since)
+        if until is not None:
+            clauses.append('s.mtime < ?')
+            params.append(until)
+        if not clauses:
+            return '', params
+        return ' WHERE ' + ' AND '.join(clauses), params
+
+    def stats(self, **filters):
+        """Totals and rates over the filtered sessions. Durations are in
+        seconds, session time is split evenly across a session's areas."""
+        self.catalog.rebuild()
+        where, params = self.where(**filters)
+        row = self.catalog.db.execute(
+                'SELECT COUNT(*), TOTAL(duration), AVG(duration), '
+                'TOTAL(bug_count), TOTAL(entry_count), AVG(entry_count), '
+                'COUNT(timebox), '
+                'TOTAL(duration > timebox), '
+                'TOTAL(MAX(duration - timebox, 0)) '
+                'FROM sessions s' + where, params).fetchone()
+        stats = {'sessions': row[0],
+                 'total_duration': row[1],
+                 'mean_duration': row[2] or 0.0,
+                 'bugs': int(row[3]),
+                 'bugs_per_hour': row[3] / (row[1] / 3600) if row[1] else 0.0,
+                 'entries': int(row[4]),
+                 'entries_per_session': row[5] or 0.0,
+                 'timeboxed': row[6],
+                 'overrun_sessions': int(row[7]),
+                 'total_overrun': row[8]}
+        stats['areas'] = self.area_time(where, params)
+        return stats
+
+    def area_time(self, where, params):
+        rows = self.catalog.db.execute(
+                'SELECT COALESCE(a.area, ?), '
+                'TOTAL(s.duration / MAX(s.area_count, 1)), COUNT(*) '
+                'FROM sessions s LEFT JOIN session_areas a ON a.name = s.name'
+                + where + ' GROUP BY 1 ORDER BY 2 DESC',
+                [self.NO_AREA] + params)
+        return {area: {'duration': duration, 'sessions': sessions}
+                for area, duration, sessions in rows}
+
+    def summaries(self, **filters):
+        """Per-session rows of name, duration, timebox, overrun, bug and
+        entry counts"""
+        self.catalog.rebuild()
+        where, params = self.where(**filters)
+        return self.catalog.db.execute(
+                'SELECT name, duration, timebox, '
+                'MAX(duration - timebox, 0) AS overrun, bug_count, '
+                'entry_count FROM sessions s' + where + ' ORDER BY name',
+                params).fetchall()
@@ -0,0 +1,329 @@
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import zlib
+
+# Screenshot backend classes by name, see register_backend()
+BACKENDS = {}
+
+
+class ScreenshotError(Exception):
+    pass
+
+
+def register_backend(backend_class):
+    """Make backend_class selectable as TESTRECORDER_SCREENSHOT=NAME"""
+    BACKENDS[backend_class.NAME] = backend_class
+    return backend_class
+
+
+def encode_png(width, height, pixels):
+    """PNG file of width x height 8 bit RGB pixels"""
+    stride = width * 3
+    rows = b''.join(b'\x00' + pixels[row:row + stride]
+                    for row in range(0, stride * height, stride))
+
+    def chunk(tag, data):
+        return (struct.pack('>I', len(data)) + tag + data +
+                struct.pack('>I', zlib.crc32(tag + data)))
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0,
+                                       0, 0)) +
+            chunk(b'IDAT', zlib.compress(rows, 6)) + chunk(b'IEND', b''))
+
+
+class RgbCapture:
+    """Raw RGB pixels, only encoded as PNG when stored"""
+
+    def __init__(self, width, height, pixels):
+        self.width = width
+        self.height = height
+        self.pixels = pixels
+
+    def digest(self):
+        content = hashlib.sha256(
+                'rgb {} {}\n'.format(self.width, self.height).encode())
+        content.update(self.pixels)
+        return content.hexdigest()
+
+    def encode(self):
+        return encode_png(self.width, self.height, self.pixels)
+
+    def thumbnail(self, width):
+        """Nearest neighbour scaled PNG no wider than width"""
+        if self.width <= width:
+            return self.encode()
+        height = max(1, self.height * width // self.width)
+        stride = self.width * 3
+        columns = [x * self.width // width * 3 for x in range(width)]
+        pixels = bytearray()
+        for y in range(height):
+            start = y * self.height // height * stride
+            row = self.pixels[start:start + stride]
+            for column in columns:
+                pixels += row[column:column + 3]
+        return encode_png(width, height, bytes(pixels))
+
+
+class PngCapture:
+    """An image a backend already encoded as PNG"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def digest(self):
+        return hashlib.sha256(self.data).hexdigest()
+
+    def encode(self):
+        return self.data
+
+    def thumbnail(self, width):
+        # Scaling needs a PNG decoder, reports show the full image instead
+        return None
+
+
+class PillowCapture:
+    """A PIL image"""
+
+    def __init__(self, image):
+        self.image = image
+
+    def digest(self):
+        content = hashlib.sha256('{} {} {}\n'.format(
+                self.image.mode, *self.image.size).encode())
+        content.update(self.image.tobytes())
+        return content.hexdigest()
+
+    def save(self, image):
+        import io
+        png = io.BytesIO()
+        image.save(png, format='PNG')
+        return png.getvalue()
+
+    def encode(self):
+        return self.save(self.image)
+
+    def thumbnail(self, width):
+        image = self.image.copy()
+        image.thumbnail((width, width * image.size[1] // image.size[0]))
+        return self.save(image)
+
+
+class ScreenshotBackend:
+    """Captures the display. capture() returns an RgbCapture, PngCapture or
+    anything else with digest(), encode() and thumbnail(width)."""
+
+    NAME = None
+
+    @classmethod
+    def available(cls):
+        return False
+
+    def capture(self):
+        raise NotImplementedError
+
+
+@register_backend
+class PillowBackend(ScreenshotBackend):
+    """PIL's ImageGrab, where Pillow is installed"""
+
+    NAME = 'pillow'
+
+    @classmethod
+    def available(cls):
+        try:
+            from PIL import ImageGrab  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def capture(self):
+        from PIL import ImageGrab
+        try:
+            return PillowCapture(ImageGrab.grab())
+        except OSError as error:
+            raise ScreenshotError(str(error))
+
+
+@register_backend
+class CommandBackend(ScreenshotBackend):
+    """The first screenshot tool found on the PATH"""
+
+    NAME = 'command'
+    # Commands writing a PNG of the whole display to {path}
+    COMMANDS = (('screencapture', '-x', '-t', 'png', '{path}'),
+                ('grim', '{path}'),
+                ('gnome-screenshot', '-f', '{path}'),
+                ('import', '-window', 'root', '{path}'))
+    TIMEOUT_SECONDS = 10
+
+    @classmethod
+    def find_command(cls):
+        for command in cls.COMMANDS:
+            if shutil.which(command[0]):
+                return command
+        return None
+
+    @classmethod
+    def available(cls):
+        return cls.find_command() is not None
+
+    def capture(self):
+        import subprocess
+        command = self.find_command()
+        if command is None:
+            raise ScreenshotError('No screenshot tool found')
+        fd, path = tempfile.mkstemp(suffix='.png')
+        os.close(fd)
+        try:
+            subprocess.run([arg.format(path=path) for arg in command],
+                           check=True, timeout=self.TIMEOUT_SECONDS,
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+            with open(path, 'rb') as png:
+                return PngCapture(png.read())
+        except (OSError, subprocess.SubprocessError) as error:
+            raise ScreenshotError(str(error))
+        finally:
+            os.remove(path)
+
+
+@register_backend
+class PlaceholderBackend(ScreenshotBackend):
+    """A fixed test pattern, a stand-in where there is no display. Never
+    picked unless asked for."""
+
+    NAME = 'placeholder'
+    WIDTH = 320
+    HEIGHT = 180
+
+    def capture(self):
+        pixels = bytearray()
+        for y in range(self.HEIGHT):
+            for x in range(self.WIDTH):
+                pixels += bytes((x * 255 // self.WIDTH,
+                                 y * 255 // self.HEIGHT, 128))
+        return RgbCapture(self.WIDTH, self.HEIGHT, bytes(pixels))
+
+
+def get_backend(name=None):
+    """The backend named by name or TESTRECORDER_SCREENSHOT, otherwise the
+    first available one"""
+    name = name or os.environ.get('TESTRECORDER_SCREENSHOT')
+    if name:
+        if name not in BACKENDS:
+            raise ScreenshotError('Unknown screenshot backend ' + name)
+        return BACKENDS[name]()
+    for backend_class in (PillowBackend, CommandBackend):
+        if backend_class.available():
+            return backend_class()
+    raise ScreenshotError('No screenshot backend available, set '
+                          'TESTRECORDER_SCREENSHOT=placeholder for a stand-in')
+
+
+class AttachmentStore:
+    """Content-addressed store of the images attached to sessions.
+
+    Images are stored once under the SHA-256 digest of their content, which
+    is all a session log holds, so attachments never grow a session file.
+    put() only hashes the capture; encoding it as PNG, scaling its thumbnail
+    and writing both happen on a background thread.
+    """
+
+    DIRNAME = 'attachments'
+    OBJECTS_DIR = 'objects'
+    THUMBNAILS_DIR = 'thumbnails'
+    EXTENSION = '.png'
+    THUMBNAIL_WIDTH = 240
+
+    def __init__(self, root):
+        self.root = root
+        self.executor = None
+        # Futures of the writes not finished yet, by digest
+        self.pending = {}
+        # Errors of the writes that failed, by digest, see close()
+        self.failed = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def beside(cls, session_dir):
+        """The store next to session_dir"""
+        return cls(os.path.join(os.path.dirname(os.path.abspath(session_dir)),
+                                cls.DIRNAME))
+
+    def blob_path(self, directory, digest):
+        return os.path.join(self.root, directory, digest[:2],
+                            digest[2:] + self.EXTENSION)
+
+    def path(self, digest):
+        return self.blob_path(self.OBJECTS_DIR, digest)
+
+    def thumbnail_path(self, digest):
+        return self.blob_path(self.THUMBNAILS_DIR, digest)
+
+    def put(self, capture):
+        """Store capture unless an identical image is stored, returning its
+        digest before it is written"""
+        digest = capture.digest()
+        with self.lock:
+            if digest in self.pending or os.path.exists(self.path(digest)):
+                return digest
+            if self.executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self.executor = ThreadPoolExecutor(
+                        1, thread_name_prefix='attachments')
+            self.failed.pop(digest, None)
+            future = self.executor.submit(self.write, digest, capture)
+            self.pending[digest] = future
+        future.add_done_callback(lambda future: self.done(digest, future))
+        return digest
+
+    def done(self, digest, future):
+        with self.lock:
+            self.pending.pop(digest, None)
+            if not future.cancelled() and future.exception() is not None:
+                self.failed[digest] = future.exception()
+
+    def write(self, digest, capture):
+        thumbnail = capture.thumbnail(self.THUMBNAIL_WIDTH)
+        if thumbnail is not None:
+            self.write_blob(self.thumbnail_path(digest), thumbnail)
+        # The image last, its presence marks the attachment as stored
+        self.write_blob(self.path(digest), capture.encode())
+
+    @staticmethod
+    def write_blob(path, data):
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.',
+                                        suffix='.tmp')
+        try:
+            with open(fd, 'wb') as blob:
+                blob.write(data)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def wait(self):
+        """Wait until every attachment put so far is written, raising the
+        first error"""
+        with self.lock:
+            futures = list(self.pending.values())
+        for future in futures:
+            future.result()
+
+    def close(self):
+        """Wait for the writes still running, returning the errors of the
+        attachments that could not be written by digest"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        with self.lock:
+            failed, self.failed = self.failed, {}
+        return failed
@@ -0,0 +1,104 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from .report_generator import SessionReportGenerator
+
+# Report generator of the current process, shared by every report it renders
+# so the template is compiled once per process rather than once per session
+_generator = None
+
+
+def _init_worker(reports_dir, package):
+    global _generator
+    # Forked workers inherit the parent's compiled template
+    if _generator is None or _generator.reports_dir != reports_dir:
+        _generator = SessionReportGenerator(reports_dir, package)
+
+
+def _report_worker(job):
+    session_name, session_dir = job
+    if not _generator.generate_session_report(session_name, session_dir):
+        return session_name, False, 0
+    report_path = os.path.join(_generator.reports_dir, session_name + '.html')
+    return session_name, True, os.path.getsize(report_path)
+
+
+class BatchReportStats:
+
+    def __init__(self):
+        self.generated = 0
+        self.skipped = 0
+        self.failed = []
+        self.bytes_written = 0
+        self.elapsed = 0.0
+
+    @property
+    def sessions_per_second(self):
+        if not self.elapsed:
+            return 0.0
+        return self.generated / self.elapsed
+
+    @property
+    def megabytes_written(self):
+        return self.bytes_written / (1024 * 1024)
+
+    def __str__(self):
+        return ('{} reports generated, {} up to date, {} failed in {:.2f}s '
+                '({:.1f} sessions/sec, {:.2f} MB written)'.format(
+                    self.generated, self.skipped, len(self.failed),
+                    self.elapsed, self.sessions_per_second,
+                    self.megabytes_written))
+
+
+def is_report_current(session_name, session_dir, reports_dir):
+    try:
+        report_mtime = os.path.getmtime(
+                os.path.join(reports_dir, session_name + '.html'))
+    except OSError:
+        return False
+    return report_mtime >= os.path.getmtime(
+            os.path.join(session_dir, session_name))
+
+
+def generate_reports(session_names, session_dir, reports_dir, package,
+                     workers=None, force=False):
+    """Generate an HTML report for each of session_names.
+
+    Sessions whose report is newer than the session file are skipped unless
+    force is set. The remaining sessions are sharded across a pool of worker
+    processes, or rendered in this process when workers is 1."""
+    stats = BatchReportStats()
+    start = time.monotonic()
+    jobs = []
+    for session_name in session_names:
+        if not force and is_report_current(session_name, session_dir,
+                                           reports_dir):
+            stats.skipped += 1
+        else:
+            jobs.append((session_name, session_dir))
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(jobs)))
+    _init_worker(reports_dir, package)
+    if workers == 1:
+        results = map(_report_worker, jobs)
+        _collect(stats, results)
+    else:
+        # A few chunks per worker balances uneven session sizes without
+        # paying a round trip per session
+        chunksize = max(1, len(jobs) // (workers * 4))
+        with ProcessPoolExecutor(workers, initializer=_init_worker,
+                                 initargs=(reports_dir, package)) as pool:
+            _collect(stats, pool.map(_report_worker, jobs,
+                                     chunksize=chunksize))
+    stats.elapsed = time.monotonic() - start
+    return stats
+
+
+def _collect(stats, results):
+    for session_name, success, size in results:
+        if success:
+            stats.generated += 1
+            stats.bytes_written += size
+        else:
+            stats.failed.append(session_name)
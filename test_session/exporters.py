@@ -0,0 +1,185 @@
+import csv
+import json
+import os
+import tempfile
+import time
+from .session import Session
+from .session_timer import format_duration
+
+# Exporter classes by format name, see register_exporter()
+EXPORTERS = {}
+
+
+def register_exporter(exporter_class):
+    """Make exporter_class available as report --format FORMAT"""
+    EXPORTERS[exporter_class.FORMAT] = exporter_class
+    return exporter_class
+
+
+class SessionExporter:
+    """Writes sessions to a text stream in one export format.
+
+    Entries are streamed from the session file as they are written out, so
+    exporting never holds a whole session log in memory. begin() and end()
+    are called once per file, write_session() once per session, which lets
+    one file hold any number of sessions.
+    """
+
+    FORMAT = None
+    EXTENSION = None
+    # Exports are written through this much buffer
+    BUFFER_SIZE = 64 * 1024
+    EXPORT_MODE = 0o644
+
+    def __init__(self, stream, session_dir):
+        self.stream = stream
+        self.session_dir = session_dir
+
+    def begin(self):
+        pass
+
+    def write_session(self, session_name, header):
+        raise NotImplementedError
+
+    def end(self):
+        pass
+
+    def iter_log(self, session_name):
+        return Session.iter_log(session_name, self.session_dir)
+
+    @staticmethod
+    def iso_time(epoch):
+        return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(epoch))
+
+    @staticmethod
+    def kind(entry):
+        if entry.screenshot:
+            return 'screenshot'
+        return 'bug' if entry.bug else 'note'
+
+
+@register_exporter
+class JsonLinesExporter(SessionExporter):
+    """A session object followed by one object per log entry"""
+
+    FORMAT = 'jsonl'
+    EXTENSION = '.jsonl'
+
+    def write_line(self, record):
+        self.stream.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def write_session(self, session_name, header):
+        self.write_line({'type': 'session', 'session': session_name,
+                         'mission': header[Session.MISSION_KEY],
+                         'areas': header[Session.AREAS_KEY],
+                         'timebox': header[Session.TIMEBOX_KEY],
+                         'duration': header[Session.DURATION_KEY],
+                         'debrief': header[Session.DEBRIEF_KEY]})
+        for entry in self.iter_log(session_name):
+            self.write_line({'type': 'entry', 'session': session_name,
+                             'time': self.iso_time(entry.epoch),
+                             'epoch': entry.epoch, 'kind': self.kind(entry),
+                             'text': entry.text.strip()})
+
+
+@register_exporter
+class CsvExporter(SessionExporter):
+    """One row per log entry, with the session fields on every row"""
+
+    FORMAT = 'csv'
+    EXTENSION = '.csv'
+    COLUMNS = ('session', 'mission', 'areas', 'timebox', 'duration', 'time',
+               'epoch', 'kind', 'text')
+
+    def begin(self):
+        self.writer = csv.writer(self.stream)
+        self.writer.writerow(self.COLUMNS)
+
+    def write_session(self, session_name, header):
+        session_fields = (session_name, header[Session.MISSION_KEY],
+                          '; '.join(header[Session.AREAS_KEY]),
+                          header[Session.TIMEBOX_KEY],
+                          header[Session.DURATION_KEY])
+        self.writer.writerows(
+                session_fields + (self.iso_time(entry.epoch), entry.epoch,
+                                  self.kind(entry), entry.text.strip())
+                for entry in self.iter_log(session_name))
+
+
+@register_exporter
+class MarkdownExporter(SessionExporter):
+    """A section per session with its log and bugs as lists"""
+
+    FORMAT = 'md'
+    EXTENSION = '.md'
+
+    def write_session(self, session_name, header):
+        write = self.stream.write
+        write('# ' + session_name + '\n\n')
+        if header[Session.MISSION_KEY]:
+            write('- **Test Mission:** ' +
+                  header[Session.MISSION_KEY].strip() + '\n')
+        if header[Session.AREAS_KEY]:
+            write('- **Test Areas:** ' +
+                  ', '.join(header[Session.AREAS_KEY]) + '\n')
+        write('- **Time Box:** ' +
+              format_duration(header[Session.TIMEBOX_KEY]) + '\n')
+        write('- **Duration:** ' +
+              format_duration(header[Session.DURATION_KEY]) + '\n\n')
+        write('## Test Log\n\n')
+        for entry in self.iter_log(session_name):
+            write(self.list_item(entry))
+        # A second pass over the file rather than holding the bugs back
+        bugs = (entry for entry in self.iter_log(session_name) if entry.bug)
+        for index, entry in enumerate(bugs):
+            if index == 0:
+                write('\n## Bugs\n\n')
+            write(self.list_item(entry))
+        if header[Session.DEBRIEF_KEY]:
+            write('\n## Debrief\n\n' + header[Session.DEBRIEF_KEY] + '\n')
+        write('\n')
+
+    def list_item(self, entry):
+        kind = ''
+        if entry.bug:
+            kind = ' **BUG**'
+        elif entry.screenshot:
+            kind = ' **SCREENSHOT**'
+        return '- `{}`{} {}\n'.format(entry.date, kind,
+                                      self.escape(entry.text.strip()))
+
+    @staticmethod
+    def escape(text):
+        for char in '\\`*_[]<>#|':
+            text = text.replace(char, '\\' + char)
+        return text
+
+
+def export_sessions(format_name, session_names, session_dir, path):
+    """Export session_names into the one file at path.
+
+    The export is written to a temporary file that replaces path only once
+    every session was written. Returns False if any session failed."""
+    exporter_class = EXPORTERS[format_name]
+    tmp_path = None
+    try:
+        tmp_fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(path), prefix='.export-', suffix='.tmp')
+        # The csv module does its own line endings
+        with open(tmp_fd, 'w', encoding='utf-8', newline='',
+                  buffering=SessionExporter.BUFFER_SIZE) as stream:
+            exporter = exporter_class(stream, session_dir)
+            exporter.begin()
+            for session_name in session_names:
+                header = Session.get_session_header(session_name,
+                                                    session_dir)
+                exporter.write_session(session_name, header)
+            exporter.end()
+        os.chmod(tmp_path, SessionExporter.EXPORT_MODE)
+        os.replace(tmp_path, path)
+    except Exception:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    else:
+        return True
@@ -0,0 +1,215 @@
+import bisect
+import functools
+import importlib
+import json
+import os
+import threading
+import time
+
+
+class OperationHistogram:
+    """Latency histogram and counters of one instrumented operation"""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # One count per bound plus the overflow bucket, not cumulative
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def observe(self, seconds, failed=False):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        if failed:
+            self.errors += 1
+
+    def cumulative(self):
+        """(upper bound, count) pairs as Prometheus buckets, the last bound
+        being '+Inf'"""
+        total = 0
+        buckets = []
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+
+class Instrumentation:
+    """Opt-in timing of the recorder's hot paths.
+
+    Nothing is instrumented until start() is called, which wraps the methods
+    named in TARGETS with a timer, so a recorder running without profiling
+    pays nothing. Times are inclusive: a command's time includes the storage
+    writes it makes. On stop() the histograms are written to path as
+    Prometheus text when it ends in .prom or .txt, as JSON otherwise, and a
+    cProfile capture of the whole run to cprofile_path if one was given.
+    """
+
+    # Instrumentation can also be switched on through the environment
+    PROFILE_ENV = 'TESTRECORDER_PROFILE'
+    CPROFILE_ENV = 'TESTRECORDER_CPROFILE'
+    DEFAULT_PATH = 'testrecorder-profile.json'
+    PROMETHEUS_SUFFIXES = ('.prom', '.txt')
+    METRIC = 'testrecorder_operation_seconds'
+    # Histogram bucket upper bounds in seconds
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+               0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    # (module, class or None for a module function, attribute, operation)
+    TARGETS = (
+        ('test_session.test_session_recorder', 'TestSessionRecorder',
+         'onecmd', 'recorder.command'),
+        ('test_session.test_session_recorder', 'TestSessionRecorder',
+         'precmd', 'recorder.precmd'),
+        ('test_session.session', 'Session', 'process_session_cmd',
+         'session.command'),
+        ('test_session.session_store', 'JournalStore', 'load', 'store.load'),
+        ('test_session.session_store', 'JournalStore', 'write',
+         'store.write'),
+        ('test_session.session_store', 'JournalStore', 'sync', 'store.sync'),
+        ('test_session.session_store', 'JournalStore', 'write_lines',
+         'store.flush'),
+        ('test_session.session_store', 'JournalStore', 'catch_up',
+         'store.catch_up'),
+        ('test_session.session_store', 'JournalStore', 'compact',
+         'store.compact'),
+        ('test_session.report_generator', 'SessionReportGenerator',
+         'generate_session_report', 'report.session'),
+        ('test_session.report_generator', 'SessionReportGenerator',
+         'render', 'report.render'),
+        ('test_session.report_generator', 'SessionReportGenerator',
+         'update_report', 'report.update'),
+        ('test_session.exporters', None, 'export_sessions', 'report.export'),
+        ('test_session.batch_report', None, 'generate_reports',
+         'report.batch'),
+    )
+
+    def __init__(self, path=None, cprofile_path=None):
+        self.path = path
+        self.cprofile_path = cprofile_path
+        self.histograms = {}
+        self.lock = threading.Lock()
+        # (owner, attribute, original) of every wrapped target
+        self.patched = []
+        self.profiler = None
+
+    @classmethod
+    def from_settings(cls, path=None, cprofile_path=None):
+        """An Instrumentation for the given paths or the environment, None
+        when neither asks for one"""
+        path = path or os.environ.get(cls.PROFILE_ENV)
+        cprofile_path = cprofile_path or os.environ.get(cls.CPROFILE_ENV)
+        if not path and not cprofile_path:
+            return None
+        return cls(path, cprofile_path)
+
+    def start(self):
+        if self.path:
+            for module_name, class_name, attribute, operation in self.TARGETS:
+                module = importlib.import_module(module_name)
+                owner = getattr(module, class_name) if class_name else module
+                self.wrap(owner, attribute, operation)
+        if self.cprofile_path:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def stop(self):
+        """Remove the timers and write out what was measured"""
+        if self.profiler:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.cprofile_path)
+            self.profiler = None
+        while self.patched:
+            owner, attribute, original = self.patched.pop()
+            if original is None:
+                # Inherited, eg. cmd.Cmd.onecmd
+                delattr(owner, attribute)
+            else:
+                setattr(owner, attribute, original)
+        if self.path:
+            self.write(self.path)
+
+    def wrap(self, owner, attribute, operation):
+        # Only needed once instrumentation is turned on
+        import inspect
+        function = inspect.getattr_static(owner, attribute)
+        if isinstance(function, (classmethod, staticmethod)):
+            wrapped = type(function)(self.timed(operation,
+                                                function.__func__))
+        else:
+            wrapped = self.timed(operation, function)
+        self.patched.append((owner, attribute,
+                             vars(owner).get(attribute)))
+        setattr(owner, attribute, wrapped)
+
+    def timed(self, operation, function):
+        clock = time.perf_counter
+        observe = self.observe
+
+        @functools.wraps(function)
+        def timer(*args, **kwargs):
+            start = clock()
+            failed = True
+            try:
+                result = function(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                observe(operation, clock() - start, failed)
+        return timer
+
+    def observe(self, operation, seconds, failed=False):
+        # The write-behind thread reports storage writes too
+        with self.lock:
+            histogram = self.histograms.get(operation)
+            if histogram is None:
+                histogram = OperationHistogram(self.BUCKETS)
+                self.histograms[operation] = histogram
+            histogram.observe(seconds, failed)
+
+    def as_json(self):
+        with self.lock:
+            operations = {
+                operation: {'count': histogram.count,
+                            'errors': histogram.errors,
+                            'sum_seconds': histogram.total_seconds,
+                            'max_seconds': histogram.max_seconds,
+                            'buckets': {str(bound): count for bound, count
+                                        in histogram.cumulative()}}
+                for operation, histogram in sorted(self.histograms.items())}
+        return json.dumps({'operations': operations}, indent=2) + '\n'
+
+    def as_prometheus(self):
+        lines = ['# HELP {} Time spent in recorder operations'.format(
+                     self.METRIC),
+                 '# TYPE {} histogram'.format(self.METRIC)]
+        errors = []
+        with self.lock:
+            for operation, histogram in sorted(self.histograms.items()):
+                label = 'operation="{}"'.format(operation)
+                for bound, count in histogram.cumulative():
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                        self.METRIC, label, bound, count))
+                lines.append('{}_sum{{{}}} {!r}'.format(
+                    self.METRIC, label, histogram.total_seconds))
+                lines.append('{}_count{{{}}} {}'.format(
+                    self.METRIC, label, histogram.count))
+                errors.append('testrecorder_operation_errors_total{{{}}} '
+                              '{}'.format(label, histogram.errors))
+        lines.append('# HELP testrecorder_operation_errors_total Operations '
+                     'that raised')
+        lines.append('# TYPE testrecorder_operation_errors_total counter')
+        return '\n'.join(lines + errors) + '\n'
+
+    def write(self, path):
+        if path.endswith(self.PROMETHEUS_SUFFIXES):
+            text = self.as_prometheus()
+        else:
+            text = self.as_json()
+        with open(path, 'w') as metrics:
+            metrics.write(text)
@@ -0,0 +1,61 @@
+import collections
+import datetime
+import enum
+import time
+
+
+class EntryKind(enum.IntEnum):
+    NOTE = 0
+    BUG = 1
+    # The text is the digest of an image in the AttachmentStore
+    SCREENSHOT = 2
+
+
+class LogEntry(collections.namedtuple('LogEntry', ['epoch', 'kind', 'text'])):
+    """A session log entry.
+
+    Stored as a tuple of the entry time in epoch seconds, its EntryKind and
+    its text, which persists as a three item JSON list. The display date is
+    only formatted when the entry is shown or reported.
+    """
+
+    __slots__ = ()
+
+    DATE_FORMAT = '[%Y-%m-%d %H:%M:%S]'
+
+    @property
+    def bug(self):
+        return self.kind == EntryKind.BUG
+
+    @property
+    def screenshot(self):
+        return self.kind == EntryKind.SCREENSHOT
+
+    @property
+    def date(self):
+        return time.strftime(self.DATE_FORMAT, time.localtime(self.epoch))
+
+    @classmethod
+    def parse_date(cls, date):
+        """Epoch seconds of a date in DATE_FORMAT"""
+        return int(datetime.datetime.strptime(
+            date, cls.DATE_FORMAT).timestamp())
+
+    @classmethod
+    def epoch_of(cls, value):
+        """Epoch seconds of an entry or of its persisted form, without
+        building the entry"""
+        if isinstance(value, dict):
+            return cls.parse_date(value['date'])
+        return value[0]
+
+    @classmethod
+    def from_value(cls, value):
+        """Build an entry from its persisted form, including the
+        {'date', 'entry', 'bug'} dicts of sessions recorded before LogEntry"""
+        if isinstance(value, dict):
+            return cls(cls.parse_date(value['date']),
+                       EntryKind.BUG if value['bug'] else EntryKind.NOTE,
+                       value['entry'])
+        epoch, kind, text = value
+        return cls(epoch, EntryKind(kind), text)
@@ -0,0 +1,111 @@
+import csv
+import os
+import re
+from .session_catalog import SessionCatalog
+from .session_timer import as_seconds
+
+
+class CharterError(Exception):
+    pass
+
+
+# Charter file readers by file extension, see read_charters()
+READERS = {}
+
+
+def register_reader(*extensions):
+    """Make a function reading a charter file into a list of dicts the
+    reader for files ending in extensions"""
+    def register(reader):
+        for extension in extensions:
+            READERS[extension] = reader
+        return reader
+    return register
+
+
+@register_reader('.csv')
+def read_csv(path):
+    """One charter per row, under a header row naming the fields"""
+    with open(path, newline='', encoding='utf-8') as charters:
+        return [{key.strip().lower(): value for key, value in row.items()
+                 if key is not None}
+                for row in csv.DictReader(charters)]
+
+
+@register_reader('.yaml', '.yml')
+def read_yaml(path):
+    """A list of charters, or a mapping of them under 'sessions' with the
+    fields every charter starts from under 'template'"""
+    try:
+        import yaml
+    except ImportError:
+        raise CharterError('Reading YAML charters needs PyYAML, pip install '
+                           'pyyaml or use a CSV file')
+    with open(path, encoding='utf-8') as charters:
+        try:
+            document = yaml.safe_load(charters)
+        except yaml.YAMLError as error:
+            raise CharterError('Invalid YAML: {}'.format(error))
+    template = {}
+    if isinstance(document, dict):
+        template = document.get('template') or {}
+        document = document.get('sessions')
+    if not isinstance(document, list) or not isinstance(template, dict):
+        raise CharterError('Expected a list of sessions')
+    charters = []
+    for charter in document:
+        if not isinstance(charter, dict):
+            raise CharterError('Expected a list of sessions')
+        charters.append(dict(template, **charter))
+    return charters
+
+
+def parse_charter(number, fields):
+    """A charter's session name, mission, areas and timebox in seconds"""
+    name = str(fields.get('name') or fields.get('session') or '').strip()
+    if not name or os.sep in name or not SessionCatalog.is_session_file(name):
+        raise CharterError('Charter {}: invalid session name {!r}'.format(
+            number, name))
+    mission = fields.get('mission')
+    mission = str(mission).strip() if mission else None
+    areas = fields.get('areas') or []
+    if isinstance(areas, str):
+        areas = re.split('[,;]', areas)
+    areas = [str(area).strip() for area in areas if str(area).strip()]
+    timebox = fields.get('timebox')
+    if timebox in (None, ''):
+        timebox = None
+    elif isinstance(timebox, (int, float)) and not isinstance(timebox, bool):
+        # YAML reads an unquoted 90 or 1:30:00 (base 60) as seconds
+        if timebox < 0:
+            raise CharterError('Charter {}: invalid timebox {!r}'.format(
+                number, timebox))
+        timebox = as_seconds(timebox)
+    else:
+        timebox = as_seconds(str(timebox).strip())
+        if isinstance(timebox, str):
+            raise CharterError('Charter {}: invalid timebox {!r}, use eg. '
+                               '90m, 1h30 or 01:30:00'.format(number, timebox))
+    return {'name': name, 'mission': mission, 'areas': areas,
+            'timebox': timebox}
+
+
+def read_charters(path):
+    """The charters in a CSV or YAML file, checked and parsed"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in READERS:
+        raise CharterError('Charter files must end in one of: ' +
+                           ', '.join(sorted(READERS)))
+    try:
+        rows = READERS[extension](path)
+    except (OSError, UnicodeDecodeError, csv.Error) as error:
+        raise CharterError(str(error))
+    charters = [parse_charter(number, fields)
+                for number, fields in enumerate(rows, 1)]
+    names = set()
+    for charter in charters:
+        if charter['name'] in names:
+            raise CharterError('Session {} is chartered twice'.format(
+                charter['name']))
+        names.add(charter['name'])
+    return charters
@@ -0,0 +1,330 @@
+import getpass
+import http.client
+import json
+import os
+import queue
+import threading
+import urllib.parse
+from .session_store import JournalStore
+
+
+class RemoteError(Exception):
+    pass
+
+
+class RemoteClient:
+    """HTTP client of a SessionServer, reusing a small pool of keep-alive
+    connections"""
+
+    URL_ENV = 'TESTRECORDER_REMOTE'
+    OWNER_ENV = 'TESTRECORDER_REMOTE_OWNER'
+    POOL_SIZE = 4
+    TIMEOUT_SECONDS = 10
+
+    def __init__(self, url, owner=None):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError('Invalid session server URL ' + url)
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.prefix = parts.path.rstrip('/')
+        # Sessions are stored on the server as OWNER-NAME, so testers can
+        # use the same session names
+        self.owner = owner or getpass.getuser()
+        self.pool = queue.LifoQueue(self.POOL_SIZE)
+
+    @classmethod
+    def from_settings(cls, url=None, owner=None):
+        """A client of the server named by url or the environment, None when
+        neither names one"""
+        url = url or os.environ.get(cls.URL_ENV)
+        if not url:
+            return None
+        return cls(url, owner or os.environ.get(cls.OWNER_ENV))
+
+    def remote_name(self, session_name):
+        return self.owner + '-' + session_name
+
+    def connect(self):
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, self.port,
+                                               timeout=self.TIMEOUT_SECONDS)
+        return http.client.HTTPConnection(self.host, self.port,
+                                          timeout=self.TIMEOUT_SECONDS)
+
+    def request(self, method, path, body=None):
+        """Status and decoded JSON reply of a request. A pooled connection
+        the server closed meanwhile is replaced once."""
+        headers = {'Content-Type': 'application/x-ndjson'} if body else {}
+        for attempt in range(2):
+            try:
+                connection = self.pool.get_nowait()
+                reused = True
+            except queue.Empty:
+                connection = self.connect()
+                reused = False
+            try:
+                connection.request(method, self.prefix + path, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException) as error:
+                connection.close()
+                if reused and attempt == 0:
+                    continue
+                raise RemoteError(str(error))
+            if response.will_close:
+                connection.close()
+            else:
+                try:
+                    self.pool.put_nowait(connection)
+                except queue.Full:
+                    connection.close()
+            try:
+                return response.status, json.loads(data)
+            except ValueError:
+                raise RemoteError('Invalid reply from the session server')
+
+    def session_path(self, session_name):
+        return '/sessions/' + urllib.parse.quote(
+                self.remote_name(session_name), safe='')
+
+    def session_state(self, session_name):
+        """The server's {'last_id'} of a session, None if it has none"""
+        status, reply = self.request('GET', self.session_path(session_name))
+        if status == 404:
+            return None
+        if status != 200:
+            raise RemoteError(reply.get('error', 'HTTP {}'.format(status)))
+        return reply
+
+    def upload(self, session_name, lines):
+        """Send journal record lines in one request"""
+        status, reply = self.request(
+                'POST', self.session_path(session_name) + '/records',
+                ''.join(lines).encode('utf-8'))
+        if status != 200:
+            raise RemoteError(reply.get('error', 'HTTP {}'.format(status)))
+        return reply
+
+    def sessions(self):
+        status, reply = self.request('GET', '/sessions')
+        if status != 200:
+            raise RemoteError(reply.get('error', 'HTTP {}'.format(status)))
+        return reply['sessions']
+
+    def close(self):
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class Outbox:
+    """Journal records of a session waiting to be uploaded.
+
+    Records are appended to a file in the session directory, so what could
+    not be uploaded survives the recorder and is sent by a later run. Once
+    everything in it was uploaded the file is emptied."""
+
+    DIRNAME = '.outbox'
+
+    def __init__(self, session_dir, session_name):
+        directory = os.path.join(session_dir, self.DIRNAME)
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self.session_name = session_name
+        self.path = os.path.join(directory, session_name)
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.lock = threading.Lock()
+        # Bytes at the head of the file already uploaded
+        self.sent = 0
+
+    @classmethod
+    def pending_sessions(cls, session_dir):
+        """Names of the sessions with records waiting to be uploaded"""
+        directory = os.path.join(session_dir, cls.DIRNAME)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(entry.name for entry in os.scandir(directory)
+                      if entry.stat().st_size)
+
+    def add(self, line):
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def read(self, limit):
+        """Up to limit whole lines not uploaded yet and the offset after
+        them. A snapshot is never split from its chunk records, the server
+        restores it from one upload."""
+        lines = []
+        position = self.sent
+        with open(self.path, 'rb') as outbox:
+            outbox.seek(position)
+            for line in outbox:
+                if not line.endswith(b'\n'):
+                    break
+                if len(lines) >= limit and not self.is_chunk(line):
+                    break
+                lines.append(line.decode('utf-8'))
+                position += len(line)
+        return lines, position
+
+    @staticmethod
+    def is_chunk(line):
+        try:
+            return json.loads(line).get('op') == JournalStore.CHUNK
+        except ValueError:
+            return False
+
+    def mark_sent(self, position):
+        with self.lock:
+            self.sent = position
+            if self.sent >= os.fstat(self.file.fileno()).st_size:
+                self.file.truncate(0)
+                self.sent = 0
+
+    def pending(self):
+        with self.lock:
+            return os.fstat(self.file.fileno()).st_size > self.sent
+
+    def close(self):
+        self.file.close()
+
+
+class RemoteStore:
+    """Mirrors a session's journal to a session server.
+
+    Attached to a session's JournalStore as a listener, so recording never
+    waits for the network: every record written is added to the session's
+    Outbox and a background thread uploads the outbox in batches of up to
+    BATCH_RECORDS records per request over a pooled connection. While the
+    server can not be reached the outbox grows and uploads are retried with
+    a growing delay. A session the server is missing entries of is sent as a
+    snapshot first.
+    """
+
+    BATCH_RECORDS = 1000
+    # Records written within this many seconds go in one upload
+    GATHER_SECONDS = 0.1
+    RETRY_SECONDS = 1.0
+    MAX_RETRY_SECONDS = 60.0
+    # close() waits this long for the outbox to be uploaded
+    CLOSE_SECONDS = 5.0
+
+    def __init__(self, client, session):
+        self.client = client
+        self.session_name = session.session_name
+        self.store = session.store
+        self.outbox = Outbox(session.session_dir, self.session_name)
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.error = None
+        self.store.listeners.append(self.on_record)
+        self.uploader = threading.Thread(target=self.upload_loop,
+                                         name='remote-uploader', daemon=True)
+        self.uploader.start()
+
+    def send_snapshot(self):
+        """Bring the server up to date with the whole session if it is
+        missing entries, eg. ones recorded before the session was mirrored.
+        Records queued before the snapshot only repeat what it holds."""
+        try:
+            state = self.client.session_state(self.session_name)
+            if state is not None and state['last_id'] == self.last_id():
+                return
+            self.client.upload(self.session_name, self.snapshot_lines())
+        except RemoteError as error:
+            # Offline, the snapshot waits in the outbox
+            self.error = error
+            self.outbox.add(''.join(self.snapshot_lines()))
+
+    def last_id(self):
+        with self.store.mutex:
+            return max((max(ids) for ids in self.store.ids.values() if ids),
+                       default=-1)
+
+    def snapshot_lines(self):
+        with self.store.mutex:
+            return self.store.snapshot_lines()
+
+    def on_record(self, record):
+        self.outbox.add(JournalStore.dumps(record) + '\n')
+        self.wake.set()
+
+    def upload_loop(self):
+        self.send_snapshot()
+        # Anything left in the outbox by an earlier run goes first
+        self.wake.set()
+        delay = self.RETRY_SECONDS
+        while not self.stopping.is_set():
+            self.wake.wait()
+            self.wake.clear()
+            # Let a burst of records gather into one upload
+            self.stopping.wait(self.GATHER_SECONDS)
+            try:
+                self.upload_pending(self.client, self.outbox,
+                                    self.BATCH_RECORDS)
+            except RemoteError as error:
+                self.error = error
+                if self.stopping.wait(delay):
+                    return
+                delay = min(delay * 2, self.MAX_RETRY_SECONDS)
+                self.wake.set()
+            else:
+                self.error = None
+                delay = self.RETRY_SECONDS
+
+    @staticmethod
+    def upload_pending(client, outbox, batch_records):
+        """Upload everything in outbox, returning how many records were
+        sent"""
+        sent = 0
+        while True:
+            lines, position = outbox.read(batch_records)
+            if not lines:
+                return sent
+            client.upload(outbox.session_name, lines)
+            outbox.mark_sent(position)
+            sent += len(lines)
+
+    @classmethod
+    def sync(cls, client, session_dir, exclude=()):
+        """Upload the outboxes left by earlier runs, except those of the
+        sessions in exclude, returning the number of records sent and the
+        names of the sessions that failed"""
+        sent = 0
+        failed = []
+        for session_name in Outbox.pending_sessions(session_dir):
+            if session_name in exclude:
+                continue
+            outbox = Outbox(session_dir, session_name)
+            try:
+                sent += cls.upload_pending(client, outbox, cls.BATCH_RECORDS)
+            except RemoteError:
+                failed.append(session_name)
+            finally:
+                outbox.close()
+        return sent, failed
+
+    def close(self):
+        """Stop mirroring, waiting a little for the outbox to be uploaded.
+        Returns True if nothing is left waiting in it."""
+        if self.on_record in self.store.listeners:
+            self.store.listeners.remove(self.on_record)
+        if self.outbox.pending() and self.error is None:
+            self.wake.set()
+            # Checked between uploads, a failed one leaves error set
+            deadline = self.CLOSE_SECONDS
+            while deadline > 0 and self.outbox.pending() and (
+                    self.error is None):
+                self.stopping.wait(0.05)
+                deadline -= 0.05
+        self.stopping.set()
+        self.wake.set()
+        self.uploader.join()
+        uploaded = not self.outbox.pending()
+        self.outbox.close()
+        return uploaded
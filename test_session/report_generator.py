@@ -1,33 +1,457 @@
-from jinja2 import Environment, PackageLoader
+from jinja2 import (ChoiceLoader, Environment, FileSystemBytecodeCache,
+                    FileSystemLoader, ModuleLoader, PackageLoader)
+import hashlib
+import html
+import importlib
+import json
 import os
+import tempfile
+import time
+from .attachments import AttachmentStore
+from .log_entry import LogEntry
+from .session import Session
+from .session_store import JournalStore
+from .session_timer import format_duration
+
+# Compiled templates shared by every generator in the process, keyed by
+# package, template name and the template file's mtime
+_template_cache = {}
 
 
 class SessionReportGenerator:
 
     TEMPLATES_DIR = 'templates'
     TEMPLATE = 'report-template.html'
+    # Templates precompiled into Python modules by precompile_templates()
+    COMPILED_DIR = 'compiled'
+    SOURCES_FILE = 'sources.sha1'
+    # Directory for Jinja's on-disk bytecode cache, off unless set
+    BYTECODE_CACHE_ENV = 'TESTRECORDER_BYTECODE_CACHE'
+    # Size of the write buffer the rendered report is streamed through
+    BUFFER_SIZE = 64 * 1024
+    # mkstemp creates owner-only files, reports are meant to be shared
+    REPORT_MODE = 0o644
+    # report_tail() output starts with this, see update_report()
+    LOG_END_MARKER = '<!-- end of log -->'
+    # The bug rows in it are between these, see bug_rows()
+    BUGS_MARKER = b'<!-- bugs -->\n'
+    BUGS_END_MARKER = b'<!-- end of bugs -->'
+    # Session reports end with a line holding what they were rendered from
+    STATE_PREFIX = b'\n<!-- report-state '
+    STATE_SUFFIX = b' -->\n'
+    # Session fields shown in the report header
+    HEADER_KEYS = (Session.MISSION_KEY, Session.AREAS_KEY,
+                   Session.TIMEBOX_KEY, Session.DURATION_KEY,
+                   Session.DEBRIEF_KEY)
+    # watch() polls the session file this often, and updates the report once
+    # the file has been quiet for DEBOUNCE_SECONDS or changing for
+    # MAX_DELAY_SECONDS
+    POLL_SECONDS = 0.5
+    DEBOUNCE_SECONDS = 1.0
+    MAX_DELAY_SECONDS = 5.0
+    # Width screenshots are shown at in the log
+    SCREENSHOT_WIDTH = 240
 
     def __init__(self, reports_dir, package):
         self.reports_dir = reports_dir
         if not os.path.exists(reports_dir):
             os.makedirs(reports_dir)
-        env = Environment(loader=PackageLoader(package, self.TEMPLATES_DIR))
-        self.template = env.get_template(self.TEMPLATE)
+        self.template = self.load_template(package, self.TEMPLATE)
+        try:
+            self.template_hash = self.source_hash(os.path.join(
+                    self.templates_path(package), self.TEMPLATE))
+        except OSError:
+            self.template_hash = None
+
+    @classmethod
+    def templates_path(cls, package):
+        return os.path.join(os.path.dirname(
+            importlib.import_module(package).__file__), cls.TEMPLATES_DIR)
+
+    @classmethod
+    def load_template(cls, package, template_name):
+        """Return the compiled template, parsing it only when it is not
+        cached in this process or the template file has changed"""
+        templates_path = cls.templates_path(package)
+        try:
+            mtime = os.stat(os.path.join(templates_path,
+                                         template_name)).st_mtime_ns
+        except OSError:
+            mtime = None
+        key = (package, template_name, mtime)
+        template = _template_cache.get(key)
+        if template is None:
+            template = cls.create_environment(
+                    package, templates_path, template_name).get_template(
+                            template_name)
+            _template_cache[key] = template
+        return template
+
+    @classmethod
+    def create_environment(cls, package, templates_path, template_name):
+        loader = PackageLoader(package, cls.TEMPLATES_DIR)
+        compiled_path = os.path.join(templates_path, cls.COMPILED_DIR)
+        # Precompiled modules are only used while they match the template
+        # source they were compiled from
+        if cls.is_compiled(templates_path, compiled_path, template_name):
+            loader = ChoiceLoader([ModuleLoader(compiled_path), loader])
+        bytecode_cache = None
+        if os.environ.get(cls.BYTECODE_CACHE_ENV):
+            cache_dir = os.environ[cls.BYTECODE_CACHE_ENV]
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            bytecode_cache = FileSystemBytecodeCache(cache_dir)
+        return Environment(loader=loader, bytecode_cache=bytecode_cache)
+
+    @classmethod
+    def is_compiled(cls, templates_path, compiled_path, template_name):
+        try:
+            with open(os.path.join(compiled_path, cls.SOURCES_FILE)) as f:
+                sources = dict(line.split() for line in f if line.strip())
+            return sources.get(template_name) == cls.source_hash(
+                    os.path.join(templates_path, template_name))
+        except (OSError, ValueError):
+            return False
+
+    @staticmethod
+    def source_hash(path):
+        with open(path, 'rb') as source:
+            return hashlib.sha1(source.read()).hexdigest()
+
+    @classmethod
+    def precompile_templates(cls, templates_path, target_path=None):
+        """Compile the HTML templates in templates_path to Python modules,
+        by default into the directory load_template() looks in"""
+        if target_path is None:
+            target_path = os.path.join(templates_path, cls.COMPILED_DIR)
+        env = Environment(loader=FileSystemLoader(templates_path))
+        names = env.list_templates(filter_func=lambda name: name.endswith(
+                                   '.html'))
+        env.compile_templates(target_path, zip=None, ignore_errors=False,
+                              filter_func=lambda name: name in names)
+        with open(os.path.join(target_path, cls.SOURCES_FILE), 'w') as f:
+            for name in names:
+                f.write(name + ' ' + cls.source_hash(
+                        os.path.join(templates_path, name)) + '\n')
+        return target_path
+
+    def report_path(self, report_name):
+        if os.sep in report_name:
+            return None
+        return os.path.join(self.reports_dir, report_name + '.html')
 
     def generate_report(self, session_name='', filename=None, **report_params):
+        """Render the report into reports_dir"""
+        report_path = self.report_path(filename if filename else session_name)
+        if report_path is None:
+            return False
+        return self.render(report_path, None, session_name=session_name,
+                           **report_params)
+
+    def render(self, report_path, state, **report_params):
+        """Render the template to report_path, followed by state when given.
+
+        The template is rendered in chunks, so the log and bug entries can be
+        passed as generators and the report is never held in memory in full.
+        It is written to a temporary file that replaces the report only once
+        rendering succeeded."""
+        tmp_path = None
         try:
-            if filename:
-                html_report = open(os.path.join(
-                                   self.reports_dir, filename + '.html'),
-                                   'w+')
-            else:
-                html_report = open(os.path.join(
-                                   self.reports_dir, session_name + '.html'),
-                                   'w+')
-            html_report.write((self.template.render(
-                session_name=session_name, **report_params)))
-        except:
+            tmp_fd, tmp_path = tempfile.mkstemp(
+                    dir=self.reports_dir, prefix='.report-', suffix='.tmp')
+            with open(tmp_fd, 'wb', buffering=self.BUFFER_SIZE) as html_report:
+                position = 0
+                log_end = tail_end = None
+                for chunk in self.template.generate(**report_params):
+                    chunk = chunk.encode('utf-8')
+                    # Log rows are chunks of their own, so only the tail
+                    # can start with the marker
+                    if log_end is None and chunk.startswith(
+                            self.LOG_END_MARKER.encode()):
+                        log_end = position
+                        tail_end = position + len(chunk)
+                        bugs = self.bug_rows(chunk)
+                        if bugs is not None:
+                            bugs = [position + offset for offset in bugs]
+                    html_report.write(chunk)
+                    position += len(chunk)
+                if state is not None:
+                    state['log_end'] = log_end
+                    state['tail_end'] = tail_end
+                    state['bugs'] = bugs
+                    html_report.write(self.state_line(state))
+            os.chmod(tmp_path, self.REPORT_MODE)
+            os.replace(tmp_path, report_path)
+        except Exception:
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
             return False
         else:
-            html_report.close()
             return True
+
+    def generate_session_report(self, session_name, session_dir,
+                                filename=None):
+        """Report on a recorded session, streaming its log from disk.
+
+        A report rendered before is brought up to date by appending the
+        entries recorded since, and left alone if nothing changed. It is only
+        rendered again in full when its header, the template or entries
+        already reported changed."""
+        report_path = self.report_path(filename if filename else session_name)
+        if report_path is None:
+            return False
+        try:
+            if self.update_report(report_path, session_name, session_dir):
+                return True
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return self.render_session_report(report_path, session_name,
+                                          session_dir)
+
+    def render_session_report(self, report_path, session_name, session_dir):
+        journal_path = os.path.join(session_dir, session_name)
+        state = end = None
+        try:
+            if JournalStore.is_journal(journal_path):
+                # Everything is read up to the same offset, which is where
+                # update_report() goes on from
+                with open(journal_path, 'rb') as journal:
+                    end = JournalStore.complete_size(journal)
+                    state = {'ino': os.fstat(journal.fileno()).st_ino,
+                             'offset': end}
+            session_data = Session.get_session_header(session_name,
+                                                      session_dir, end)
+        except (OSError, ValueError, KeyError):
+            return False
+        bugs = self.iter_entries(session_name, session_dir, True, end, state)
+        if state is not None:
+            state['header'] = self.header_hash(session_name, session_data)
+        for key in (Session.TIMEBOX_KEY, Session.DURATION_KEY):
+            session_data[key] = format_duration(session_data[key])
+        session_data[Session.BUG_KEY] = bugs
+        session_data[Session.LOG_KEY] = self.iter_entries(
+                session_name, session_dir, False, end, state)
+        return self.render(report_path, state, session_name=session_name,
+                           **session_data)
+
+    def update_report(self, report_path, session_name, session_dir):
+        """Append the entries recorded since the report was rendered. Returns
+        False when the report has to be rendered again instead.
+
+        The updated report is written to a temporary file that replaces it,
+        as in render(), copying what precedes the new entries and the bugs
+        already reported unchanged."""
+        if not os.path.exists(report_path):
+            return False
+        with open(report_path, 'rb') as report:
+            state, state_start = self.read_state(report)
+            if state is None or state.get('template') != self.template_hash:
+                return False
+            with open(os.path.join(session_dir, session_name),
+                      'rb') as journal:
+                if os.fstat(journal.fileno()).st_ino != state['ino']:
+                    # Compacted or replaced since
+                    return False
+                end = JournalStore.complete_size(journal)
+                if end == state['offset']:
+                    return True
+                if end < state['offset']:
+                    return False
+                attachments = AttachmentStore.beside(session_dir)
+                log = []
+                bugs = []
+                header_changed = False
+                for record in JournalStore.read_range(journal,
+                                                      state['offset'], end):
+                    op = record['op']
+                    key = record.get('key')
+                    if op == JournalStore.APPEND and key == Session.LOG_KEY:
+                        entry = LogEntry.from_value(record['value'])
+                        last = [Session.LOG_ORDER(entry), record['id']]
+                        if state.get('last') and last < state['last']:
+                            # Belongs before entries already reported
+                            return False
+                        state['last'] = last
+                        (bugs if entry.bug else log).append(
+                                self.entry_row(entry, attachments))
+                    elif op == JournalStore.SET and key in self.HEADER_KEYS:
+                        header_changed = True
+                    elif op in (JournalStore.SNAPSHOT,
+                                JournalStore.CHUNK) or (
+                            op in (JournalStore.POP, JournalStore.REPLACE) and
+                            key == Session.LOG_KEY):
+                        return False
+            if header_changed and state['header'] != self.header_hash(
+                    session_name, Session.get_session_header(
+                        session_name, session_dir, end)):
+                return False
+            # What follows the bugs only depends on the header
+            report.seek(state['tail_end'])
+            rest = report.read(state_start - state['tail_end'])
+            module = self.template.module
+            tmp_path = None
+            try:
+                tmp_fd, tmp_path = tempfile.mkstemp(
+                        dir=self.reports_dir, prefix='.report-', suffix='.tmp')
+                with open(tmp_fd, 'wb',
+                          buffering=self.BUFFER_SIZE) as html_report:
+                    self.copy(report, 0, state['log_end'], html_report)
+                    for row in log:
+                        html_report.write(
+                                str(module.log_row(row)).encode('utf-8'))
+                    state['offset'] = end
+                    state['log_end'] = html_report.tell()
+                    reported = state['bugs']
+                    tail = str(module.report_tail(
+                            bugs, bool(reported))).encode('utf-8')
+                    rows = self.bug_rows(tail)
+                    if rows is None:
+                        html_report.write(tail)
+                    else:
+                        # The bugs reported before go ahead of the new ones
+                        html_report.write(tail[:rows[0]])
+                        start = html_report.tell()
+                        if reported:
+                            self.copy(report, reported[0],
+                                      reported[1] - reported[0], html_report)
+                        state['bugs'] = [start, html_report.tell() +
+                                         rows[1] - rows[0]]
+                        html_report.write(tail[rows[0]:])
+                    state['tail_end'] = html_report.tell()
+                    html_report.write(rest)
+                    html_report.write(self.state_line(state))
+                os.chmod(tmp_path, self.REPORT_MODE)
+                os.replace(tmp_path, report_path)
+            except BaseException:
+                if tmp_path and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        return True
+
+    def header_hash(self, session_name, header):
+        fields = [session_name] + [header[key] for key in self.HEADER_KEYS]
+        return hashlib.sha1(json.dumps(fields).encode()).hexdigest()
+
+    def state_line(self, state):
+        state['template'] = self.template_hash
+        # -- may not appear inside an HTML comment
+        text = json.dumps(state, separators=(',', ':')).replace(
+                '--', '-\\u002d')
+        return self.STATE_PREFIX + text.encode() + self.STATE_SUFFIX
+
+    @classmethod
+    def read_state(cls, report):
+        """The state a session report was rendered from and the offset of
+        the line holding it, or (None, None)"""
+        size = report.seek(0, os.SEEK_END)
+        block = 4096
+        while True:
+            start = max(0, size - block)
+            report.seek(start)
+            tail = report.read(size - start)
+            index = tail.rfind(cls.STATE_PREFIX)
+            if index >= 0:
+                break
+            if start == 0:
+                return None, None
+            block *= 4
+        line = tail[index + len(cls.STATE_PREFIX):]
+        if not line.endswith(cls.STATE_SUFFIX):
+            return None, None
+        state = json.loads(line[:-len(cls.STATE_SUFFIX)])
+        if not isinstance(state, dict):
+            return None, None
+        return state, start + index
+
+    @classmethod
+    def bug_rows(cls, tail):
+        """The start and end offsets of the bug rows in the rendered
+        report_tail(), None if it shows no bugs"""
+        start = tail.find(cls.BUGS_MARKER)
+        if start < 0:
+            return None
+        # Rows may hold the markers' text, the template's come first and last
+        return start + len(cls.BUGS_MARKER), tail.rfind(cls.BUGS_END_MARKER)
+
+    def copy(self, source, start, size, target):
+        """Copy size bytes from start of an open file to another"""
+        source.seek(start)
+        while size:
+            chunk = source.read(min(size, self.BUFFER_SIZE))
+            if not chunk:
+                raise ValueError('Report is truncated')
+            target.write(chunk)
+            size -= len(chunk)
+
+    def entry_row(self, entry, attachments=None):
+        if entry.screenshot and attachments is not None:
+            return entry.date + ' ' + self.screenshot_html(attachments,
+                                                           entry.text)
+        return entry.date + ' ' + entry.text
+
+    def screenshot_html(self, attachments, digest):
+        """A thumbnail linking to the full screenshot, by paths relative to
+        the report"""
+        image = attachments.path(digest)
+        thumbnail = attachments.thumbnail_path(digest)
+        if not os.path.exists(thumbnail):
+            thumbnail = image
+        return ('<a href="{}"><img src="{}" width="{}" loading="lazy">'
+                '</a>').format(self.relative_url(image),
+                               self.relative_url(thumbnail),
+                               self.SCREENSHOT_WIDTH)
+
+    def relative_url(self, path):
+        url = os.path.relpath(path, self.reports_dir).replace(os.sep, '/')
+        return html.escape(url)
+
+    def iter_entries(self, session_name, session_dir, bugs, end=None,
+                     state=None):
+        """Rows of the bugs or the other entries of a session. The sort key
+        of the last entry is kept in state, see update_report()."""
+        attachments = AttachmentStore.beside(session_dir)
+        for item_id, entry in Session.iter_log(session_name, session_dir,
+                                               with_ids=True, end=end):
+            if entry.bug == bugs:
+                if state is not None:
+                    state['last'] = max(state.get('last') or [],
+                                        [Session.LOG_ORDER(entry), item_id])
+                yield self.entry_row(entry, attachments)
+
+    @staticmethod
+    def file_signature(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def watch(self, session_name, session_dir, filename=None, on_update=None,
+              should_stop=None):
+        """Keep the report of a session up to date while it is recorded,
+        until should_stop() returns True. on_update is called with the result
+        of every update."""
+        path = os.path.join(session_dir, session_name)
+        seen = self.file_signature(path)
+        result = self.generate_session_report(session_name, session_dir,
+                                              filename)
+        if on_update:
+            on_update(result)
+        changed_since = quiet_since = None
+        while not (should_stop and should_stop()):
+            time.sleep(self.POLL_SECONDS)
+            signature = self.file_signature(path)
+            now = time.monotonic()
+            if signature != seen:
+                seen = signature
+                quiet_since = now
+                if changed_since is None:
+                    changed_since = now
+            if changed_since is not None and (
+                    now - quiet_since >= self.DEBOUNCE_SECONDS or
+                    now - changed_since >= self.MAX_DELAY_SECONDS):
+                changed_since = None
+                result = self.generate_session_report(
+                        session_name, session_dir, filename)
+                if on_update:
+                    on_update(result)
@@ -0,0 +1,250 @@
+import os
+import sqlite3
+import threading
+from .log_entry import LogEntry
+from .session import Session
+from .session_catalog import SessionCatalog
+from .session_store import JournalStore
+
+
+class SearchIndex:
+    """Full-text index over the sessions in a session directory.
+
+    Log entries, bugs, missions, test areas and debriefs are indexed with
+    SQLite FTS5. An open session is indexed as it records through its store
+    listeners, which run on the store's writer thread, so the connection is
+    shared between threads under a lock. Sessions changed any other way are
+    re-indexed when a search finds their file mtime differs from the one
+    they were indexed at.
+    """
+
+    FILENAME = '.search.sqlite'
+    SCHEMA_VERSION = 1
+    # Live updates are committed after this many records
+    COMMIT_RECORDS = 100
+    # Index fields
+    LOG_FIELD = 'log'
+    BUG_FIELD = 'bug'
+    FIELDS = {Session.MISSION_KEY: 'mission', Session.AREAS_KEY: 'areas',
+              Session.DEBRIEF_KEY: 'debrief'}
+
+    def __init__(self, session_dir):
+        self.session_dir = session_dir
+        if not os.path.exists(session_dir):
+            os.makedirs(session_dir)
+        self.path = os.path.join(session_dir, self.FILENAME)
+        self.lock = threading.RLock()
+        try:
+            self.db = self.connect()
+        except sqlite3.DatabaseError:
+            # The index is rebuilt from the sessions, so start over
+            os.remove(self.path)
+            self.db = self.connect()
+        self.uncommitted = 0
+        # Sessions written through a watched store since the last commit
+        self.dirty = set()
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=10,
+                             check_same_thread=False)
+        # See SessionCatalog.connect
+        db.execute('PRAGMA journal_mode=MEMORY')
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+        if version != self.SCHEMA_VERSION:
+            with db:
+                for table in ('entries_fts', 'entries', 'areas', 'indexed'):
+                    db.execute('DROP TABLE IF EXISTS ' + table)
+                self.create_tables(db)
+                db.execute('PRAGMA user_version = {}'.format(
+                    self.SCHEMA_VERSION))
+        return db
+
+    def create_tables(self, db):
+        db.execute('CREATE TABLE entries (id INTEGER PRIMARY KEY, '
+                   'session TEXT, field TEXT, epoch INTEGER, '
+                   'entry_id INTEGER, text TEXT)')
+        db.execute('CREATE INDEX entries_session ON entries '
+                   '(session, field, entry_id)')
+        # External content table, the text is only stored once in entries
+        db.execute("CREATE VIRTUAL TABLE entries_fts USING fts5(text, "
+                   "content='entries', content_rowid='id')")
+        db.execute('CREATE TRIGGER entries_insert AFTER INSERT ON entries '
+                   'BEGIN INSERT INTO entries_fts(rowid, text) '
+                   'VALUES (new.id, new.text); END')
+        db.execute("CREATE TRIGGER entries_delete AFTER DELETE ON entries "
+                   "BEGIN INSERT INTO entries_fts(entries_fts, rowid, text) "
+                   "VALUES ('delete', old.id, old.text); END")
+        db.execute('CREATE TABLE areas (area TEXT, session TEXT, '
+                   'PRIMARY KEY (area, session)) WITHOUT ROWID')
+        db.execute('CREATE TABLE indexed (session TEXT PRIMARY KEY, '
+                   'mtime REAL) WITHOUT ROWID')
+
+    def watch(self, session):
+        """Index everything session records from now on"""
+        with self.lock:
+            session_name = session.session_name
+            if not self.is_indexed(session_name):
+                self.index_session(session_name)
+            session.store.listeners.append(
+                    lambda record: self.on_record(session_name, record))
+
+    def is_indexed(self, session_name):
+        return self.db.execute('SELECT 1 FROM indexed WHERE session = ?',
+                               (session_name,)).fetchone() is not None
+
+    def on_record(self, session_name, record):
+        with self.lock:
+            op = record['op']
+            key = record.get('key')
+            if op == JournalStore.APPEND and key == Session.LOG_KEY:
+                self.add_entry(session_name, record['id'],
+                               LogEntry.from_value(record['value']))
+            elif (op in (JournalStore.POP, JournalStore.REPLACE) and
+                    key == Session.LOG_KEY):
+                self.db.execute('DELETE FROM entries WHERE session = ? AND '
+                                'field IN (?, ?) AND entry_id = ?',
+                                (session_name, self.LOG_FIELD,
+                                 self.BUG_FIELD, record['id']))
+                if op == JournalStore.REPLACE:
+                    self.add_entry(session_name, record['id'],
+                                   LogEntry.from_value(record['value']))
+            elif op == JournalStore.SET and key in self.FIELDS:
+                self.set_field(session_name, key, record['value'])
+            else:
+                return
+            self.dirty.add(session_name)
+            self.uncommitted += 1
+            if self.uncommitted >= self.COMMIT_RECORDS:
+                self.commit()
+
+    def add_entry(self, session_name, entry_id, entry):
+        self.db.execute('INSERT INTO entries (session, field, epoch, '
+                        'entry_id, text) VALUES (?, ?, ?, ?, ?)',
+                        (session_name,
+                         self.BUG_FIELD if entry.bug else self.LOG_FIELD,
+                         entry.epoch, entry_id, entry.text))
+
+    def set_field(self, session_name, key, value):
+        field = self.FIELDS[key]
+        self.db.execute('DELETE FROM entries WHERE session = ? AND field = ?',
+                        (session_name, field))
+        if key == Session.AREAS_KEY:
+            self.db.execute('DELETE FROM areas WHERE session = ?',
+                            (session_name,))
+            self.db.executemany('INSERT OR IGNORE INTO areas VALUES (?, ?)',
+                                [(area.lower(), session_name)
+                                 for area in value])
+            value = ', '.join(value)
+        if value:
+            self.db.execute('INSERT INTO entries (session, field, text) '
+                            'VALUES (?, ?, ?)', (session_name, field, value))
+
+    def commit(self):
+        """Commit live updates and mark their sessions as indexed up to
+        their current mtime"""
+        with self.lock:
+            for session_name in self.dirty:
+                self.mark_indexed(session_name)
+            self.db.commit()
+            self.dirty.clear()
+            self.uncommitted = 0
+
+    def mark_indexed(self, session_name):
+        try:
+            mtime = os.path.getmtime(os.path.join(self.session_dir,
+                                                  session_name))
+        except OSError:
+            return
+        self.db.execute('INSERT OR REPLACE INTO indexed VALUES (?, ?)',
+                        (session_name, mtime))
+
+    def index_session(self, session_name):
+        """(Re)index a whole session from its file"""
+        self.remove(session_name, commit=False)
+        header = Session.get_session_header(session_name, self.session_dir)
+        for key in self.FIELDS:
+            if header[key]:
+                self.set_field(session_name, key, header[key])
+        self.db.executemany(
+                'INSERT INTO entries (session, field, epoch, entry_id, text) '
+                'VALUES (?, ?, ?, ?, ?)',
+                ((session_name,
+                  self.BUG_FIELD if entry.bug else self.LOG_FIELD,
+                  entry.epoch, entry_id, entry.text)
+                 for entry_id, entry in Session.iter_log(
+                     session_name, self.session_dir, with_ids=True)))
+        self.mark_indexed(session_name)
+
+    def remove(self, session_name, commit=True):
+        with self.lock:
+            for table in ('entries', 'areas', 'indexed'):
+                self.db.execute(
+                        'DELETE FROM {} WHERE session = ?'.format(table),
+                        (session_name,))
+            if commit:
+                self.db.commit()
+
+    def refresh(self):
+        """Bring the index up to date with the session directory, only
+        re-indexing sessions whose mtime changed"""
+        with self.lock:
+            self.commit()
+            indexed = dict(self.db.execute(
+                    'SELECT session, mtime FROM indexed'))
+            for entry in os.scandir(self.session_dir):
+                if not SessionCatalog.is_session_file(entry.name):
+                    continue
+                if indexed.pop(entry.name, None) != entry.stat().st_mtime:
+                    try:
+                        self.index_session(entry.name)
+                    except (OSError, ValueError, KeyError):
+                        continue
+            for session_name in indexed:
+                self.remove(session_name, commit=False)
+            self.db.commit()
+
+    @staticmethod
+    def match_query(query):
+        # Quote every term so user input is never parsed as FTS syntax,
+        # a trailing * keeps its meaning as a prefix search
+        terms = []
+        for term in query.split():
+            prefix = term.endswith('*')
+            term = '"' + term.rstrip('*').replace('"', '""') + '"'
+            terms.append(term + '*' if prefix else term)
+        return ' '.join(terms)
+
+    def search(self, query, bugs_only=False, since=None, until=None,
+               area=None, limit=50):
+        """Return (session, field, epoch, text) rows matching every term of
+        query, best matches first. since and until are epoch seconds and
+        only match log entries and bugs."""
+        self.refresh()
+        sql = ('SELECT e.session, e.field, e.epoch, e.text FROM entries_fts '
+               'JOIN entries e ON e.id = entries_fts.rowid '
+               'WHERE entries_fts MATCH ?')
+        params = [self.match_query(query)]
+        if bugs_only:
+            sql += ' AND e.field = ?'
+            params.append(self.BUG_FIELD)
+        if since is not None:
+            sql += ' AND e.epoch >= ?'
+            params.append(since)
+        if until is not None:
+            sql += ' AND e.epoch < ?'
+            params.append(until)
+        if area:
+            sql += ' AND e.session IN (SELECT session FROM areas ' \
+                   'WHERE area = ?)'
+            params.append(area.lower())
+        sql += ' ORDER BY entries_fts.rank LIMIT ?'
+        params.append(limit)
+        if not params[0]:
+            return []
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.db.close()
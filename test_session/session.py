@@ -1,7 +1,12 @@
-import shelve
+import collections
+import itertools
 import os
+import re
+import time
 import datetime
-from .session_timer import DurationTimer
+from .log_entry import EntryKind, LogEntry
+from .session_store import JournalStore
+from .session_timer import DurationTimer, as_seconds, format_duration
 
 
 class Session:
@@ -11,17 +16,24 @@ class Session:
                 'mission': 'mission [statement] '
                 '\n        Set the Test Mission',
                 'timebox': 'timebox [time_value] '
-                '\n        Set the Test Timebox',
+                '\n        Set the Test Timebox, eg. 90m, 1h30 or 01:30:00',
                 'pause': 'pause \n        '
                 'Pause the current session. Session resumes upon next entry',
+                'idle': 'idle [time_value|off] \n        '
+                'Pause the session when there is no entry for time_value',
                 'duration': 'duration \n        '
                 'Show the current session duration',
                 'undo': 'undo \n        '
-                'Undo the last test session entry',
+                'Undo the last entry, edit or change of mission, timebox, '
+                'areas or idle time',
+                'redo': 'redo \n        '
+                'Redo the last change undone',
+                'edit': 'edit [N] [text] \n        '
+                'Replace the text of entry N, as numbered by show',
                 'areas': 'areas [area1, area2] '
                 '\n        Set the list of Test Areas',
                 'screenshot': 'screenshot \n        '
-                'Take a screenshot of the current display [NOT IMPLEMENTED]',
+                'Take a screenshot of the current display',
                 'help': 'help [command] '
                 '\n        Display command and description'}
     CMD_KEY = 'cmd'
@@ -31,11 +43,14 @@ class Session:
     MISSION_CMD = 'mission'
     TIMEBOX_CMD = 'timebox'
     UNDO_CMD = 'undo'
+    REDO_CMD = 'redo'
+    EDIT_CMD = 'edit'
     AREAS_CMD = 'areas'
     SCREENSHOT_CMD = 'screenshot'
     SESSION_QUIT = '!SESSION_QUIT!'
     HELP_CMD = 'help'
     PAUSE_CMD = 'pause'
+    IDLE_CMD = 'idle'
     DURATION_CMD = 'duration'
     PASS_THROUGH = 'passthrough '
     # File Keys
@@ -48,131 +63,511 @@ class Session:
     DURATION_KEY = 'session_duration'
     AREAS_KEY = 'test_areas'
     DEBRIEF_KEY = 'session_debrief'
+    # [event, epoch, duration seconds] for every pause and resume
+    PAUSES_KEY = 'session_pauses'
+    IDLE_KEY = 'idle_timeout'
+    PAUSE_EVENT = 'pause'
+    RESUME_EVENT = 'resume'
     SESSION_PROMPT = 'SESSION >> '
+    # Leading timestamp kept when ingesting, eg. '[2020-01-31 09:15:00]' or
+    # '2020-01-31T09:15:00.123' from a tool's log
+    INGEST_TIMESTAMP = re.compile(
+            r'\[?(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})(?:[.,]\d+)?\]?\s*')
+    # Lines committed to the session file in one write when ingesting
+    INGEST_BATCH_SIZE = 10000
+    # Journal records after which closing packs the session file
+    COMPACT_RECORDS = 1000
+    # Changes that can be undone, oldest are forgotten first
+    HISTORY_LIMIT = 1000
+    # Undo history items: (ADDED, key, id, value) for a new entry,
+    # (CHANGED, key, previous, value) for a field and
+    # (EDITED, key, id, index, previous, value) for an edited entry
+    ADDED = 'added'
+    CHANGED = 'changed'
+    EDITED = 'edited'
+    # Fields whose changes can be undone, by the name undo reports
+    FIELD_NAMES = {MISSION_KEY: 'Test mission', TIMEBOX_KEY: 'Test time box',
+                   AREAS_KEY: 'Test areas', IDLE_KEY: 'Idle time'}
+    # Timebox and duration are kept in seconds, older sessions saved the
+    # timebox text and a timedelta
+    DECODERS = {LOG_KEY: LogEntry.from_value, TIMEBOX_KEY: as_seconds,
+                DURATION_KEY: as_seconds}
+    # Entries are shown in timestamp order, whichever writer added them
+    LOG_ORDER = LogEntry.epoch_of
+    ORDERS = {LOG_KEY: LOG_ORDER}
 
     def __init__(self, session_name, session_dir):
+        self.session_name = session_name
         self.session_dir = session_dir
-        self.session_file = shelve.open(os.path.join(
-            session_dir, session_name), writeback=True)
+        self.store = JournalStore(
+                os.path.join(session_dir, session_name),
+                self.new_session_data(), legacy_key=self.SESSION_KEY,
+                decoders=self.DECODERS, orders=self.ORDERS)
+        self.timebox_warned = False
+        # An existing session resumes from its saved duration, or from the
+        # duration at its last pause or resume if it was never quit
+        seconds = self.store.data[self.DURATION_KEY] or 0
         self.paused = False
-        self.pause_intervals = []
-        # See if this is an existing session, if not initialize a skeleton
-        try:
-            self.duration = self.session_file[
-                    self.SESSION_KEY][self.DURATION_KEY]
-        except KeyError:
-            self.session_file[self.SESSION_KEY] = {
-                    self.LOG_KEY: [], self.TIMEBOX_KEY: None,
-                    self.MISSION_KEY: None, self.DURATION_KEY: None,
-                    self.AREAS_KEY: [], self.DEBRIEF_KEY: None}
-            self.duration = datetime.timedelta(seconds=0)
-        self.timer = DurationTimer(self.duration)
+        pauses = self.store.data[self.PAUSES_KEY]
+        if pauses:
+            event, _, event_seconds = pauses[-1]
+            seconds = max(seconds, event_seconds)
+            self.paused = event == self.PAUSE_EVENT
+        self.duration = datetime.timedelta(seconds=seconds)
+        self.timer = DurationTimer(self.duration, paused=self.paused)
+        self._attachments = None
+        # Changes made since the session was opened, see undo_entry()
+        self.undo_history = collections.deque(maxlen=self.HISTORY_LIMIT)
+        self.redo_history = []
+
+    @classmethod
+    def new_session_data(cls):
+        return {cls.LOG_KEY: [], cls.TIMEBOX_KEY: None,
+                cls.MISSION_KEY: None, cls.DURATION_KEY: None,
+                cls.AREAS_KEY: [], cls.DEBRIEF_KEY: None,
+                cls.PAUSES_KEY: [], cls.IDLE_KEY: None}
 
     @staticmethod
     def get_session_data(session_name, session_dir):
-        read_file = shelve.open(os.path.join(session_dir, session_name))
-        session_data = read_file[Session.SESSION_KEY]
-        read_file.close()
-        return session_data
+        """Read a session without blocking the sessions writing to it. The
+        entries of every writer are merged in timestamp order."""
+        return JournalStore.load(
+                os.path.join(session_dir, session_name),
+                Session.new_session_data(), legacy_key=Session.SESSION_KEY,
+                decoders=Session.DECODERS, orders=Session.ORDERS)
+
+    @staticmethod
+    def get_session_header(session_name, session_dir, end=None):
+        """Session data without the log, see iter_log(). end limits the
+        read to the first end bytes of the session file. The header of an
+        archived session is read without unpacking its log."""
+        path = os.path.join(session_dir, session_name)
+        summary = JournalStore.read_summary(path)
+        if summary is not None:
+            session_data = Session.new_session_data()
+            for key, value in summary['header'].items():
+                decoder = Session.DECODERS.get(key)
+                session_data[key] = decoder(value) if decoder else value
+            return session_data
+        return JournalStore.load(path, Session.new_session_data(),
+                                 legacy_key=Session.SESSION_KEY,
+                                 skip_keys=(Session.LOG_KEY,),
+                                 decoders=Session.DECODERS, end=end)
+
+    @staticmethod
+    def summarize(session_data):
+        """The header fields of a session with its bug and entry counts"""
+        log = session_data[Session.LOG_KEY]
+        return {'header': {key: value for key, value in session_data.items()
+                           if key != Session.LOG_KEY},
+                'bug_count': sum(1 for entry in log if entry.bug),
+                'entry_count': len(log)}
+
+    @staticmethod
+    def get_session_summary(session_name, session_dir):
+        """summarize() of a session, read from the head of an archive"""
+        summary = JournalStore.read_summary(
+                os.path.join(session_dir, session_name))
+        if summary is None:
+            return Session.summarize(Session.get_session_data(session_name,
+                                                              session_dir))
+        summary['archived'] = True
+        return summary
+
+    @staticmethod
+    def archive(session_name, session_dir):
+        """Pack a finished session into a compressed archive. It reads as
+        before and is unpacked when opened for recording again."""
+        return JournalStore.archive(
+                os.path.join(session_dir, session_name),
+                Session.new_session_data(), Session.summarize,
+                legacy_key=Session.SESSION_KEY, decoders=Session.DECODERS,
+                orders=Session.ORDERS)
+
+    @staticmethod
+    def provision(session_dir, charters):
+        """Create a session for every charter, a dict of its 'name',
+        'mission', 'areas' and 'timebox', writing them all at once. Sessions
+        that exist are left alone. Returns the (name, session_data) of the
+        sessions created."""
+        sessions = []
+        for charter in charters:
+            session_data = Session.new_session_data()
+            mission = charter.get('mission')
+            # Stored as the mission command stores it, after a space
+            session_data[Session.MISSION_KEY] = (' ' + mission if mission
+                                                 else None)
+            session_data[Session.AREAS_KEY] = list(charter.get('areas', []))
+            session_data[Session.TIMEBOX_KEY] = charter.get('timebox')
+            sessions.append((charter['name'], session_data))
+        created = set(JournalStore.create_many(
+                (os.path.join(session_dir, session_name), session_data)
+                for session_name, session_data in sessions))
+        return [(session_name, session_data)
+                for session_name, session_data in sessions
+                if os.path.join(session_dir, session_name) in created]
+
+    @staticmethod
+    def iter_log(session_name, session_dir, with_ids=False, end=None):
+        """Stream the log in timestamp order, the entries of every writer
+        merged"""
+        return JournalStore.iter_values(
+                os.path.join(session_dir, session_name), Session.LOG_KEY,
+                legacy_key=Session.SESSION_KEY, decoder=LogEntry.from_value,
+                with_ids=with_ids, end=end, order=Session.LOG_ORDER)
+
+    def log_indexes(self):
+        """Indexes into the loaded log in the order iter_log() streams it,
+        which is how show, open and edit number the entries"""
+        return self.store.ordered_indexes(self.LOG_KEY, self.LOG_ORDER)
 
     def get_duration(self):
+        seconds = self.store.data[self.DURATION_KEY]
+        if seconds is None:
+            self.duration = None
+        else:
+            self.duration = datetime.timedelta(seconds=seconds)
+        return self.duration
+
+    def check_timebox(self):
+        """Warning text the first time the session runs over its timebox,
+        None otherwise"""
+        timebox = self.store.data[self.TIMEBOX_KEY]
+        if self.timebox_warned or not isinstance(timebox, int):
+            return None
+        overrun = self.timer.get_duration().total_seconds() - timebox
+        if overrun <= 0:
+            return None
+        self.timebox_warned = True
+        return 'Timebox of {} exceeded by {}'.format(
+                format_duration(timebox), format_duration(overrun))
+
+    @property
+    def attachments(self):
+        if self._attachments is None:
+            from .attachments import AttachmentStore
+            self._attachments = AttachmentStore.beside(self.session_dir)
+        return self._attachments
+
+    def close(self):
+        """Write out and close the session, returning a message for every
+        screenshot that could not be stored, see drop_screenshots()"""
+        messages = []
+        if self._attachments is not None:
+            # Screenshots still being written
+            failed = self._attachments.close()
+            if failed:
+                messages = self.drop_screenshots(failed)
+        if self.store.record_count >= self.COMPACT_RECORDS:
+            self.store.compact()
+        self.store.close()
+        return messages
+
+    def drop_screenshots(self, failed):
+        """Turn the entries of the screenshots in failed, errors by digest,
+        into notes saying so, as their images were never stored"""
+        messages = []
+        with self.store.mutex:
+            entries = [(item_id, index, entry) for index, (item_id, entry)
+                       in enumerate(zip(self.store.ids[self.LOG_KEY],
+                                        self.store.data[self.LOG_KEY]))
+                       if entry.screenshot and entry.text in failed]
+        for item_id, index, entry in entries:
+            message = 'Screenshot could not be saved: {}'.format(
+                    failed[entry.text])
+            self.store.replace(self.LOG_KEY, item_id, LogEntry(
+                    entry.epoch, EntryKind.NOTE, ' ' + message), index)
+            messages.append('{} {}'.format(entry.date, message))
+        return messages
+
+    def ingest(self, lines):
+        """Apply session commands from an iterable of lines in bulk.
+
+        Lines starting with a timestamp keep it, others, including those
+        starting with an invalid date, are stamped with the time they are
+        read. Commands that need a prompt (quit) are skipped. Each
+        batch of lines is committed to the session file in a single write.
+        Returns the number of lines applied."""
+        lines = iter(lines)
+        applied = 0
+        while True:
+            chunk = list(itertools.islice(lines, self.INGEST_BATCH_SIZE))
+            if not chunk:
+                break
+            with self.store.batch():
+                for line in chunk:
+                    line = line.rstrip('\r\n')
+                    timestamp = self.ingest_timestamp(line)
+                    if timestamp is None:
+                        timestamp = int(time.time())
+                    else:
+                        line = line[self.INGEST_TIMESTAMP.match(line).end():]
+                    if not line.strip() or line.rstrip() == self.QUIT_CMD:
+                        continue
+                    self.process_session_cmd(timestamp, line)
+                    applied += 1
+        return applied
+
+    @classmethod
+    def ingest_timestamp(cls, line):
+        """The epoch seconds of the timestamp an ingested line starts with,
+        None if it has none or it is not a valid date, eg. 2020-02-30"""
+        match = cls.INGEST_TIMESTAMP.match(line)
+        if not match:
+            return None
         try:
-            self.duration = self.session_file[
-                    self.SESSION_KEY][self.DURATION_KEY]
-            return self.duration
-        except KeyError:
+            return int(datetime.datetime.fromisoformat(
+                '{} {}'.format(*match.groups())).timestamp())
+        except ValueError:
             return None
 
+    @classmethod
+    def register_command(cls, name, handler, help_text, takes_args=True):
+        """Add a session command.
+
+        handler is called as handler(session, timestamp, args) with the text
+        after the command word and returns a result dict like
+        process_session_cmd. Commands that take no arguments are recorded as
+        plain notes when text follows the command word."""
+        # Subclasses get their own registry rather than extending Session's
+        if 'HANDLERS' not in cls.__dict__:
+            cls.HANDLERS = dict(cls.HANDLERS)
+            cls.COMMANDS = dict(cls.COMMANDS)
+        cls.HANDLERS[name] = (handler, takes_args)
+        cls.COMMANDS[name] = help_text
+
     def process_session_cmd(self, timestamp, line_data):
-        # If session is in unpaused state,
+        # Entries are timestamped in epoch seconds, formatted dates are
+        # still accepted
+        if isinstance(timestamp, str):
+            timestamp = LogEntry.parse_date(timestamp)
+        notice = self.check_idle(timestamp)
+        # If session is in paused state,
         # immediately unpause and proceed with the command processor
         if self.paused:
             self.paused = self.timer.unpause()
+            self.record_pause(self.RESUME_EVENT, timestamp)
+        result = self.dispatch(timestamp, line_data)
+        if notice:
+            text = result[self.TEXT_KEY]
+            result[self.TEXT_KEY] = notice + ('\n' + text if text else '')
+        return result
+
+    def dispatch(self, timestamp, line_data):
+        # The first word selects the handler, anything else is a note
+        if line_data[:1].strip():
+            command = line_data.split(None, 1)[0]
+            handler = self.HANDLERS.get(command)
+            if handler is not None:
+                args = line_data[len(command):]
+                if handler[1] or not args.strip():
+                    return handler[0](self, timestamp, args)
+        return self.record_note(timestamp, line_data)
 
-        # Process session commands
-        if line_data.rstrip() == 'quit':
-            print('Would you like to record a debrief? (y/N)')
-            confirmation = input()
-            if confirmation.lower() in ['y', 'yes']:
-                print('Debrief:', end=' ')
-                debrief = input()
-                self.session_file[self.SESSION_KEY][self.DEBRIEF_KEY] = debrief
-            self.session_file[self.SESSION_KEY][
-                    self.DURATION_KEY] = self.timer.get_duration()
-            return {
-                    self.CMD_KEY: self.PASS_THROUGH + self.SESSION_QUIT,
-                    self.TEXT_KEY: ''}
-        elif line_data.startswith(self.BUG_CMD):
-            line_data = line_data[len(self.BUG_CMD):]
-            self.session_file[self.SESSION_KEY][self.LOG_KEY].append(
-                    {'date': timestamp, 'entry': line_data, 'bug': True})
-            return {
-                    self.CMD_KEY: self.PASS_THROUGH,
-                    self.TEXT_KEY: 'Bug data captured'}
-        elif line_data.startswith(self.TIMEBOX_CMD):
-            line_data = line_data[len(self.TIMEBOX_CMD):]
-            self.session_file[self.SESSION_KEY][self.TIMEBOX_KEY] = line_data
-            return {
-                    self.CMD_KEY: self.PASS_THROUGH,
-                    self.TEXT_KEY:
-                    'Test time box saved'}
-        elif line_data.startswith(self.MISSION_CMD):
-            line_data = line_data[len(self.MISSION_CMD):]
-            self.session_file[self.SESSION_KEY][self.MISSION_KEY] = line_data
-            return {
-                    self.CMD_KEY: self.PASS_THROUGH,
-                    self.TEXT_KEY: 'Test mission saved'}
-        elif line_data.rstrip() == self.SCREENSHOT_CMD:
-            return {
-                    self.CMD_KEY: self.PASS_THROUGH,
-                    self.TEXT_KEY: '**Not Implemented yet**'}
-        elif line_data.rstrip() == self.UNDO_CMD:
-            self.session_file[self.SESSION_KEY][self.LOG_KEY].pop()
-            return {
-                    self.CMD_KEY: self.PASS_THROUGH,
-                    self.TEXT_KEY: 'Last entry removed'}
-        elif line_data.startswith(self.AREAS_CMD):
-            areas = line_data[len(self.AREAS_CMD)+1:].split(sep=',')
-            areas = [a.strip() for a in areas]
-            areas = list(filter(None, areas))
-            self.session_file[self.SESSION_KEY][self.AREAS_KEY] = areas
-            return {
-                    self.CMD_KEY: self.PASS_THROUGH,
-                    self.TEXT_KEY: 'Test areas saved'}
-        elif line_data.rstrip() == self.PAUSE_CMD:
-            self.paused = self.timer.pause()
-            return {
-                    self.CMD_KEY: self.PASS_THROUGH,
-                    self.TEXT_KEY: 'Session paused'}
-        elif line_data.rstrip() == self.DURATION_CMD:
-            return {
-                    self.CMD_KEY: self.PASS_THROUGH,
-                    self.TEXT_KEY: 'Duration: '+str(
-                        self.timer.get_duration())}
-        elif line_data.rstrip() == self.HELP_CMD:
-            commands = list(self.COMMANDS.keys())
+    def check_idle(self, timestamp):
+        """Pause a session that had no entry for longer than its idle
+        timeout, as of the moment the timeout ran out"""
+        idle = self.timer.touch()
+        timeout = self.store.data[self.IDLE_KEY]
+        if self.paused or timeout is None or idle <= timeout:
+            return None
+        self.paused = self.timer.pause(ago=idle - timeout)
+        self.record_pause(self.PAUSE_EVENT, timestamp - int(idle - timeout))
+        return 'Session was idle, paused for ' + format_duration(
+                idle - timeout)
+
+    def record_pause(self, event, timestamp):
+        self.store.append(self.PAUSES_KEY, [
+            event, timestamp, as_seconds(self.timer.get_duration())])
+
+    def result(self, text='', command=PASS_THROUGH):
+        return {self.CMD_KEY: command, self.TEXT_KEY: text}
+
+    def add_entry(self, entry):
+        item_id = self.store.append(self.LOG_KEY, entry)
+        self.remember((self.ADDED, self.LOG_KEY, item_id, entry))
+
+    def set_field(self, key, value):
+        previous = self.store.data[key]
+        self.store.set(key, value)
+        self.remember((self.CHANGED, key, previous, value))
+
+    def remember(self, change):
+        self.undo_history.append(change)
+        self.redo_history.clear()
+
+    def record_note(self, timestamp, line_data):
+        # Write to session file
+        self.add_entry(LogEntry(timestamp, EntryKind.NOTE, ' '+line_data))
+        return self.result()
+
+    def quit_session(self, timestamp, args):
+        print('Would you like to record a debrief? (y/N)')
+        confirmation = input()
+        if confirmation.lower() in ['y', 'yes']:
+            print('Debrief:', end=' ')
+            debrief = input()
+            self.store.set(self.DEBRIEF_KEY, debrief)
+        self.store.set(self.DURATION_KEY,
+                       as_seconds(self.timer.get_duration()))
+        return self.result(command=self.PASS_THROUGH + self.SESSION_QUIT)
+
+    def record_bug(self, timestamp, args):
+        self.add_entry(LogEntry(timestamp, EntryKind.BUG, args))
+        return self.result('Bug data captured')
+
+    def set_timebox(self, timestamp, args):
+        timebox = as_seconds(args.strip() or None)
+        if isinstance(timebox, str):
+            return self.result('Invalid time box, use eg. 90m, 1h30 or '
+                               '01:30:00')
+        self.set_field(self.TIMEBOX_KEY, timebox)
+        self.timebox_warned = False
+        return self.result('Test time box saved')
+
+    def set_mission(self, timestamp, args):
+        self.set_field(self.MISSION_KEY, args)
+        return self.result('Test mission saved')
+
+    def take_screenshot(self, timestamp, args):
+        from .attachments import ScreenshotError, get_backend
+        try:
+            capture = get_backend().capture()
+        except ScreenshotError as error:
+            return self.result('Screenshot failed: {}'.format(error))
+        # Only the digest is logged, the image is written in the background
+        digest = self.attachments.put(capture)
+        self.add_entry(LogEntry(timestamp, EntryKind.SCREENSHOT, digest))
+        return self.result('Screenshot saved')
+
+    def undo_entry(self, timestamp, args):
+        """Undo the latest change still in the history. Each undo only
+        writes one small record, whatever the size of the session."""
+        if not self.undo_history:
+            # Nothing changed since the session was opened, fall back to
+            # removing the latest entry, which show lists last
+            indexes = self.log_indexes()
+            if not indexes:
+                return self.result('Nothing to undo')
+            item_id = self.store.ids[self.LOG_KEY][indexes[-1]]
+            entry = self.store.pop(self.LOG_KEY, item_id)
+            self.redo_history.append((self.ADDED, self.LOG_KEY, item_id,
+                                      entry))
+            return self.result('Last entry removed')
+        change = self.undo_history.pop()
+        try:
+            text = self.revert(change)
+        except IndexError:
+            # Removed by another writer meanwhile
+            return self.result('Entry no longer exists')
+        self.redo_history.append(change)
+        return self.result(text)
+
+    def revert(self, change):
+        kind, key = change[:2]
+        if kind == self.ADDED:
+            self.store.pop(key, change[2])
+            return 'Last entry removed'
+        if kind == self.CHANGED:
+            self.store.set(key, change[2])
+            self.timebox_warned = False
+            return self.FIELD_NAMES[key] + ' change undone'
+        _, _, item_id, index, previous, _ = change
+        self.store.replace(key, item_id, previous, index)
+        return 'Entry edit undone'
+
+    def redo_entry(self, timestamp, args):
+        if not self.redo_history:
+            return self.result('Nothing to redo')
+        change = self.redo_history.pop()
+        kind, key = change[:2]
+        if kind == self.ADDED:
+            # Appended again under a new id, the old one stays removed
+            change = (kind, key, self.store.append(key, change[3]),
+                      change[3])
+            text = 'Entry restored'
+        elif kind == self.CHANGED:
+            self.store.set(key, change[3])
+            text = self.FIELD_NAMES[key] + ' change redone'
+        else:
+            _, _, item_id, index, _, value = change
+            try:
+                self.store.replace(key, item_id, value, index)
+            except IndexError:
+                return self.result('Entry no longer exists')
+            text = 'Entry edit redone'
+        self.undo_history.append(change)
+        return self.result(text)
+
+    def edit_entry(self, timestamp, args):
+        try:
+            number, text = args.split(None, 1)
+            number = int(number)
+        except ValueError:
+            return self.result('Please give an entry number and its new text')
+        indexes = self.log_indexes()
+        if not 0 < number <= len(indexes):
+            return self.result('There is no entry {}'.format(number))
+        index = indexes[number - 1]
+        entry = self.store.data[self.LOG_KEY][index]
+        if entry.screenshot:
+            return self.result('Screenshots can not be edited')
+        item_id = self.store.ids[self.LOG_KEY][index]
+        value = entry._replace(text=' ' + text.strip())
+        self.store.replace(self.LOG_KEY, item_id, value, index)
+        self.remember((self.EDITED, self.LOG_KEY, item_id, index, entry,
+                       value))
+        return self.result('Entry {} updated'.format(number))
+
+    def set_areas(self, timestamp, args):
+        areas = args.split(sep=',')
+        areas = [a.strip() for a in areas]
+        areas = list(filter(None, areas))
+        self.set_field(self.AREAS_KEY, areas)
+        return self.result('Test areas saved')
+
+    def pause_session(self, timestamp, args):
+        self.paused = self.timer.pause()
+        self.record_pause(self.PAUSE_EVENT, timestamp)
+        return self.result('Session paused')
+
+    def set_idle_timeout(self, timestamp, args):
+        args = args.strip()
+        timeout = None if args in ('', 'off') else as_seconds(args)
+        if isinstance(timeout, str) or timeout == 0:
+            return self.result('Invalid idle time, use eg. 10m or off')
+        self.set_field(self.IDLE_KEY, timeout)
+        if timeout is None:
+            return self.result('Idle pause turned off')
+        return self.result('Session pauses after {} idle'.format(
+                format_duration(timeout)))
+
+    def show_duration(self, timestamp, args):
+        return self.result('Duration: '+str(self.timer.get_duration()))
+
+    def show_help(self, timestamp, args):
+        command = args.strip()
+        if not command:
             help_text = 'Available session commands'
-            for cmd in commands:
+            for cmd in self.COMMANDS:
                 help_text += cmd + '  \n'
-            help_text = help_text.rstrip()
-            return {
-                    self.CMD_KEY: self.PASS_THROUGH,
-                    self.TEXT_KEY: help_text}
-        elif line_data.startswith(self.HELP_CMD):
-            command = line_data[len(self.AREAS_CMD):]
-            try:
-                return {
-                        self.CMD_KEY: self.PASS_THROUGH,
-                        self.TEXT_KEY: self.COMMANDS[command]}
-            except KeyError:
-                return {
-                        self.CMD_KEY: self.PASS_THROUGH,
-                        self.TEXT_KEY: command + ' command does not exist'}
-        else:
-            # Write to session fil
-            self.session_file[
-                    self.SESSION_KEY][self.LOG_KEY].append(
-                            {'date': timestamp,
-                             'entry': ' '+line_data, 'bug': False})
-            return {
-                    self.CMD_KEY: self.PASS_THROUGH, self.TEXT_KEY: ''}
+            return self.result(help_text.rstrip())
+        try:
+            return self.result(self.COMMANDS[command])
+        except KeyError:
+            return self.result(command + ' command does not exist')
+
+    # Session command -> (handler, takes arguments), see register_command()
+    HANDLERS = {QUIT_CMD: (quit_session, False),
+                BUG_CMD: (record_bug, True),
+                TIMEBOX_CMD: (set_timebox, True),
+                MISSION_CMD: (set_mission, True),
+                SCREENSHOT_CMD: (take_screenshot, False),
+                UNDO_CMD: (undo_entry, False),
+                REDO_CMD: (redo_entry, False),
+                EDIT_CMD: (edit_entry, True),
+                AREAS_CMD: (set_areas, True),
+                PAUSE_CMD: (pause_session, False),
+                IDLE_CMD: (set_idle_timeout, True),
+                DURATION_CMD: (show_duration, False),
+                HELP_CMD: (show_help, True)}
@@ -0,0 +1,222 @@
+import os
+import sqlite3
+from .session import Session
+
+
+class SessionCatalog:
+    """Persistent index of the sessions in a session directory.
+
+    Listing, existence checks and tab completion read the catalog instead of
+    scanning the directory. Lookups go through the primary key index, so they
+    stay O(log n) however many sessions there are. The catalog remembers the
+    directory mtime and reconciles itself with the directory when it changes
+    behind its back. Listings also compare the mtime and size of every
+    session file, which change without the directory when another recorder
+    writes to a session.
+    """
+
+    FILENAME = '.catalog.sqlite'
+    SCHEMA_VERSION = 4
+    # Files in the session directory that are not sessions
+    IGNORED_SUFFIXES = ('.migrating', '.compacting', '.archiving',
+                        '.restoring', '.provisioning')
+    COLUMNS = ('name', 'mtime', 'size', 'duration', 'bug_count', 'mission',
+               'entry_count', 'timebox', 'area_count', 'archived')
+    # list orderings, sessions without a duration or timebox sort last
+    SORT_ORDERS = {'name': 'name',
+                   'duration': 'duration DESC, name',
+                   'overrun': 'MAX(duration - timebox, 0) DESC, name'}
+
+    def __init__(self, session_dir):
+        self.session_dir = session_dir
+        if not os.path.exists(session_dir):
+            os.makedirs(session_dir)
+        self.path = os.path.join(session_dir, self.FILENAME)
+        try:
+            self.db = self.connect()
+        except sqlite3.DatabaseError:
+            # The catalog only mirrors the directory, so start over
+            os.remove(self.path)
+            self.db = self.connect()
+        self.dir_mtime = self.get_meta('dir_mtime')
+        self.check_drift()
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=10)
+        db.row_factory = sqlite3.Row
+        # An in-memory rollback journal keeps sqlite from creating files
+        # in the session directory, which would change its mtime
+        db.execute('PRAGMA journal_mode=MEMORY')
+        db.execute('CREATE TABLE IF NOT EXISTS meta '
+                   '(key TEXT PRIMARY KEY, value) WITHOUT ROWID')
+        version = db.execute('SELECT value FROM meta WHERE key = ?',
+                             ('schema',)).fetchone()
+        if version is None or version[0] != self.SCHEMA_VERSION:
+            with db:
+                db.execute('DROP TABLE IF EXISTS sessions')
+                db.execute('DROP TABLE IF EXISTS session_areas')
+                db.execute('DELETE FROM meta')
+                self.create_tables(db)
+                db.execute('INSERT INTO meta VALUES (?, ?)',
+                           ('schema', self.SCHEMA_VERSION))
+        return db
+
+    def create_tables(self, db):
+        # duration and timebox are in seconds
+        db.execute('CREATE TABLE sessions (name TEXT PRIMARY KEY, '
+                   'mtime REAL, size INTEGER, duration REAL, '
+                   'bug_count INTEGER, '
+                   'mission TEXT, entry_count INTEGER, timebox INTEGER, '
+                   'area_count INTEGER, archived INTEGER) WITHOUT ROWID')
+        db.execute('CREATE TABLE session_areas (area TEXT, name TEXT, '
+                   'PRIMARY KEY (area, name)) WITHOUT ROWID')
+        db.execute('CREATE INDEX session_areas_name ON session_areas (name)')
+
+    def get_meta(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?',
+                              (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                        (key, value))
+
+    def current_dir_mtime(self):
+        return os.stat(self.session_dir).st_mtime_ns
+
+    def check_drift(self, files=False):
+        """Reconcile the catalog when sessions were added or removed behind
+        its back, or with files set when any session file changed"""
+        if files or self.current_dir_mtime() != self.dir_mtime:
+            self.rebuild()
+
+    @classmethod
+    def is_session_file(cls, filename):
+        return (not filename.startswith('.') and
+                not filename.endswith(cls.IGNORED_SUFFIXES))
+
+    def rebuild(self):
+        """Reconcile the catalog with the session directory, only reading
+        sessions whose mtime or size changed since they were catalogued"""
+        known = {row['name']: (row['mtime'], row['size']) for row in
+                 self.db.execute('SELECT name, mtime, size FROM sessions')}
+        changed = []
+        for entry in os.scandir(self.session_dir):
+            if not self.is_session_file(entry.name):
+                continue
+            stat = entry.stat()
+            if known.pop(entry.name, None) != (stat.st_mtime, stat.st_size):
+                changed.append((entry.name, stat))
+        if not changed and not known and (
+                self.current_dir_mtime() == self.dir_mtime):
+            # Nothing to write
+            return
+        with self.db:
+            for name, stat in changed:
+                self.upsert(name, self.read_summary(name), stat)
+            for name in known:
+                self.delete(name)
+            self.record_dir_mtime()
+
+    def read_summary(self, session_name):
+        try:
+            return Session.get_session_summary(session_name, self.session_dir)
+        except (OSError, ValueError, KeyError):
+            return Session.summarize(Session.new_session_data())
+
+    def record_dir_mtime(self):
+        self.dir_mtime = self.current_dir_mtime()
+        self.set_meta('dir_mtime', self.dir_mtime)
+
+    def upsert(self, session_name, summary, stat):
+        """Store a Session.summarize() summary of the session file with
+        os.stat() result stat"""
+        header = summary['header']
+        # A timebox that could not be parsed is left out
+        timebox = header[Session.TIMEBOX_KEY]
+        if not isinstance(timebox, int):
+            timebox = None
+        areas = set(header[Session.AREAS_KEY])
+        self.db.execute('INSERT OR REPLACE INTO sessions VALUES '
+                        '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (session_name, stat.st_mtime, stat.st_size,
+                         header[Session.DURATION_KEY], summary['bug_count'],
+                         header[Session.MISSION_KEY], summary['entry_count'],
+                         timebox, len(areas),
+                         int(summary.get('archived', False))))
+        self.db.execute('DELETE FROM session_areas WHERE name = ?',
+                        (session_name,))
+        self.db.executemany('INSERT INTO session_areas VALUES (?, ?)',
+                            [(area, session_name) for area in areas])
+
+    def delete(self, session_name):
+        self.db.execute('DELETE FROM sessions WHERE name = ?',
+                        (session_name,))
+        self.db.execute('DELETE FROM session_areas WHERE name = ?',
+                        (session_name,))
+
+    def update(self, session_name, session_data):
+        """Record a session that was created or saved"""
+        stat = os.stat(os.path.join(self.session_dir, session_name))
+        with self.db:
+            self.upsert(session_name, Session.summarize(session_data), stat)
+            self.record_dir_mtime()
+
+    def update_many(self, sessions):
+        """Record many sessions that were created, given as (name,
+        session_data) pairs, in one transaction"""
+        with self.db:
+            for session_name, session_data in sessions:
+                stat = os.stat(os.path.join(self.session_dir,
+                                            session_name))
+                self.upsert(session_name, Session.summarize(session_data),
+                            stat)
+            self.record_dir_mtime()
+
+    def mark_archived(self, session_name):
+        """Record a session that was archived, keeping its mtime"""
+        size = os.path.getsize(os.path.join(self.session_dir, session_name))
+        with self.db:
+            self.db.execute('UPDATE sessions SET archived = 1, size = ? '
+                            'WHERE name = ?', (size, session_name))
+            self.record_dir_mtime()
+
+    def unarchived(self, before):
+        """Names of the sessions not archived and last changed before the
+        epoch time before"""
+        self.check_drift(files=True)
+        return [row['name'] for row in self.db.execute(
+                'SELECT name FROM sessions WHERE NOT archived AND mtime < ? '
+                'ORDER BY name', (before,))]
+
+    def remove(self, session_name):
+        """Forget a session that was deleted"""
+        with self.db:
+            self.delete(session_name)
+            self.record_dir_mtime()
+
+    def contains(self, session_name):
+        self.check_drift()
+        return self.db.execute('SELECT 1 FROM sessions WHERE name = ?',
+                               (session_name,)).fetchone() is not None
+
+    def complete(self, prefix):
+        self.check_drift()
+        if not prefix:
+            rows = self.db.execute('SELECT name FROM sessions ORDER BY name')
+        else:
+            # A range scan over the primary key instead of LIKE, which
+            # would not use the index
+            rows = self.db.execute(
+                    'SELECT name FROM sessions WHERE name >= ? AND name < ? '
+                    'ORDER BY name', (prefix, prefix + '\U0010ffff'))
+        return [row['name'] for row in rows]
+
+    def sessions(self, sort='name'):
+        self.check_drift(files=True)
+        return self.db.execute(
+                'SELECT *, MAX(duration - timebox, 0) AS overrun FROM sessions '
+                'ORDER BY ' + self.SORT_ORDERS[sort]).fetchall()
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,418 @@
+import collections
+import http.server
+import json
+import os
+import threading
+import urllib.parse
+from .log_entry import EntryKind
+from .session import Session
+from .session_catalog import SessionCatalog
+from .session_store import JournalStore
+
+
+class CentralSession:
+    """A session journal on the server and the ids it has applied"""
+
+    # Checks of the items of the list keys of Session.new_session_data()
+    ITEM_CHECKS = {
+        # [epoch, EntryKind, text]
+        Session.LOG_KEY: lambda item: (
+            isinstance(item, list) and len(item) == 3 and
+            is_number(item[0]) and item[1] in list(EntryKind) and
+            isinstance(item[2], str)),
+        # [event, timestamp, seconds]
+        Session.PAUSES_KEY: lambda item: (
+            isinstance(item, list) and len(item) == 3 and
+            isinstance(item[0], str) and is_number(item[1]) and
+            is_number(item[2])),
+        Session.AREAS_KEY: lambda item: isinstance(item, str),
+    }
+    # Lists whose items are appended, popped and replaced one at a time.
+    # The other keys, test areas included, are only ever set.
+    ITEM_KEYS = (Session.LOG_KEY, Session.PAUSES_KEY)
+    # Checks of the values set, besides None. Durations may still be
+    # formatted, they are read with as_seconds().
+    VALUE_CHECKS = {
+        Session.TIMEBOX_KEY: lambda value: (
+            is_number(value) or isinstance(value, str)),
+        Session.DURATION_KEY: lambda value: (
+            is_number(value) or isinstance(value, str)),
+        Session.IDLE_KEY: lambda value: is_number(value),
+        Session.MISSION_KEY: lambda value: isinstance(value, str),
+        Session.DEBRIEF_KEY: lambda value: isinstance(value, str),
+        Session.AREAS_KEY: lambda value: isinstance(value, list) and all(
+            isinstance(area, str) for area in value),
+    }
+
+    def __init__(self, path):
+        self.store = JournalStore(path, Session.new_session_data(),
+                                  legacy_key=Session.SESSION_KEY)
+        # Uploads are retried after failures, entries seen before are
+        # skipped. Popped ids are kept, so a retried append stays undone.
+        self.known = self.store_ids()
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def store_ids(self):
+        return {(key, item_id) for key, ids in self.store.ids.items()
+                for item_id in ids}
+
+    def last_id(self):
+        return max((max(ids) for ids in self.store.ids.values() if ids),
+                   default=-1)
+
+    def apply(self, records):
+        """Write uploaded records, checked with check_record(), returning
+        how many were new"""
+        applied = 0
+        for restoring, group in self.split_snapshots(records):
+            if restoring:
+                self.restore(group)
+                applied += len(group)
+                continue
+            with self.store.batch():
+                for record in group:
+                    if record['op'] == JournalStore.APPEND:
+                        item = (record['key'], record['id'])
+                        if item in self.known:
+                            continue
+                        self.known.add(item)
+                    elif record['op'] == JournalStore.CHUNK:
+                        record = self.new_items(record)
+                        if record is None:
+                            continue
+                    self.store.write(record)
+                    applied += 1
+        return applied
+
+    @staticmethod
+    def split_snapshots(records):
+        """Yield (True, records) for every snapshot and the chunk records
+        following it, (False, records) for the records in between"""
+        group = []
+        restoring = False
+        for record in records:
+            op = record['op']
+            if op == JournalStore.SNAPSHOT or (
+                    restoring != (op == JournalStore.CHUNK)):
+                if group:
+                    yield restoring, group
+                group = []
+                restoring = op == JournalStore.SNAPSHOT
+            group.append(record)
+        if group:
+            yield restoring, group
+
+    def new_items(self, chunk):
+        """chunk without the items applied before, None if it has none left.
+        A snapshot's chunks only arrive on their own when its upload was
+        split."""
+        items = [(item_id, item) for _, item_id, item in
+                 JournalStore.iter_snapshot(chunk, 0)
+                 if (chunk['key'], item_id) not in self.known]
+        if not items:
+            return None
+        self.known.update((chunk['key'], item_id) for item_id, _ in items)
+        return {'op': JournalStore.CHUNK, 'key': chunk['key'],
+                'ids': [item_id for item_id, _ in items],
+                'values': [item for _, item in items]}
+
+    def restore(self, records):
+        """Replace the session with a recorder's snapshot of it"""
+        with self.store.locked():
+            for record in records:
+                self.store.apply(record, decode=False)
+            self.store.write_snapshot()
+        self.known |= self.store_ids()
+
+    def close(self):
+        self.store.close()
+        self.closed = True
+
+    @classmethod
+    def check_record(cls, record):
+        """Raise ValueError unless record is a journal record of a session:
+        its key one of Session.new_session_data(), set or changed item by
+        item as that key is and holding values of the key's shape"""
+        if not isinstance(record, dict):
+            raise ValueError('Invalid record')
+        op = record.get('op')
+        key = record.get('key')
+        if op == JournalStore.SNAPSHOT:
+            cls.check_snapshot(record)
+        elif op == JournalStore.SET:
+            if key not in cls.VALUE_CHECKS:
+                raise ValueError('Can not set {!r}'.format(key))
+            cls.check_value(key, record.get('value'))
+        elif op in (JournalStore.APPEND, JournalStore.POP,
+                    JournalStore.REPLACE):
+            if key not in cls.ITEM_KEYS:
+                raise ValueError('Can not {} {!r}'.format(op, key))
+            if not is_id(record.get('id')) or not (
+                    record.get('index') is None or is_id(record['index'])):
+                raise ValueError('Invalid id in {} record'.format(op))
+            if op != JournalStore.POP:
+                cls.check_items(key, [record['id']], [record.get('value')])
+            if op == JournalStore.REPLACE and 'previous' in record:
+                cls.check_items(key, [record['id']], [record['previous']])
+        elif op == JournalStore.CHUNK:
+            # Snapshots chunk the items of every list, see snapshot_records()
+            if key not in cls.ITEM_CHECKS:
+                raise ValueError('Can not {} {!r}'.format(op, key))
+            if 'columns' in record:
+                items = cls.column_items(record['columns'])
+            else:
+                items = record.get('values')
+            cls.check_items(key, record.get('ids'), items)
+        else:
+            raise ValueError('Invalid record')
+
+    @classmethod
+    def check_snapshot(cls, record):
+        values = record.get('value')
+        ids = record.get('ids', {})
+        columns = record.get('columns', {})
+        if not (isinstance(values, dict) and isinstance(ids, dict) and
+                isinstance(columns, dict) and
+                is_id(record.get('chunks', 0)) and
+                is_id(record.get('next_id', 0))):
+            raise ValueError('Invalid snapshot record')
+        for key, value in values.items():
+            if key in cls.ITEM_KEYS:
+                if not isinstance(value, list):
+                    raise ValueError('Invalid value for {!r}'.format(key))
+                # Items without ids are numbered when applied
+                cls.check_items(key, ids.get(key, range(len(value))), value)
+            elif key in cls.VALUE_CHECKS:
+                cls.check_value(key, value)
+            else:
+                raise ValueError('Can not set {!r}'.format(key))
+        for key, fields in columns.items():
+            if key not in cls.ITEM_CHECKS:
+                raise ValueError('Can not set {!r}'.format(key))
+            cls.check_items(key, ids.get(key), cls.column_items(fields))
+
+    @staticmethod
+    def column_items(columns):
+        """The items of a list packed one column per field"""
+        if not isinstance(columns, list) or not all(
+                isinstance(column, list) for column in columns) or len(
+                    set(len(column) for column in columns)) > 1:
+            raise ValueError('Invalid columns')
+        return [list(item) for item in zip(*columns)]
+
+    @classmethod
+    def check_value(cls, key, value):
+        if value is not None and not cls.VALUE_CHECKS[key](value):
+            raise ValueError('Invalid value for {!r}'.format(key))
+
+    @classmethod
+    def check_items(cls, key, ids, items):
+        if not (isinstance(ids, (list, range)) and isinstance(items, list) and
+                len(ids) == len(items) and all(map(is_id, ids))):
+            raise ValueError('Invalid ids for {!r}'.format(key))
+        if not all(map(cls.ITEM_CHECKS[key], items)):
+            raise ValueError('Invalid item for {!r}'.format(key))
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def is_id(value):
+    return isinstance(value, int) and not isinstance(value, bool) and (
+        value >= 0)
+
+
+class SessionServer(http.server.ThreadingHTTPServer):
+    """Central store of the sessions recorded by a team.
+
+    Recorders upload the journal records of their sessions, see
+    RemoteStore, and the server writes them to journals in session_dir, so
+    that directory can be listed, searched and reported on like any local
+    session directory. Each connection gets its own thread and sessions are
+    written under their own lock, so recorders only wait for each other when
+    they upload to the same session.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+    # Session journals kept open between uploads, least recently used
+    # ones are closed beyond this
+    MAX_OPEN_SESSIONS = 256
+    # Largest upload accepted, in bytes
+    MAX_BODY = 64 * 1024 * 1024
+    RECORD_OPS = (JournalStore.SET, JournalStore.APPEND, JournalStore.POP,
+                  JournalStore.REPLACE, JournalStore.SNAPSHOT,
+                  JournalStore.CHUNK)
+
+    def __init__(self, address, session_dir, quiet=False):
+        if not os.path.exists(session_dir):
+            os.makedirs(session_dir)
+        self.session_dir = session_dir
+        self.quiet = quiet
+        self.sessions = collections.OrderedDict()
+        self.sessions_lock = threading.Lock()
+        super().__init__(address, SessionRequestHandler)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    @staticmethod
+    def valid_name(session_name):
+        return (bool(session_name) and '/' not in session_name and
+                os.sep not in session_name and
+                SessionCatalog.is_session_file(session_name))
+
+    def session_names(self):
+        return sorted(name for name in os.listdir(self.session_dir)
+                      if SessionCatalog.is_session_file(name))
+
+    def open_session(self, session_name):
+        """The open CentralSession, opening it and closing the least
+        recently used one when too many are open"""
+        evicted = []
+        with self.sessions_lock:
+            session = self.sessions.get(session_name)
+            if session is None:
+                session = CentralSession(os.path.join(self.session_dir,
+                                                      session_name))
+                self.sessions[session_name] = session
+                while len(self.sessions) > self.MAX_OPEN_SESSIONS:
+                    evicted.append(self.sessions.popitem(last=False)[1])
+            else:
+                self.sessions.move_to_end(session_name)
+        for old in evicted:
+            with old.lock:
+                old.close()
+        return session
+
+    def with_session(self, session_name, function):
+        """Call function(session) holding the session's lock"""
+        while True:
+            session = self.open_session(session_name)
+            with session.lock:
+                # Closed by another thread meanwhile, open it again
+                if not session.closed:
+                    return function(session)
+
+    def session_state(self, session_name):
+        if not os.path.exists(os.path.join(self.session_dir, session_name)):
+            return None
+        return self.with_session(
+                session_name, lambda session: {'last_id': session.last_id()})
+
+    def upload(self, session_name, records):
+        return self.with_session(
+                session_name, lambda session: session.apply(records))
+
+    def server_close(self):
+        super().server_close()
+        with self.sessions_lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            with session.lock:
+                session.close()
+
+
+class SessionRequestHandler(http.server.BaseHTTPRequestHandler):
+    """GET /sessions lists the sessions, GET /sessions/NAME returns the last
+    entry id stored for a session and POST /sessions/NAME/records writes the
+    journal records in the body, one JSON object per line"""
+
+    # Keep-alive, recorders reuse their connections
+    protocol_version = 'HTTP/1.1'
+
+    def route(self):
+        path = urllib.parse.urlsplit(self.path).path
+        return [urllib.parse.unquote(part) for part in path.split('/')
+                if part]
+
+    def do_GET(self):
+        parts = self.route()
+        if parts == ['sessions']:
+            self.reply(200, {'sessions': self.server.session_names()})
+        elif (len(parts) == 2 and parts[0] == 'sessions' and
+                self.server.valid_name(parts[1])):
+            state = self.server.session_state(parts[1])
+            if state is None:
+                self.reply(404, {'error': 'No such session'})
+            else:
+                self.reply(200, state)
+        else:
+            self.reply(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        parts = self.route()
+        if (len(parts) != 3 or parts[0] != 'sessions' or
+                parts[2] != 'records' or
+                not self.server.valid_name(parts[1])):
+            self.discard_body()
+            self.reply(404, {'error': 'Not found'})
+            return
+        try:
+            records = self.read_records()
+        except ValueError as error:
+            self.close_connection = True
+            self.reply(400, {'error': str(error)})
+            return
+        try:
+            applied = self.server.upload(parts[1], records)
+        except Exception as error:
+            # Reported rather than dropping the connection, the recorder
+            # keeps the records and retries
+            self.log_error('Upload to %s failed: %r', parts[1], error)
+            self.reply(500, {'error': 'Records could not be stored'})
+            return
+        self.reply(200, {'received': len(records), 'applied': applied})
+
+    def content_length(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length < 0 or length > self.server.MAX_BODY:
+            raise ValueError('Invalid Content-Length')
+        return length
+
+    def discard_body(self):
+        try:
+            self.rfile.read(self.content_length())
+        except ValueError:
+            self.close_connection = True
+
+    def read_records(self):
+        body = self.rfile.read(self.content_length())
+        records = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if (not isinstance(record, dict) or
+                    record.get('op') not in self.server.RECORD_OPS):
+                raise ValueError('Invalid record')
+            CentralSession.check_record(record)
+            records.append(record)
+        return records
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def serve(session_dir, host='127.0.0.1', port=8765):
+    """Serve session_dir until interrupted"""
+    with SessionServer((host, port), session_dir) as server:
+        print('Serving sessions in {} at {}'.format(session_dir, server.url))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
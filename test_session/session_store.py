@@ -0,0 +1,1158 @@
+import atexit
+import contextlib
+import datetime
+import gzip
+import heapq
+import io
+import json
+import os
+import queue
+import threading
+import time
+try:
+    import fcntl
+except ImportError:
+    # No advisory locks, writers are not serialised
+    fcntl = None
+
+
+def _encode(value):
+    if isinstance(value, datetime.timedelta):
+        return {'$timedelta': value.total_seconds()}
+    raise TypeError('Cannot journal value of type ' + type(value).__name__)
+
+
+def _decode(obj):
+    if '$timedelta' in obj:
+        return datetime.timedelta(seconds=obj['$timedelta'])
+    return obj
+
+
+class FlushMetrics:
+    """Latency of the journal writes made by a write-behind thread"""
+
+    def __init__(self):
+        self.flushes = 0
+        self.records = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.last_seconds = 0.0
+
+    def add(self, records, seconds):
+        self.flushes += 1
+        self.records += records
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.last_seconds = seconds
+
+    @property
+    def mean_seconds(self):
+        return self.total_seconds / self.flushes if self.flushes else 0.0
+
+
+class FileSection(io.RawIOBase):
+    """The rest of an open binary file from offset on, as a file of its own"""
+
+    def __init__(self, raw, offset):
+        self.raw = raw
+        self.offset = offset
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        return self.raw.readinto(buffer)
+
+    def seek(self, position, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position += self.offset
+        return self.raw.seek(position, whence) - self.offset
+
+    def tell(self):
+        return self.raw.tell() - self.offset
+
+    def fileno(self):
+        return self.raw.fileno()
+
+    def close(self):
+        self.raw.close()
+        super().close()
+
+
+class ArchivedJournal(gzip.GzipFile):
+    """Reads the journal packed in an archive, see JournalStore.archive()"""
+
+    def close(self):
+        section = self.fileobj
+        super().close()
+        # GzipFile leaves a file object it was given open
+        if section is not None:
+            section.close()
+
+
+class JournalStore:
+    """Append-only session storage.
+
+    Every change to the session data is written as its own JSON line, so a
+    write costs the same no matter how large the session is and a crash only
+    loses the records that were never written. The session data is rebuilt by
+    replaying the journal from the top.
+
+    Several stores may write to one journal. Writes hold an exclusive lock on
+    a lock file next to the journal and first apply the records other writers
+    added, so every store sees all entries and ids stay unique. Readers never
+    take the lock, a record is only ever seen whole or not at all.
+
+    With start_write_behind() records are applied in memory straight away
+    and written by a background thread, so a slow disk never holds up the
+    caller. See write_behind().
+    """
+
+    MAGIC = '#test-session-journal v1'
+    # An archive is this line, a line of JSON summary and the journal
+    # compacted and gzipped, see archive()
+    ARCHIVE_MAGIC = '#test-session-archive v1'
+    ARCHIVE_COMPRESSLEVEL = 6
+    # fsync batching: sync after this many records or seconds, whichever first
+    FSYNC_RECORDS = 32
+    FSYNC_SECONDS = 1.0
+    # Legacy dbm backends may spread a shelve over several files
+    LEGACY_SUFFIXES = ('', '.dat', '.dir', '.bak', '.db')
+
+    # Write-behind: flush after this many seconds or records, whichever
+    # first, and block writers once this many records wait to be written
+    FLUSH_SECONDS = 1.0
+    FLUSH_RECORDS = 256
+    MAX_PENDING = 4096
+    # Ids taken at a time by a write-behind store, see reserve_ids()
+    ID_BLOCK = 1024
+
+    SET = 'set'
+    APPEND = 'append'
+    POP = 'pop'
+    # Replaces a list item in place, keeping the value it replaced
+    REPLACE = 'replace'
+    SNAPSHOT = 'snapshot'
+    # List items of the snapshot before it, see snapshot_records()
+    CHUNK = 'chunk'
+    RESERVE = 'reserve'
+    # Items per chunk record, so no line grows with the session
+    CHUNK_ITEMS = 1000
+    # iter_values() sorts values added in more runs than this in memory
+    MAX_RUNS = 16
+
+    def __init__(self, path, skeleton, legacy_key=None, readonly=False,
+                 skip_keys=(), decoders=None, end=None, orders=None):
+        self.path = path
+        self.data = skeleton
+        # Lists that are left empty when replaying, see load()
+        self.skip_keys = skip_keys
+        # Converters from the persisted form of values, or of the items of
+        # list values, by key
+        self.decoders = decoders or {}
+        # Sort keys of the lists a snapshot writes in order, by key
+        self.orders = orders or {}
+        self.ids = {}
+        self.next_id = 0
+        # Records replayed or written since the last snapshot, see compact()
+        self.record_count = 0
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.journal = None
+        # Lines and records held back by batch() until the batch is committed
+        self.pending = None
+        # Callables notified of every record once it is written, eg. to
+        # index it. With write-behind they run on the writer thread.
+        self.listeners = []
+        # Ids of the items this store appended, by key, see pop()
+        self.own_ids = {}
+        # Bytes of the journal applied so far, see catch_up()
+        self.offset = 0
+        self.reader = None
+        self.lock_file = None
+        self.lock_depth = 0
+        # io_lock serialises the threads of this process on the journal,
+        # mutex guards data. Whoever needs both takes io_lock first.
+        self.io_lock = threading.RLock()
+        self.mutex = threading.RLock()
+        # Write-behind state, see start_write_behind()
+        self.queue = None
+        self.writer = None
+        self.write_error = None
+        self.metrics = FlushMetrics()
+        self.id_block = range(0)
+        if readonly:
+            if self.is_legacy(path):
+                self.apply({'op': self.SNAPSHOT,
+                            'value': self.read_legacy(path, legacy_key)})
+            elif os.path.exists(path):
+                for record in self.read_records(path, end):
+                    self.apply(record)
+            return
+        self.lock_file = open(self.lock_path(path), 'a')
+        with self.locked(catch_up=False):
+            if self.is_legacy(path):
+                self.migrate_legacy(path, legacy_key)
+            elif self.is_archive(path):
+                self.restore_archive(path)
+            self.open_journal()
+            self.catch_up()
+
+    @classmethod
+    def is_journal(cls, path):
+        try:
+            with open(path, 'r', encoding='utf-8') as journal:
+                return journal.readline().rstrip('\n') == cls.MAGIC
+        except (OSError, UnicodeDecodeError):
+            return False
+
+    @classmethod
+    def is_archive(cls, path):
+        try:
+            with open(path, 'rb') as archive:
+                return archive.readline().rstrip(b'\n') == \
+                        cls.ARCHIVE_MAGIC.encode()
+        except OSError:
+            return False
+
+    @classmethod
+    def is_legacy(cls, path):
+        if cls.is_journal(path) or cls.is_archive(path):
+            return False
+        import dbm
+        try:
+            return bool(dbm.whichdb(path))
+        except OSError:
+            return False
+
+    @classmethod
+    def read_legacy(cls, path, key):
+        # Only sessions from before the journal need shelve and pickle
+        import shelve
+        with shelve.open(path, flag='r') as legacy:
+            return legacy[key]
+
+    @staticmethod
+    def lock_path(path):
+        head, tail = os.path.split(path)
+        return os.path.join(head, '.' + tail + '.lock')
+
+    @classmethod
+    def remove(cls, path):
+        """Delete a journal and its lock file"""
+        os.remove(path)
+        if os.path.exists(cls.lock_path(path)):
+            os.remove(cls.lock_path(path))
+
+    @classmethod
+    def open_records(cls, path):
+        """Open a journal, or the journal in an archive, for reading"""
+        journal = open(path, 'rb')
+        if journal.readline().rstrip(b'\n') != cls.ARCHIVE_MAGIC.encode():
+            journal.seek(0)
+            return journal
+        journal.readline()
+        return ArchivedJournal(fileobj=FileSection(journal, journal.tell()),
+                               mode='rb')
+
+    @classmethod
+    def read_records(cls, path, end=None):
+        with cls.open_records(path) as journal:
+            yield from cls.parse_records(journal, end)
+
+    @classmethod
+    def parse_records(cls, journal, end=None):
+        journal.readline()
+        yield from cls.parse_lines(journal, journal.tell(), end)
+
+    @classmethod
+    def read_range(cls, journal, start, end):
+        """Yield the records of an open journal from byte offset start, which
+        begins a record, up to byte offset end"""
+        journal.seek(start)
+        if start == 0:
+            yield from cls.parse_records(journal, end)
+        else:
+            yield from cls.parse_lines(journal, start, end)
+
+    @staticmethod
+    def parse_lines(journal, position, end=None):
+        for line in journal:
+            if end is not None:
+                position += len(line)
+                if position > end:
+                    break
+            try:
+                yield json.loads(line, object_hook=_decode)
+            except ValueError:
+                # A torn write from a crash, nothing after it is lost
+                continue
+
+    @staticmethod
+    def complete_size(journal):
+        """Bytes of an open journal up to the end of its last whole record,
+        leaving out a record that is still being written"""
+        position = journal.seek(0, os.SEEK_END)
+        while position > 0:
+            start = max(0, position - 4096)
+            journal.seek(start)
+            index = journal.read(position - start).rfind(b'\n')
+            if index >= 0:
+                return start + index + 1
+            position = start
+        return 0
+
+    @classmethod
+    def load(cls, path, skeleton, legacy_key=None, skip_keys=(),
+             decoders=None, end=None, orders=None):
+        """Replay a journal without opening it for writing. The lists named
+        in skip_keys are not materialised, use iter_values() to stream them.
+        Records from byte offset end on are left out. The lists named in
+        orders are sorted as iter_values() yields them."""
+        store = cls(path, skeleton, legacy_key, readonly=True,
+                    skip_keys=skip_keys, decoders=decoders, end=end)
+        for key, order in (orders or {}).items():
+            values = store.data[key]
+            store.data[key] = [values[index] for index in
+                               store.ordered_indexes(key, order)]
+        return store.data
+
+    @classmethod
+    def iter_snapshot(cls, record, next_id):
+        """Yield (key, id, value) for every list item held in a snapshot or
+        chunk record. Items without a stored id are numbered on from
+        next_id."""
+        if record['op'] == cls.CHUNK:
+            if 'columns' in record:
+                items = zip(*record['columns'])
+            else:
+                items = record['values']
+            for item_id, item in zip(record['ids'], items):
+                yield record['key'], item_id, item
+            return
+        ids = record.get('ids', {})
+        for key, value in record['value'].items():
+            if not isinstance(value, list):
+                continue
+            key_ids = ids.get(key) or range(next_id, next_id + len(value))
+            for item_id, item in zip(key_ids, value):
+                next_id = max(next_id, item_id + 1)
+                yield key, item_id, item
+        # Lists of tuples are packed as one list per field
+        for key, columns in record.get('columns', {}).items():
+            for item_id, item in zip(ids[key], zip(*columns)):
+                yield key, item_id, item
+
+    @classmethod
+    def iter_values(cls, path, key, legacy_key=None, decoder=None,
+                    with_ids=False, end=None, order=None):
+        """Lazily yield the current values of the list under key, or
+        (id, value) pairs when with_ids is set. With order they are sorted
+        by order(value) and then id, otherwise they come in journal order.
+        order is given values as persisted, before decoder, so sorting does
+        not decode every value twice.
+        Values are ordered as they were first added, a replaced value keeps
+        its place.
+
+        The journal is read twice: once to collect the ids of removed values
+        and once to yield the survivors, so memory does not grow with the
+        length of the list. Values added out of order, eg. by several
+        writers, are split into runs that are in order and merged from one
+        read of the journal per run. Beyond MAX_RUNS runs they are sorted in
+        memory instead."""
+        if decoder is None:
+            decoder = cls.identity
+        if cls.is_legacy(path):
+            items = list(enumerate(map(
+                    decoder, cls.read_legacy(path, legacy_key)[key])))
+            if order is not None:
+                items.sort(key=lambda item: (order(item[1]), item[0]))
+            for item_id, value in items:
+                yield (item_id, value) if with_ids else value
+            return
+        # Every read is of the same file even if it is compacted meanwhile
+        with contextlib.ExitStack() as stack:
+            journal = stack.enter_context(cls.open_records(path))
+            removed, replaced, runs = cls.scan(journal, key, end, order)
+            journal.seek(0)
+            if len(runs) <= 1:
+                items = cls.iter_run(journal, key, decoder, removed,
+                                     replaced, end)
+            else:
+                journals = [journal]
+                if len(runs) <= cls.MAX_RUNS:
+                    inode = os.fstat(journal.fileno()).st_ino
+                    for _ in runs[1:]:
+                        journals.append(stack.enter_context(
+                                cls.open_records(path)))
+                        if os.fstat(journals[-1].fileno()).st_ino != inode:
+                            journals = [journal]
+                            break
+                if len(journals) == 1:
+                    items = sorted(cls.iter_run(journal, key, decoder,
+                                                removed, replaced, end,
+                                                order))
+                else:
+                    items = heapq.merge(*(
+                            cls.iter_run(run_journal, key, decoder, removed,
+                                         replaced, end, order, run)
+                            for run, run_journal in enumerate(journals)))
+            for _, item_id, value in items:
+                yield (item_id, value) if with_ids else value
+
+    @classmethod
+    def scan(cls, journal, key, end=None, order=None):
+        """The first pass of iter_values(): the ids of the values under key
+        that were removed, the values replaced by id and, with order, the
+        last sort key of each run, see add_to_run(). Only the values of
+        replaced items are held. A chunk of a list its snapshot wrote sorted
+        is only looked at its ends while everything is in one run."""
+        removed = set()
+        replaced = {}
+        runs = []
+        for op, item_key, item_id, value in cls.iter_items(
+                journal, end, sorted_chunks=order is not None):
+            if item_key != key:
+                continue
+            if op == cls.POP:
+                removed.add(item_id)
+            elif op == cls.REPLACE:
+                replaced[item_id] = value
+            elif order is None:
+                continue
+            elif op == cls.CHUNK:
+                ids = value['ids']
+                first, last = cls.chunk_ends(value)
+                if ids and len(runs) <= 1 and (
+                        not runs or runs[0] <= (order(first), ids[0])):
+                    runs[:] = [(order(last), ids[-1])]
+                    continue
+                for _, chunk_id, item in cls.iter_snapshot(value, 0):
+                    cls.add_to_run(runs, (order(item), chunk_id))
+            else:
+                cls.add_to_run(runs, (order(value), item_id))
+        return removed, replaced, runs
+
+    @staticmethod
+    def chunk_ends(chunk):
+        """The first and last item of a chunk record, None if it is empty"""
+        if not chunk['ids']:
+            return None, None
+        if 'columns' in chunk:
+            return (tuple(column[0] for column in chunk['columns']),
+                    tuple(column[-1] for column in chunk['columns']))
+        return chunk['values'][0], chunk['values'][-1]
+
+    @classmethod
+    def iter_run(cls, journal, key, decoder, removed, replaced, end=None,
+                 order=None, run=None):
+        """Yield (sort key, id, value) for the surviving values under key in
+        journal order, only those of run when given, see add_to_run()"""
+        runs = []
+        for op, item_key, item_id, value in cls.iter_items(journal, end):
+            if op != cls.APPEND or item_key != key:
+                continue
+            sort_key = None
+            if order is not None:
+                sort_key = (order(value), item_id)
+                index = cls.add_to_run(runs, sort_key)
+                if run is not None and index != run:
+                    continue
+            if item_id in removed:
+                continue
+            yield sort_key, item_id, decoder(replaced.get(item_id, value))
+
+    @staticmethod
+    def add_to_run(runs, sort_key):
+        """Index of the first run, given by the last key added to each, that
+        sort_key continues in order, starting a new run if there is none"""
+        for index, last in enumerate(runs):
+            if last <= sort_key:
+                runs[index] = sort_key
+                return index
+        runs.append(sort_key)
+        return len(runs) - 1
+
+    @classmethod
+    def iter_items(cls, journal, end=None, sorted_chunks=False):
+        """Yield (op, key, id, value) for every list item the records of an
+        open journal add, remove or replace. Items a snapshot holds are
+        yielded as appended. With sorted_chunks, the chunk records of the
+        lists a snapshot wrote sorted are yielded whole as (CHUNK, key,
+        None, record)."""
+        next_id = 0
+        # Lists the last snapshot wrote sorted and its chunks still to come
+        sorted_keys = ()
+        chunks = 0
+        for record in cls.parse_records(journal, end):
+            op = record['op']
+            if op == cls.APPEND:
+                next_id = max(next_id, record['id'] + 1)
+                yield op, record['key'], record['id'], record['value']
+            elif op in (cls.POP, cls.REPLACE):
+                yield op, record['key'], record['id'], record.get('value')
+            elif op in (cls.SNAPSHOT, cls.CHUNK):
+                if op == cls.SNAPSHOT:
+                    sorted_keys = record.get('sorted', ())
+                    chunks = record.get('chunks', 0)
+                elif chunks:
+                    chunks -= 1
+                    if sorted_chunks and record['key'] in sorted_keys:
+                        next_id = max([next_id] + [item_id + 1 for item_id
+                                                   in record['ids'][-1:]])
+                        yield op, record['key'], None, record
+                        continue
+                for key, item_id, item in cls.iter_snapshot(record, next_id):
+                    next_id = max(next_id, item_id + 1)
+                    yield cls.APPEND, key, item_id, item
+                next_id = max(next_id, record.get('next_id', 0))
+
+    @staticmethod
+    def identity(value):
+        return value
+
+    def open_journal(self):
+        self.journal = open(self.path, 'a', encoding='utf-8')
+        if self.journal.tell() == 0:
+            self.journal.write(self.MAGIC + '\n')
+            self.sync()
+        self.reader = open(self.path, 'rb')
+        self.offset = 0
+
+    @contextlib.contextmanager
+    def locked(self, catch_up=True):
+        """Hold the journal lock, up to date with every other writer"""
+        with self.io_lock:
+            if self.lock_depth:
+                self.lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self.lock_depth -= 1
+                return
+            if fcntl:
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            self.lock_depth = 1
+            try:
+                if catch_up:
+                    self.catch_up()
+                yield
+            finally:
+                self.lock_depth = 0
+                if self.journal and not self.journal.closed:
+                    self.journal.flush()
+                    self.offset = os.fstat(self.journal.fileno()).st_size
+                if fcntl:
+                    fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def guard(self):
+        """Context for a change to the data. Only a synchronous store needs
+        the journal lock to pick ids, a write-behind store must not hold
+        the mutex while its queue is full."""
+        if self.queue is not None:
+            return contextlib.nullcontext()
+        return self.locked()
+
+    def catch_up(self):
+        """Apply the records other writers added since this store last read
+        or wrote the journal"""
+        with self.mutex:
+            try:
+                replaced = (os.stat(self.path).st_ino !=
+                            os.fstat(self.journal.fileno()).st_ino)
+            except FileNotFoundError:
+                replaced = False
+            if replaced:
+                # Compacted or archived by another writer. Its snapshot holds
+                # all the old journal held, so finish reading that and go on
+                # after the snapshot, keeping what is applied here but not
+                # written yet.
+                self.read_new_records(terminate=False)
+                if self.is_archive(self.path):
+                    self.restore_archive(self.path)
+                self.journal.close()
+                self.reader.close()
+                self.open_journal()
+                self.reader.readline()
+                snapshot = json.loads(self.reader.readline())
+                for _ in range(snapshot.get('chunks', 0)):
+                    self.reader.readline()
+                self.offset = self.reader.tell()
+            self.read_new_records()
+
+    def read_new_records(self, terminate=True):
+        self.reader.seek(self.offset)
+        if self.offset == 0:
+            self.reader.readline()
+        for line in self.reader:
+            if not line.endswith(b'\n'):
+                if terminate:
+                    # Terminate a record torn by a crash so the next one
+                    # parses
+                    self.journal.write('\n')
+                    self.journal.flush()
+                break
+            try:
+                record = json.loads(line, object_hook=_decode)
+            except ValueError:
+                continue
+            self.apply(record)
+        self.offset = self.reader.tell()
+
+    def migrate_legacy(self, path, key):
+        data = self.read_legacy(path, key)
+        tmp_path = path + '.migrating'
+        with open(tmp_path, 'w', encoding='utf-8') as journal:
+            journal.write(self.MAGIC + '\n')
+            journal.write(self.dumps(
+                {'op': self.SNAPSHOT, 'value': data}) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        for suffix in self.LEGACY_SUFFIXES:
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def dumps(record):
+        return json.dumps(record, default=_encode, separators=(',', ':'))
+
+    def apply(self, record, decode=True):
+        op = record['op']
+        if op != self.CHUNK:
+            self.record_count += 1
+        if op == self.SET:
+            key = record['key']
+            value = record['value']
+            if decode and key in self.decoders:
+                value = self.decoders[key](value)
+            self.data[key] = value
+            # A list set whole has no item ids, see snapshot_records()
+            self.ids.pop(key, None)
+        elif op == self.APPEND:
+            key = record['key']
+            self.next_id = max(self.next_id, record['id'] + 1)
+            if key in self.skip_keys:
+                return
+            value = record['value']
+            if decode and key in self.decoders:
+                value = self.decoders[key](value)
+            self.data[key].append(value)
+            self.ids.setdefault(key, []).append(record['id'])
+        elif op == self.POP:
+            key = record['key']
+            if key in self.skip_keys:
+                return
+            # Usually the last item, unless another writer appended since
+            index = self.index_of(key, record['id'], record.get('index'))
+            if index is not None:
+                del self.ids[key][index]
+                del self.data[key][index]
+            own_ids = self.own_ids.get(key)
+            if own_ids and record['id'] in own_ids:
+                own_ids.remove(record['id'])
+        elif op == self.REPLACE:
+            key = record['key']
+            if key in self.skip_keys:
+                return
+            index = self.index_of(key, record['id'], record.get('index'))
+            if index is not None:
+                value = record['value']
+                if decode and key in self.decoders:
+                    value = self.decoders[key](value)
+                self.data[key][index] = value
+        elif op == self.SNAPSHOT:
+            self.record_count = 0
+            for key, value in record['value'].items():
+                if not isinstance(value, list):
+                    if key in self.decoders:
+                        value = self.decoders[key](value)
+                    self.data[key] = value
+            for key in list(record['value']) + list(record.get('columns', {})):
+                if isinstance(self.data.get(key), list):
+                    self.data[key] = []
+                    self.ids[key] = []
+            self.apply_items(record)
+            self.next_id = max(self.next_id, record.get('next_id', 0))
+        elif op == self.CHUNK:
+            self.apply_items(record)
+        elif op == self.RESERVE:
+            self.next_id = max(self.next_id, record['next_id'])
+
+    def apply_items(self, record):
+        for key, item_id, item in self.iter_snapshot(record, self.next_id):
+            self.next_id = max(self.next_id, item_id + 1)
+            if key in self.skip_keys:
+                continue
+            if key in self.decoders:
+                item = self.decoders[key](item)
+            self.data.setdefault(key, []).append(item)
+            self.ids.setdefault(key, []).append(item_id)
+
+    def ordered_indexes(self, key, order):
+        """Indexes of the items of the list under key sorted by order(item)
+        and then id, the order iter_values() yields them in"""
+        values = self.data[key]
+        ids = self.ids.get(key, [])
+        return sorted(range(len(values)),
+                      key=lambda index: (order(values[index]), ids[index]))
+
+    def index_of(self, key, item_id, hint=None):
+        """Index of the item with item_id in the list under key, or None.
+        hint is where the item was when the record was written, which it
+        still is unless another writer changed the list since."""
+        ids = self.ids.get(key, [])
+        if hint is not None and 0 <= hint < len(ids) and ids[hint] == item_id:
+            return hint
+        for index in range(len(ids) - 1, -1, -1):
+            if ids[index] == item_id:
+                return index
+        return None
+
+    def write(self, record):
+        with self.mutex:
+            self.apply(record, decode=False)
+        line = self.dumps(record) + '\n'
+        if self.pending is not None:
+            self.pending.append((line, record))
+            return
+        if self.queue is not None:
+            self.enqueue(line, [record])
+            return
+        self.journal.write(line)
+        self.journal.flush()
+        self.unsynced += 1
+        if (self.unsynced >= self.FSYNC_RECORDS or
+                time.monotonic() - self.last_sync >= self.FSYNC_SECONDS):
+            self.sync()
+        self.notify([record])
+
+    def notify(self, records):
+        # Copied, a listener may be removed from another thread meanwhile
+        listeners = list(self.listeners)
+        for record in records:
+            for listener in listeners:
+                listener(record)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Commit every record written inside the block with a single write
+        and fsync. Other writers wait for the whole batch."""
+        if self.pending is not None:
+            yield
+            return
+        if self.queue is not None:
+            self.pending = []
+            try:
+                yield
+            finally:
+                pending, self.pending = self.pending, None
+                if pending:
+                    lines, records = zip(*pending)
+                    self.enqueue(''.join(lines), records)
+            return
+        records = ()
+        try:
+            with self.locked():
+                self.pending = []
+                try:
+                    yield
+                finally:
+                    pending, self.pending = self.pending, None
+                    if pending:
+                        lines, written = zip(*pending)
+                        self.journal.write(''.join(lines))
+                        self.sync()
+                        records = written
+        finally:
+            # Written records are notified even if the block failed
+            self.notify(records)
+
+    def sync(self):
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def set(self, key, value):
+        with self.guard():
+            self.write({'op': self.SET, 'key': key, 'value': value})
+
+    def append(self, key, value):
+        """Add value to the list under key, returning its id"""
+        if self.queue is not None and not self.id_block:
+            self.reserve_ids()
+        with self.guard():
+            if self.queue is not None:
+                item_id = self.id_block[0]
+                self.id_block = self.id_block[1:]
+            else:
+                item_id = self.next_id
+            self.write({'op': self.APPEND, 'key': key, 'id': item_id,
+                        'value': value})
+            self.own_ids.setdefault(key, []).append(item_id)
+            return item_id
+
+    def reserve_ids(self):
+        """Take a block of ids no other writer will use, so a write-behind
+        store can number entries without waiting for the journal lock"""
+        with self.locked():
+            start = self.next_id
+            self.journal.write(self.dumps(
+                {'op': self.RESERVE, 'next_id': start + self.ID_BLOCK}) + '\n')
+            with self.mutex:
+                self.next_id = start + self.ID_BLOCK
+            self.id_block = range(start, start + self.ID_BLOCK)
+
+    def pop(self, key, item_id=None, index=None):
+        """Remove the item with item_id from the list under key, by default
+        the last item this store appended under key, or the last item if it
+        appended none. index is where the item is expected, see index_of().
+        Returns the value removed."""
+        with self.guard():
+            with self.mutex:
+                if item_id is None:
+                    if self.own_ids.get(key):
+                        item_id = self.own_ids[key][-1]
+                    elif self.data[key]:
+                        item_id = self.ids[key][-1]
+                    else:
+                        raise IndexError('pop from empty ' + key)
+                index = self.index_of(key, item_id, index)
+                if index is None:
+                    raise IndexError('no item {} in {}'.format(item_id, key))
+                value = self.data[key][index]
+            self.write({'op': self.POP, 'key': key, 'id': item_id,
+                        'index': index})
+            return value
+
+    def replace(self, key, item_id, value, index=None):
+        """Replace the item with item_id in the list under key with value,
+        returning the value it replaced. The record holds both, so the change
+        can be undone by replacing it back."""
+        with self.guard():
+            with self.mutex:
+                index = self.index_of(key, item_id, index)
+                if index is None:
+                    raise IndexError('no item {} in {}'.format(item_id, key))
+                previous = self.data[key][index]
+            self.write({'op': self.REPLACE, 'key': key, 'id': item_id,
+                        'index': index, 'value': value,
+                        'previous': previous})
+            return previous
+
+    def compact(self):
+        """Rewrite the journal as a snapshot, see snapshot_records()"""
+        self.flush()
+        with self.locked():
+            self.write_snapshot()
+
+    def start_write_behind(self, interval=None, batch_records=None,
+                           max_pending=None):
+        """Write records from a background thread from now on"""
+        if self.queue is not None:
+            return
+        self.queue = queue.Queue(max_pending or self.MAX_PENDING)
+        self.writer = threading.Thread(
+                target=self.write_behind, name='journal-writer',
+                args=(interval or self.FLUSH_SECONDS,
+                      batch_records or self.FLUSH_RECORDS),
+                daemon=True)
+        self.writer.start()
+        # Written for certain when the interpreter exits, eg. on a signal
+        atexit.register(self.close)
+
+    def enqueue(self, text, records):
+        # Blocks while the queue is full, writers can not outrun the disk
+        self.queue.put((text, records))
+        if self.write_error is not None:
+            error, self.write_error = self.write_error, None
+            raise error
+
+    def write_behind(self, interval, batch_records):
+        """Background thread body. Waits for a record, then collects more
+        for up to interval seconds or batch_records records and writes them
+        all with one write and fsync under the journal lock, then notifies
+        the listeners of them, so neither disk nor listeners hold up the
+        caller. flush() queues an Event that is set once everything before
+        it is written."""
+        lines = []
+        records = []
+        while True:
+            item = self.queue.get()
+            waiters = []
+            deadline = time.monotonic() + interval
+            while True:
+                if item is None or isinstance(item, threading.Event):
+                    waiters.append(item)
+                    break
+                lines.append(item[0])
+                records.extend(item[1])
+                if len(lines) >= batch_records:
+                    break
+                try:
+                    item = self.queue.get(
+                            timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+            if lines:
+                try:
+                    self.write_lines(lines)
+                except Exception as error:
+                    # Kept to retry with the next flush, raised by the
+                    # next write or flush
+                    self.write_error = error
+                else:
+                    lines = []
+                    written, records = records, []
+                    try:
+                        self.notify(written)
+                    except Exception as error:
+                        # Written all the same, raised like a write error
+                        self.write_error = error
+            for waiter in waiters:
+                if waiter is None:
+                    return
+                waiter.set()
+
+    def write_lines(self, lines):
+        start = time.monotonic()
+        text = ''.join(lines)
+        with self.locked():
+            self.journal.write(text)
+            self.sync()
+        self.metrics.add(text.count('\n'), time.monotonic() - start)
+
+    def flush(self):
+        """Wait until every record written so far is on disk"""
+        if self.queue is None:
+            return
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+        if self.write_error is not None:
+            error, self.write_error = self.write_error, None
+            raise error
+
+    def stop_write_behind(self):
+        if self.queue is None:
+            return
+        atexit.unregister(self.close)
+        try:
+            self.flush()
+        finally:
+            self.queue.put(None)
+            self.writer.join()
+            self.queue = None
+            self.writer = None
+            self.id_block = range(0)
+
+    @classmethod
+    def create_many(cls, items):
+        """Write a new journal holding data for every (path, data) in items,
+        leaving the journals that exist alone. Each journal is synced as it
+        is created and the directories holding them once at the end.
+        Returns the paths created."""
+        created = []
+        try:
+            for path, data in items:
+                if os.path.exists(path) or cls.is_legacy(path):
+                    continue
+                if cls.create_file(path, cls.MAGIC + '\n' + cls.dumps(
+                        {'op': cls.SNAPSHOT, 'value': data}) + '\n'):
+                    created.append(path)
+        finally:
+            for directory in {os.path.dirname(path) for path in created}:
+                cls.sync_directory(directory)
+        return created
+
+    @staticmethod
+    def create_file(path, text):
+        """Write a synced file holding text at path unless a file is there,
+        returning whether it was created. It only appears once written."""
+        tmp_path = path + '.provisioning'
+        with open(tmp_path, 'w', encoding='utf-8') as tmp:
+            tmp.write(text)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        try:
+            # Unlike a rename, fails if the file was created meanwhile
+            os.link(tmp_path, path)
+        except FileExistsError:
+            return False
+        except OSError:
+            # Hard links are not supported everywhere, create it exclusively
+            # instead, where it is seen while being written
+            try:
+                with open(path, 'x', encoding='utf-8') as created:
+                    created.write(text)
+                    created.flush()
+                    os.fsync(created.fileno())
+            except FileExistsError:
+                return False
+        finally:
+            os.remove(tmp_path)
+        return True
+
+    @staticmethod
+    def sync_directory(directory):
+        """Sync the entries of directory, so files created in it survive a
+        crash. Not possible on every platform."""
+        try:
+            fd = os.open(directory or '.', os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    @classmethod
+    def archive(cls, path, skeleton, summarize, legacy_key=None,
+                decoders=None, orders=None):
+        """Replace the journal at path by a compressed archive of it.
+
+        The archive starts with the JSON summary summarize(data) returns,
+        uncompressed, so it can be read without unpacking the journal, see
+        read_summary(). The journal is compacted into a snapshot and
+        gzipped. The file keeps its mtime. Returns False if path already
+        is an archive."""
+        with open(cls.lock_path(path), 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if cls.is_archive(path):
+                return False
+            stat = os.stat(path)
+            store = cls(path, skeleton, legacy_key, readonly=True,
+                        decoders=decoders, orders=orders)
+            tmp_path = path + '.archiving'
+            try:
+                with open(tmp_path, 'wb') as archive:
+                    archive.write((cls.ARCHIVE_MAGIC + '\n').encode())
+                    archive.write((json.dumps(
+                        summarize(store.data), default=_encode) +
+                        '\n').encode())
+                    with gzip.GzipFile(
+                            fileobj=archive, mode='wb', mtime=0,
+                            compresslevel=cls.ARCHIVE_COMPRESSLEVEL
+                            ) as journal:
+                        journal.write((cls.MAGIC + '\n').encode())
+                        for record in store.snapshot_records():
+                            journal.write((cls.dumps(record) +
+                                           '\n').encode())
+                    archive.flush()
+                    os.fsync(archive.fileno())
+            except Exception:
+                os.remove(tmp_path)
+                raise
+            os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            for suffix in cls.LEGACY_SUFFIXES[1:]:
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+            os.replace(tmp_path, path)
+        return True
+
+    @classmethod
+    def read_summary(cls, path):
+        """The summary an archive starts with, None for a journal"""
+        with open(path, 'rb') as archive:
+            if archive.readline().rstrip(b'\n') != cls.ARCHIVE_MAGIC.encode():
+                return None
+            return json.loads(archive.readline(), object_hook=_decode)
+
+    def restore_archive(self, path):
+        """Unpack an archive back into a journal that can be written"""
+        tmp_path = path + '.restoring'
+        with self.open_records(path) as archived, \
+                open(tmp_path, 'wb') as journal:
+            while True:
+                chunk = archived.read(1024 * 1024)
+                if not chunk:
+                    break
+                journal.write(chunk)
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(tmp_path, path)
+
+    def snapshot_records(self):
+        """Yield the records holding the data as it is: a snapshot record of
+        the values, with every list left empty, followed by chunk records
+        holding the list items CHUNK_ITEMS at a time. Readers stream the
+        items chunk by chunk, so memory does not grow with the length of a
+        list.
+
+        Chunks of tuples are packed column by column, so each field name and
+        record key is written once rather than once per item. Ids are kept,
+        so entries are numbered the same before and after compaction. Lists
+        that were set whole rather than appended to have no ids and stay in
+        the snapshot record."""
+        values = {}
+        lists = []
+        for key, value in self.data.items():
+            if isinstance(value, list) and (
+                    len(self.ids.get(key, [])) == len(value)):
+                values[key] = []
+                lists.append(key)
+            else:
+                values[key] = value
+        # Writers that catch up with the snapshot skip its chunks
+        chunks = sum(-(-len(self.data[key]) // self.CHUNK_ITEMS)
+                     for key in lists)
+        snapshot = {'op': self.SNAPSHOT, 'value': values, 'chunks': chunks,
+                    'next_id': self.next_id}
+        ordered = [key for key in lists if key in self.orders]
+        if ordered:
+            # Readers need not check the order of their chunks, see scan()
+            snapshot['sorted'] = ordered
+        yield snapshot
+        for key in lists:
+            items = self.data[key]
+            ids = self.ids.get(key, [])
+            if key in self.orders:
+                # Read back in a single run, see iter_values()
+                indexes = self.ordered_indexes(key, self.orders[key])
+                items = [items[index] for index in indexes]
+                ids = [ids[index] for index in indexes]
+            for start in range(0, len(items), self.CHUNK_ITEMS):
+                chunk = items[start:start + self.CHUNK_ITEMS]
+                record = {'op': self.CHUNK, 'key': key,
+                          'ids': ids[start:start + self.CHUNK_ITEMS]}
+                if all(isinstance(item, tuple) for item in chunk):
+                    record['columns'] = [list(field)
+                                         for field in zip(*chunk)]
+                else:
+                    record['values'] = chunk
+                yield record
+
+    def snapshot_lines(self):
+        return [self.dumps(record) + '\n'
+                for record in self.snapshot_records()]
+
+    def write_snapshot(self):
+        tmp_path = self.path + '.compacting'
+        with open(tmp_path, 'w', encoding='utf-8') as journal:
+            journal.write(self.MAGIC + '\n')
+            for record in self.snapshot_records():
+                journal.write(self.dumps(record) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        self.journal.close()
+        self.reader.close()
+        os.replace(tmp_path, self.path)
+        self.journal = open(self.path, 'a', encoding='utf-8')
+        self.reader = open(self.path, 'rb')
+        self.record_count = 0
+
+    def close(self):
+        self.stop_write_behind()
+        if self.journal and not self.journal.closed:
+            self.sync()
+            self.journal.close()
+        for handle in (self.reader, self.lock_file):
+            if handle:
+                handle.close()
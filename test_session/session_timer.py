@@ -1,25 +1,100 @@
 import datetime
+import re
+import time
 
 
 class DurationTimer:
-    def __init__(self, initial_duration=datetime.timedelta(seconds=0)):
-        self.total_duration = 0
-        self.initial_duration = initial_duration
-        self.start_time = datetime.datetime.now().replace(microsecond=0)
-        self.pause_intervals = []
-
-    def pause(self):
-        self.pause_start = datetime.datetime.now().replace(microsecond=0)
+    """Active session time.
+
+    Time is measured with the monotonic clock, so wall clock changes such as
+    NTP adjustments do not affect it. The time counted before the current
+    run is kept as a running total, so reading the duration is O(1) however
+    often the session was paused.
+    """
+
+    NS_PER_SECOND = 10 ** 9
+
+    def __init__(self, initial_duration=datetime.timedelta(seconds=0),
+                 clock=time.monotonic_ns, paused=False):
+        self.clock = clock
+        self.total_ns = (initial_duration // datetime.timedelta(
+            microseconds=1)) * 1000
+        self.paused = paused
+        self.start_ns = clock()
+        self.last_activity_ns = self.start_ns
+
+    def pause(self, ago=0):
+        """Stop counting, as of ago seconds before now"""
+        if not self.paused:
+            end_ns = self.clock() - int(ago * self.NS_PER_SECOND)
+            self.total_ns += max(end_ns - self.start_ns, 0)
+            self.paused = True
         return True
 
     def unpause(self):
-        self.pause_interval = datetime.datetime.now().replace(microsecond=0)- self.pause_start
-        self.pause_intervals.append(self.pause_interval)
+        if self.paused:
+            self.start_ns = self.clock()
+            self.paused = False
         return False
 
+    def touch(self):
+        """Record activity, returning the seconds since the last activity"""
+        now_ns = self.clock()
+        idle = (now_ns - self.last_activity_ns) / self.NS_PER_SECOND
+        self.last_activity_ns = now_ns
+        return idle
+
     def get_duration(self):
-        self.total_duration = datetime.datetime.now().replace(microsecond=0)- self.start_time
-        for interval in self.pause_intervals:
-            self.total_duration -= interval
+        total_ns = self.total_ns
+        if not self.paused:
+            total_ns += self.clock() - self.start_ns
+        return datetime.timedelta(seconds=total_ns // self.NS_PER_SECOND)
+
+
+# Timebox formats: '90m', '1h30', '1h 30min', '2 hours', '45' (minutes)
+_DURATION_UNITS = re.compile(
+        r'^(?:(\d+)\s*h(?:ours?|rs?)?)?\s*(?:(\d+)\s*(?:m(?:in(?:ute)?s?)?)?)?$',
+        re.IGNORECASE)
+
+
+def parse_duration(text):
+    """Seconds in a timebox such as '90m', '1h30' or '01:30:00', or None
+    if text is not a duration"""
+    if text is None:
+        return None
+    text = text.strip()
+    if not text:
+        return None
+    if ':' in text:
+        parts = text.split(':')
+        if len(parts) > 3 or not all(part.isdigit() for part in parts):
+            return None
+        # H:MM or H:MM:SS
+        parts = [int(part) for part in parts] + [0] * (3 - len(parts))
+        return parts[0] * 3600 + parts[1] * 60 + parts[2]
+    match = _DURATION_UNITS.match(text)
+    if not match or not any(match.groups()):
+        return None
+    hours, minutes = match.groups()
+    return int(hours or 0) * 3600 + int(minutes or 0) * 60
+
+
+def as_seconds(value):
+    """Whole seconds of a duration saved as a timedelta, a timebox string or
+    a number. Strings that are not durations are returned as they are."""
+    if isinstance(value, datetime.timedelta):
+        return int(value.total_seconds())
+    if isinstance(value, str):
+        seconds = parse_duration(value)
+        return value if seconds is None else seconds
+    if value is None:
+        return None
+    return int(value)
+
 
-        return self.total_duration + self.initial_duration
+def format_duration(seconds):
+    if seconds is None:
+        return '-'
+    if isinstance(seconds, str):
+        return seconds
+    return str(datetime.timedelta(seconds=int(seconds)))
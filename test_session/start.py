@@ -1,7 +1,73 @@
+import sys
+from .instrumentation import Instrumentation
 from .test_session_recorder import TestSessionRecorder
 
-def main():
-    TestSessionRecorder().cmdloop(
-            TestSessionRecorder.print_header('Test Session Recorder', True))
+
+def parse_args(argv):
+    # argparse is only needed, and imported, for the non-interactive modes
+    import argparse
+    parser = argparse.ArgumentParser(
+            prog='testrecorder',
+            description='Interactive CLI test session recorder')
+    parser.add_argument(
+            '--profile', nargs='?', const=Instrumentation.DEFAULT_PATH,
+            metavar='FILE',
+            help='Write timings of commands, storage and reports to FILE, '
+                 'as Prometheus text if it ends in .prom, else as JSON '
+                 '(default {}, or set {})'.format(
+                     Instrumentation.DEFAULT_PATH,
+                     Instrumentation.PROFILE_ENV))
+    parser.add_argument(
+            '--cprofile', metavar='FILE',
+            help='Write a cProfile capture of the whole run to FILE '
+                 '(or set {})'.format(Instrumentation.CPROFILE_ENV))
+    subparsers = parser.add_subparsers(dest='command')
+    ingest = subparsers.add_parser(
+            'ingest', help='Record session commands read from a file or stdin')
+    ingest.add_argument('session_name')
+    ingest.add_argument('file', nargs='?', type=argparse.FileType('r'),
+                        default=sys.stdin,
+                        help='File to read, stdin when not given')
+    serve = subparsers.add_parser(
+            'serve', help='Run a session server recorders mirror their '
+                          'sessions to, see ' + TestSessionRecorder.REMOTE_ENV)
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8765)
+    serve.add_argument('--dir', default=TestSessionRecorder.SESSION_DIR,
+                       help='Directory to store the sessions in (default '
+                            '%(default)s)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parse_args(argv) if argv else None
+    instrumentation = Instrumentation.from_settings(
+            args.profile if args else None, args.cprofile if args else None)
+    if instrumentation:
+        instrumentation.start()
+    try:
+        if args is None or args.command is None:
+            recorder = TestSessionRecorder()
+            try:
+                recorder.cmdloop(TestSessionRecorder.print_header(
+                    'Test Session Recorder', True))
+            finally:
+                recorder.close()
+        elif args.command == 'ingest':
+            try:
+                TestSessionRecorder().ingest_session(args.session_name,
+                                                     args.file)
+            finally:
+                if args.file is not sys.stdin:
+                    args.file.close()
+        elif args.command == 'serve':
+            from .session_server import serve
+            serve(args.dir, args.host, args.port)
+    finally:
+        # After the recorder closed, so its last writes are counted
+        if instrumentation:
+            instrumentation.stop()
 
 if __name__ == '__main__': main()
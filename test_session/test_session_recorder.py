@@ -1,11 +1,22 @@
 import time
 import cmd
-import os
+import collections
 import datetime
-import subprocess
-from .report_generator import SessionReportGenerator
+import os
+import shutil
+import signal
+import shlex
+import fnmatch
+import sys
 from .print_colour import Printer
+from .attachments import AttachmentStore
+from .log_entry import EntryKind, LogEntry
 from .session import Session
+from .session_store import JournalStore
+from .session_timer import format_duration
+from .session_catalog import SessionCatalog
+from .search_index import SearchIndex
+from .analytics import SessionAnalytics
 
 
 class TestSessionRecorder(cmd.Cmd):
@@ -15,6 +26,24 @@ class TestSessionRecorder(cmd.Cmd):
     REPORTS_DIR = os.path.expanduser("~") + '/reports'
     # Prompts
     DEFAULT_PROMPT = '>> '
+    # Report options
+    REPORT_ALL = '--all'
+    REPORT_GLOB = '--glob'
+    REPORT_WATCH = '--watch'
+    HTML_FORMAT = 'html'
+    # Name of the single file many sessions are exported to
+    EXPORT_FILENAME = 'sessions'
+    # Sessions unchanged for this many days are archived on quit when the
+    # environment variable sets it, 0 turns it off
+    ARCHIVE_AFTER_DAYS = 0
+    ARCHIVE_DAYS_ENV = 'TESTRECORDER_ARCHIVE_DAYS'
+    # Sessions archived on quit at most, the rest wait for the next quit
+    ARCHIVE_ON_QUIT = 20
+    # URL of a session server sessions are mirrored to, see remote.py
+    REMOTE_ENV = 'TESTRECORDER_REMOTE'
+    # Entries shown when a session is opened, show lists the rest
+    OPEN_TAIL = 20
+    MORE_PROMPT = '-- More -- (Enter for the next page, q to stop) '
 
     # Global Values
     prompt = DEFAULT_PROMPT
@@ -23,18 +52,81 @@ class TestSessionRecorder(cmd.Cmd):
     'interactive command line format. Sessions can be viewed '
     'later or outputted to an HTML report'
     session = None
+    _catalog = None
+    _search_index = None
+    _remote = None
+    remote_store = None
 
-    try:
-        rows, columns = subprocess.check_output(
-                ['stty', 'size']).decode('utf-8').split()
-        columns = int(columns)
-    except:
-        rows = 0
-        columns = 80
+    columns, rows = shutil.get_terminal_size()
 
     def preloop(self):
         if not os.path.exists(os.path.join(self.SESSION_DIR)):
             os.makedirs(self.SESSION_DIR)
+        if hasattr(signal, 'SIGWINCH'):
+            signal.signal(signal.SIGWINCH, TestSessionRecorder.resize)
+        for name in ('SIGTERM', 'SIGHUP'):
+            if hasattr(signal, name):
+                signal.signal(getattr(signal, name),
+                              TestSessionRecorder.terminate)
+
+    @staticmethod
+    def terminate(signum, frame):
+        # Unwind the command loop so close() writes the open session
+        raise SystemExit(128 + signum)
+
+    def close(self):
+        """Write out and close a session left open, eg. on a signal"""
+        if self.session:
+            self.print_failures(self.session.close())
+            self.catalog.update(self.session.session_name,
+                                self.session.store.data)
+            self.search_index.commit()
+            self.session = None
+        self.unwatch_remote()
+
+    @staticmethod
+    def print_failures(messages):
+        for message in messages:
+            Printer.print(message, Printer.WARNING)
+
+    @classmethod
+    def resize(cls, signum=None, frame=None):
+        cls.columns, cls.rows = shutil.get_terminal_size()
+
+    @property
+    def catalog(self):
+        if self._catalog is None:
+            self._catalog = SessionCatalog(self.SESSION_DIR)
+        return self._catalog
+
+    @property
+    def search_index(self):
+        if self._search_index is None:
+            self._search_index = SearchIndex(self.SESSION_DIR)
+        return self._search_index
+
+    @property
+    def remote(self):
+        """Client of the session server named in the environment, None when
+        sessions are only kept locally"""
+        if self._remote is None and os.environ.get(self.REMOTE_ENV):
+            from .remote import RemoteClient
+            self._remote = RemoteClient.from_settings()
+        return self._remote
+
+    def watch_remote(self, session):
+        """Mirror everything session records from now on to the session
+        server, if there is one"""
+        if self.remote:
+            from .remote import RemoteStore
+            self.remote_store = RemoteStore(self.remote, session)
+
+    def unwatch_remote(self):
+        if self.remote_store:
+            if not self.remote_store.close():
+                print('Session server unreachable, run sync to upload the '
+                      'changes queued')
+            self.remote_store = None
 
     def do_new(self, session_name):
         """new [session_name]
@@ -57,10 +149,20 @@ class TestSessionRecorder(cmd.Cmd):
             if self.check_for_session(session_name):
                 TestSessionRecorder.print_header(
                         'Session Opened - ' + session_name)
-                self.show_session(
-                        Session.get_session_data(
-                            session_name, self.SESSION_DIR))
+                # The session is loaded once, for recording and for showing
                 self.session = Session(session_name, self.SESSION_DIR)
+                session_data = self.session.store.data
+                log = session_data[Session.LOG_KEY]
+                # Numbered as show and edit number them
+                indexes = self.session.log_indexes()
+                start = max(0, len(indexes) - self.OPEN_TAIL)
+                self.show_session(session_data,
+                                  ((number, log[index]) for number, index in
+                                   enumerate(indexes[start:], start + 1)),
+                                  earlier=start)
+                self.session.store.start_write_behind()
+                self.search_index.watch(self.session)
+                self.watch_remote(self.session)
                 self.prompt = Session.SESSION_PROMPT
             else:
                 # Session does not exist so start a new one
@@ -69,79 +171,329 @@ class TestSessionRecorder(cmd.Cmd):
     def complete_open(self, text, line, begidx, endidx):
         return self.autocomplete_sessions(text, line, begidx, endidx)
 
-    def do_show(self, session_name):
-        """show [session_name]
-        Show contents of test session_name"""
-        self.show_session(Session.get_session_data(
-            session_name, self.SESSION_DIR))
+    def do_show(self, show_args):
+        """show [session_name] --tail N --since [date] --bugs-only --no-pager
+        Show contents of test session_name, optionally only its last N
+        entries, those from a date (YYYY-mm-dd [HH:MM:SS]) on or its bugs.
+        Long logs are shown a page at a time"""
+        args = self.parse_args(self.show_parser(), show_args)
+        if args is None:
+            return
+        session_name = ' '.join(args.session_name)
+        if not self.check_for_session(session_name):
+            print('There is no test session with that name')
+            return
+        header = Session.get_session_header(session_name, self.SESSION_DIR)
+        entries = self.filter_entries(
+                enumerate(Session.iter_log(session_name, self.SESSION_DIR),
+                          1),
+                tail=args.tail, since=args.since, bugs_only=args.bugs_only)
+        pager = not args.no_pager and sys.stdin.isatty() and (
+                sys.stdout.isatty())
+        self.show_session(header, entries, pager=pager)
 
     def complete_show(self, text, line, begidx, endidx):
         return self.autocomplete_sessions(text, line, begidx, endidx)
 
+    @staticmethod
+    def show_parser():
+        import argparse
+        parser = argparse.ArgumentParser(prog='show', add_help=False)
+        parser.add_argument('session_name', nargs='+')
+        parser.add_argument('--tail', type=int, metavar='N')
+        parser.add_argument('--since', type=TestSessionRecorder.parse_epoch)
+        parser.add_argument('--bugs-only', action='store_true')
+        parser.add_argument('--no-pager', action='store_true')
+        return parser
+
+    @staticmethod
+    def filter_entries(entries, tail=None, since=None, bugs_only=False):
+        """Lazily filter (number, log entry) pairs, only holding the last
+        tail entries in memory when a tail is asked for"""
+        if since is not None:
+            entries = (item for item in entries if item[1].epoch >= since)
+        if bugs_only:
+            entries = (item for item in entries if item[1].bug)
+        if tail is not None:
+            entries = collections.deque(entries, maxlen=max(0, tail))
+        return entries
+
     def do_list(self, line):
-        """list
-        List all test sessions"""
-        all_sessions = os.listdir(self.SESSION_DIR)
+        """list --sort [name|duration|overrun]
+        List all test sessions, longest or most over their timebox first
+        when sorted by duration or overrun"""
+        args = line.split()
+        sort = 'name'
+        if args:
+            if (len(args) != 2 or args[0] != '--sort' or
+                    args[1] not in SessionCatalog.SORT_ORDERS):
+                print('Please sort by one of: ' +
+                      ', '.join(SessionCatalog.SORT_ORDERS))
+                return
+            sort = args[1]
+        all_sessions = self.catalog.sessions(sort)
         if len(all_sessions) > 0:
             TestSessionRecorder.print_header('Test Sessions')
             for session in all_sessions:
-                print(session, end='')
-                create_time = time.ctime(os.path.getmtime(
-                    os.path.join(self.SESSION_DIR, session)))
-                print(' '*(self.columns-len(session)-len(create_time))
-                      + create_time)
+                print(session['name'], end='')
+                details = time.ctime(session['mtime'])
+                if session['archived']:
+                    details = 'archived  ' + details
+                if sort != 'name':
+                    details = format_duration(session[sort]) + '  ' + details
+                print(' '*(self.columns-len(session['name'])-len(details))
+                      + details)
         else:
             print('There are no recorded sessions')
 
     def do_report(self, report_args):
-        """report [report_args]
-        Generate an HTML report for [session_name] -f [optional_filename]"""
-        args = report_args.split('-f')
-        if len(args) == 0:
+        """report [session_name] -f [optional_filename] --format [format]
+        Generate an HTML report, or an export as jsonl, csv or md, for
+        session_name or for many sessions with --all or --glob [pattern].
+        Exports of many sessions are written to a single file. With --watch
+        the HTML report of session_name is kept up to date as it is recorded,
+        eg. from a second terminal, until Ctrl-C"""
+        args = self.parse_args(self.report_parser(), report_args)
+        if args is None:
+            return
+        session_name = ' '.join(args.session_name)
+        if args.all or args.glob:
+            pattern = args.glob if args.glob else '*'
+            if args.format == self.HTML_FORMAT:
+                self.report_batch(pattern)
+            else:
+                self.export_batch(pattern, args.format, args.filename)
+        elif not session_name:
             print('Please enter a valid session name')
-        elif len(args) >= 1:
-            session_name = args[0].strip()
-            if self.check_for_session(session_name):
-                generator = SessionReportGenerator(self.REPORTS_DIR,
-                                                   'test_session')
-                session_data = Session.get_session_data(
-                        session_name, self.SESSION_DIR)
-                log = session_data[Session.LOG_KEY]
-                test_log = []
-                bug_log = []
-                for entry in log:
-                    if entry['bug']:
-                        bug_log.append(entry['date'] + ' ' + entry['entry'])
-                    else:
-                        test_log.append(entry['date'] + ' ' + entry['entry'])
-                session_data[Session.BUG_KEY] = bug_log
-                session_data[Session.LOG_KEY] = test_log
-                if len(args) == 2:
-                    filename = args[1].strip()
-                    result = generator.generate_report(
-                           session_name, filename, **session_data)
-                else:
-                    result = generator.generate_report(
-                                session_name, **session_data)
-                if result:
-                    print('Report sucessfully generated')
-                else:
-                    print('Report failed to generate')
+        elif not self.check_for_session(session_name):
+            print('Session name not found')
+        elif args.format == self.HTML_FORMAT:
+            # jinja2 is only imported once a report is asked for
+            from .report_generator import SessionReportGenerator
+            generator = SessionReportGenerator(self.REPORTS_DIR,
+                                               'test_session')
+            if args.watch:
+                self.watch_report(generator, session_name, args.filename)
             else:
-                print('Session name not found')
+                self.print_report_result(generator.generate_session_report(
+                    session_name, self.SESSION_DIR, args.filename))
         else:
-            print('Invalid report arguments')
+            self.print_report_result(self.export(
+                [session_name], args.format, args.filename or session_name))
+
+    @staticmethod
+    def report_parser():
+        import argparse
+        from .exporters import EXPORTERS
+        parser = argparse.ArgumentParser(prog='report', add_help=False)
+        parser.add_argument('session_name', nargs='*')
+        parser.add_argument('-f', dest='filename')
+        parser.add_argument('--format', default=TestSessionRecorder.HTML_FORMAT,
+                            choices=[TestSessionRecorder.HTML_FORMAT] +
+                            list(EXPORTERS))
+        parser.add_argument(TestSessionRecorder.REPORT_ALL,
+                            action='store_true')
+        parser.add_argument(TestSessionRecorder.REPORT_GLOB)
+        parser.add_argument(TestSessionRecorder.REPORT_WATCH,
+                            action='store_true')
+        return parser
+
+    def watch_report(self, generator, session_name, filename):
+        print('Watching ' + session_name + ', press Ctrl-C to stop')
+        updates = []
+
+        def on_update(result):
+            # Only the first result and failures are worth a line
+            if not updates or not result:
+                self.print_report_result(result)
+            updates.append(result)
+        try:
+            generator.watch(session_name, self.SESSION_DIR, filename,
+                            on_update=on_update)
+        except KeyboardInterrupt:
+            print()
+        print('Stopped watching after {} updates'.format(len(updates)))
+
+    @staticmethod
+    def print_report_result(result):
+        if result:
+            print('Report sucessfully generated')
+        else:
+            print('Report failed to generate')
+
+    def export(self, session_names, format_name, filename):
+        from .exporters import EXPORTERS, export_sessions
+        if os.sep in filename:
+            return False
+        if not os.path.exists(self.REPORTS_DIR):
+            os.makedirs(self.REPORTS_DIR)
+        return export_sessions(
+                format_name, session_names, self.SESSION_DIR,
+                os.path.join(self.REPORTS_DIR,
+                             filename + EXPORTERS[format_name].EXTENSION))
+
+    def export_batch(self, pattern, format_name, filename):
+        session_names = fnmatch.filter(self.catalog.complete(''), pattern)
+        if not session_names:
+            print('No sessions match ' + pattern)
+            return
+        if self.export(session_names, format_name,
+                       filename or self.EXPORT_FILENAME):
+            print('{} sessions exported'.format(len(session_names)))
+        else:
+            print('Export failed')
+
+    def report_batch(self, pattern):
+        session_names = fnmatch.filter(self.catalog.complete(''), pattern)
+        if not session_names:
+            print('No sessions match ' + pattern)
+            return
+        from .batch_report import generate_reports
+        stats = generate_reports(session_names, self.SESSION_DIR,
+                                 self.REPORTS_DIR, 'test_session')
+        print(stats)
+        for session_name in stats.failed:
+            print('Report failed to generate: ' + session_name)
 
     def complete_report(self, text, line, begidx, endidx):
         return self.autocomplete_sessions(text, line, begidx, endidx)
 
+    def do_search(self, search_args):
+        """search [query] --bugs --area [area] --since [date] --until [date]
+        Search all test sessions for entries containing every word of
+        query, optionally only bugs, sessions covering a test area or
+        entries between dates (YYYY-mm-dd [HH:MM:SS])"""
+        args = self.parse_args(self.search_parser(), search_args)
+        if args is None:
+            return
+        results = self.search_index.search(
+                ' '.join(args.query), bugs_only=args.bugs, since=args.since,
+                until=args.until, area=args.area)
+        if not results:
+            print('No matching session entries')
+            return
+        TestSessionRecorder.print_header('Search Results')
+        for session_name, field, epoch, text in results:
+            Printer.print(session_name + ' ', end='')
+            if field == SearchIndex.BUG_FIELD:
+                Printer.print(LogEntry(epoch, EntryKind.BUG, text).date +
+                              ' (BUG)' + text, Printer.WARNING)
+            elif field == SearchIndex.LOG_FIELD:
+                print(LogEntry(epoch, EntryKind.NOTE, text).date + ' ' + text)
+            else:
+                print(field.capitalize() + ': ' + text)
+
+    @staticmethod
+    def search_parser():
+        import argparse
+        parser = argparse.ArgumentParser(prog='search', add_help=False)
+        parser.add_argument('query', nargs='+')
+        parser.add_argument('--bugs', action='store_true')
+        parser.add_argument('--area')
+        parser.add_argument('--since', type=TestSessionRecorder.parse_epoch)
+        parser.add_argument('--until', type=TestSessionRecorder.parse_epoch)
+        return parser
+
+    @staticmethod
+    def parse_epoch(date):
+        return int(datetime.datetime.fromisoformat(date).timestamp())
+
+    @staticmethod
+    def filter_parser(prog):
+        import argparse
+        parser = argparse.ArgumentParser(prog=prog, add_help=False)
+        parser.add_argument('pattern', nargs='?')
+        parser.add_argument('--area')
+        parser.add_argument('--since', type=TestSessionRecorder.parse_epoch)
+        parser.add_argument('--until', type=TestSessionRecorder.parse_epoch)
+        return parser
+
+    def parse_filters(self, prog, filter_args):
+        args = self.parse_args(self.filter_parser(prog), filter_args)
+        return None if args is None else vars(args)
+
+    @staticmethod
+    def parse_args(parser, line):
+        """The arguments in line parsed by parser, or None once the error
+        is printed"""
+        try:
+            words = shlex.split(line)
+        except ValueError as error:
+            # eg. an unmatched quote, report O'Brien
+            print('Invalid arguments: {}, quote names holding quotes or '
+                  'spaces'.format(error))
+            return None
+        try:
+            return parser.parse_args(words)
+        except SystemExit:
+            # argparse printed the error
+            return None
+
+    def do_stats(self, stats_args):
+        """stats [pattern] --area [area] --since [date] --until [date]
+        Show totals across all test sessions or those matching a name
+        pattern, test area or last saved between dates"""
+        filters = self.parse_filters('stats', stats_args)
+        if filters is None:
+            return
+        stats = SessionAnalytics(self.catalog).stats(**filters)
+        if not stats['sessions']:
+            print('There are no matching sessions')
+            return
+        TestSessionRecorder.print_header('Session Statistics')
+        for label, value in [
+                ('Sessions', stats['sessions']),
+                ('Total duration', format_duration(
+                    stats['total_duration'])),
+                ('Mean duration', format_duration(
+                    stats['mean_duration'])),
+                ('Bugs', stats['bugs']),
+                ('Bugs per hour', '{:.2f}'.format(stats['bugs_per_hour'])),
+                ('Entries', stats['entries']),
+                ('Entries per session', '{:.1f}'.format(
+                    stats['entries_per_session'])),
+                ('Over timebox', '{} of {} timeboxed, {} over'.format(
+                    stats['overrun_sessions'], stats['timeboxed'],
+                    format_duration(stats['total_overrun'])))]:
+            Printer.print(label + ': ', end='')
+            print(value)
+        Printer.print('Time per test area:')
+        for area, totals in stats['areas'].items():
+            print('- {}: {} ({} sessions)'.format(
+                area, format_duration(totals['duration']),
+                totals['sessions']))
+
+    def do_summary(self, summary_args):
+        """summary [pattern] --area [area] --since [date] --until [date]
+        Show duration, timebox overrun, bugs and entries per test session"""
+        filters = self.parse_filters('summary', summary_args)
+        if filters is None:
+            return
+        rows = SessionAnalytics(self.catalog).summaries(**filters)
+        if not rows:
+            print('There are no matching sessions')
+            return
+        TestSessionRecorder.print_header('Session Summary')
+        row_format = '{:<30} {:>10} {:>10} {:>10} {:>6} {:>8}'
+        Printer.print(row_format.format('Session', 'Duration', 'Timebox',
+                                        'Overrun', 'Bugs', 'Entries'))
+        for row in rows:
+            print(row_format.format(
+                row['name'][:30], format_duration(row['duration']),
+                format_duration(row['timebox']),
+                format_duration(row['overrun']), row['bug_count'],
+                row['entry_count']))
+
     def precmd(self, line):
         if self.session:
-            timestamp = datetime.datetime.now().strftime('[%Y-%m-%d %H:%M:%S]')
+            timestamp = int(time.time())
             result = self.session.process_session_cmd(timestamp, line)
             console_text = result[Session.TEXT_KEY]
             if console_text:
                 print(console_text)
+            warning = self.session.check_timebox()
+            if warning:
+                Printer.print(warning, Printer.WARNING)
             return result[Session.CMD_KEY]
         else:
             return line
@@ -169,75 +521,227 @@ class TestSessionRecorder(cmd.Cmd):
 
     def delete_session(self, session_name, choice):
             if choice.lower() in ['y', 'yes']:
-                os.remove(os.path.join(self.SESSION_DIR, session_name))
+                JournalStore.remove(os.path.join(self.SESSION_DIR,
+                                                 session_name))
+                self.catalog.remove(session_name)
+                self.search_index.remove(session_name)
                 print(session_name + ' successfully deleted')
 
     def complete_delete(self, text, line, begidx, endidx):
         return self.autocomplete_sessions(text, line, begidx, endidx)
 
+    def do_archive(self, archive_args):
+        """archive [session_name] --older-than [days]
+        Compress session_name, or every session unchanged for days. Archived
+        sessions can still be shown, reported and searched, and are unpacked
+        when opened again. Set TESTRECORDER_ARCHIVE_DAYS to archive the
+        sessions unchanged for that many days on quit"""
+        args = self.parse_args(self.archive_parser(), archive_args)
+        if args is None:
+            return
+        session_name = ' '.join(args.session_name)
+        if args.older_than is not None:
+            archived = self.archive_idle(args.older_than)
+            print('{} sessions archived'.format(len(archived)))
+        elif not session_name:
+            print('Please enter a valid session name')
+        elif not self.check_for_session(session_name):
+            print('There is no test session with that name')
+        elif self.archive_session(session_name):
+            print(session_name + ' archived')
+        else:
+            print(session_name + ' is open or already archived')
+
+    @staticmethod
+    def archive_parser():
+        import argparse
+        parser = argparse.ArgumentParser(prog='archive', add_help=False)
+        parser.add_argument('session_name', nargs='*')
+        parser.add_argument('--older-than', type=float, metavar='DAYS')
+        return parser
+
+    def complete_archive(self, text, line, begidx, endidx):
+        return self.autocomplete_sessions(text, line, begidx, endidx)
+
+    def archive_session(self, session_name):
+        if self.session and self.session.session_name == session_name:
+            return False
+        try:
+            if not Session.archive(session_name, self.SESSION_DIR):
+                return False
+        except (OSError, ValueError, KeyError):
+            return False
+        self.catalog.mark_archived(session_name)
+        return True
+
+    def archive_idle(self, days, limit=None):
+        """Archive the sessions unchanged for days, at most limit of them,
+        returning their names"""
+        before = time.time() - days * 24 * 60 * 60
+        archived = []
+        for session_name in self.catalog.unarchived(before):
+            if limit is not None and len(archived) >= limit:
+                break
+            if self.archive_session(session_name):
+                archived.append(session_name)
+        return archived
+
+    def do_sync(self, line):
+        """sync
+        Upload the changes queued while the session server was
+        unreachable"""
+        if not self.remote:
+            print('No session server, set {} to its URL'.format(
+                self.REMOTE_ENV))
+            return
+        from .remote import RemoteStore
+        open_name = self.session.session_name if self.session else None
+        sent, failed = RemoteStore.sync(self.remote, self.SESSION_DIR,
+                                        exclude=(open_name,))
+        print('{} changes uploaded'.format(sent))
+        for session_name in failed:
+            print('Upload failed: ' + session_name)
+
+    def do_provision(self, path):
+        """provision [file]
+        Create a session for every charter in a CSV or YAML file, with its
+        name, mission, areas and timebox"""
+        from .provisioning import CharterError, read_charters
+        path = os.path.expanduser(path.strip())
+        if not path:
+            print('Please specify a charter file')
+            return
+        try:
+            charters = read_charters(path)
+        except CharterError as error:
+            print(error)
+            return
+        if not os.path.exists(self.SESSION_DIR):
+            os.makedirs(self.SESSION_DIR)
+        try:
+            created = Session.provision(self.SESSION_DIR, charters)
+        except OSError as error:
+            print('Provisioning failed: {}'.format(error))
+            return
+        self.catalog.update_many(created)
+        print('{} sessions provisioned'.format(len(created)))
+        if len(created) < len(charters):
+            print('{} sessions already existed and were left alone'.format(
+                len(charters) - len(created)))
+
     def do_quit(self, line):
         """quit
         Quit the application or current test session"""
+        try:
+            days = float(os.environ.get(self.ARCHIVE_DAYS_ENV,
+                                        self.ARCHIVE_AFTER_DAYS))
+        except ValueError:
+            days = self.ARCHIVE_AFTER_DAYS
+        if days > 0:
+            archived = self.archive_idle(days, self.ARCHIVE_ON_QUIT)
+            if archived:
+                print('Sessions unchanged for {:g} days archived: {}'.format(
+                    days, ', '.join(archived)))
         return True
 
     def check_for_session(self, session_name):
-        all_sessions = os.listdir(self.SESSION_DIR)
-        return session_name in all_sessions
-
-    def show_session(self, session_data):
-            TestSessionRecorder.print_header('Test Session Contents', True)
-            mission = session_data[Session.MISSION_KEY]
-            timebox = session_data[Session.TIMEBOX_KEY]
-            test_areas = session_data[Session.AREAS_KEY]
-            debrief = session_data[Session.DEBRIEF_KEY]
-            if mission is not None:
-                Printer.print('Test Mission: ', end='')
-                print(mission)
-            if timebox is not None:
-                Printer.print('Timebox: ', end='')
-                print(timebox)
-            if len(test_areas) != 0:
-                Printer.print('Test Areas:')
-                for area in test_areas:
-                    print('- ' + area)
+        return self.catalog.contains(session_name)
+
+    def show_session(self, session_data, entries=None, pager=False,
+                     earlier=0):
+        """Print a session's header and the (number, log entry) pairs
+        iterated from entries, by default its whole log. With pager set, the
+        log is shown a terminal page at a time and only read as far as it is
+        shown."""
+        TestSessionRecorder.print_header('Test Session Contents', True)
+        mission = session_data[Session.MISSION_KEY]
+        timebox = session_data[Session.TIMEBOX_KEY]
+        test_areas = session_data[Session.AREAS_KEY]
+        debrief = session_data[Session.DEBRIEF_KEY]
+        if mission is not None:
+            Printer.print('Test Mission: ', end='')
+            print(mission)
+        if timebox is not None:
+            Printer.print('Timebox: ', end='')
+            print(format_duration(timebox))
+        if len(test_areas) != 0:
+            Printer.print('Test Areas:')
+            for area in test_areas:
+                print('- ' + area)
+        TestSessionRecorder.print_bar()
+        TestSessionRecorder.print_header('Test Session Log', True)
+        if entries is None:
+            entries = enumerate(session_data[Session.LOG_KEY], 1)
+        if earlier:
+            print('({} earlier entries, use show to see them)'.format(
+                earlier))
+        if self.print_entries(entries, pager):
             TestSessionRecorder.print_bar()
-            TestSessionRecorder.print_header('Test Session Log', True)
-            log_entries = session_data[Session.LOG_KEY]
-            if len(log_entries) > 0:
-                for entry in log_entries:
-                    if entry['bug']:
-                        Printer.print(
-                                entry['date'] + ' (BUG)' + entry['entry'],
-                                Printer.WARNING)
-                    else:
-                        print(entry['date'] + ' ' + entry['entry'])
-                TestSessionRecorder.print_bar()
-            if debrief is not None:
-                Printer.print('Debrief: ', end='')
-                print(debrief)
-            Printer.print('Duration: ', end='')
-            print(session_data[Session.DURATION_KEY])
+        if debrief is not None:
+            Printer.print('Debrief: ', end='')
+            print(debrief)
+        Printer.print('Duration: ', end='')
+        print(format_duration(session_data[Session.DURATION_KEY]))
+
+    def print_entries(self, entries, pager=False):
+        """Print numbered log entries, returning how many were printed"""
+        attachments = AttachmentStore.beside(self.SESSION_DIR)
+        page_size = max(1, self.rows - 2)
+        printed = 0
+        for number, entry in entries:
+            # Only asked once there is another entry to show
+            if pager and printed and printed % page_size == 0:
+                try:
+                    answer = input(self.MORE_PROMPT)
+                except EOFError:
+                    answer = 'q'
+                if answer.strip().lower().startswith('q'):
+                    break
+            prefix = '{:>4} {}'.format(number, entry.date)
+            if entry.bug:
+                Printer.print(prefix + ' (BUG)' + entry.text, Printer.WARNING)
+            elif entry.screenshot:
+                print(prefix + ' (SCREENSHOT) ' +
+                      attachments.path(entry.text))
+            else:
+                print(prefix + ' ' + entry.text)
+            printed += 1
+        return printed
 
     def new_session(self, session_name):
         print('Session Started: ' + session_name)
         TestSessionRecorder.print_bar()
         self.prompt = Session.SESSION_PROMPT
         self.session = Session(session_name, self.SESSION_DIR)
+        self.session.store.start_write_behind()
+        self.catalog.update(session_name, self.session.store.data)
+        self.search_index.watch(self.session)
+        self.watch_remote(self.session)
+
+    def ingest_session(self, session_name, lines):
+        if not os.path.exists(self.SESSION_DIR):
+            os.makedirs(self.SESSION_DIR)
+        session = Session(session_name, self.SESSION_DIR)
+        self.search_index.watch(session)
+        self.watch_remote(session)
+        try:
+            applied = session.ingest(lines)
+        finally:
+            self.print_failures(session.close())
+            self.catalog.update(session_name, session.store.data)
+            self.search_index.commit()
+            self.unwatch_remote()
+        print('{} entries recorded to {}'.format(applied, session_name))
 
     def quit_session(self):
         self.prompt = self.DEFAULT_PROMPT
         duration = self.session.get_duration()
+        self.close()
         print('Session Duration: ' + str(duration))
         print('Session saved.')
-        self.session = None
 
     def autocomplete_sessions(self, text, line, begidx, endidx):
-        all_sessions = os.listdir(self.SESSION_DIR)
-        if not text:
-            completions = all_sessions[:]
-        else:
-            completions = [f for f in all_sessions if f.startswith(text)]
-        return completions
+        return self.catalog.complete(text)
 
     @classmethod
     def print_header(cls, header_text, center=False):
@@ -253,5 +757,9 @@ class TestSessionRecorder(cmd.Cmd):
         print('='*TestSessionRecorder.columns)
 
 if __name__ == '__main__':
-    TestSessionRecorder().cmdloop(
-            TestSessionRecorder.print_header('Test Session Recorder', True))
+    recorder = TestSessionRecorder()
+    try:
+        recorder.cmdloop(
+                TestSessionRecorder.print_header('Test Session Recorder', True))
+    finally:
+        recorder.close()
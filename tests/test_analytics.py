@@ -0,0 +1,79 @@
+import datetime
+import os
+import pytest
+from test_session.analytics import SessionAnalytics
+from test_session.session import Session
+from test_session.session_catalog import SessionCatalog
+from test_session.session_timer import parse_duration
+
+@pytest.fixture
+def session_dir(tmpdir):
+    return str(tmpdir)
+
+def record_session(session_dir, session_name, minutes, bugs=0, notes=0,
+                   timebox=None, areas=None):
+    session = Session(session_name, session_dir)
+    if timebox:
+        session.process_session_cmd('[2020-01-01 10:00:00]', Session.TIMEBOX_CMD + ' ' + timebox)
+    if areas:
+        session.process_session_cmd('[2020-01-01 10:00:00]', Session.AREAS_CMD + ' ' + areas)
+    for _ in range(bugs):
+        session.process_session_cmd('[2020-01-01 10:00:00]', Session.BUG_CMD + ' Bug')
+    for _ in range(notes):
+        session.process_session_cmd('[2020-01-01 10:00:00]', 'Note')
+    session.store.set(Session.DURATION_KEY, datetime.timedelta(minutes=minutes))
+    session.close()
+
+@pytest.fixture
+def analytics(session_dir):
+    record_session(session_dir, 'login', 60, bugs=2, notes=2, timebox='45m', areas='UI, API')
+    record_session(session_dir, 'logout', 30, bugs=1, timebox='1h', areas='UI')
+    record_session(session_dir, 'search', 90, notes=3)
+    return SessionAnalytics(SessionCatalog(session_dir))
+
+def test_parse_duration():
+    assert parse_duration('90m') == 5400, 'Unexpected minutes'
+    assert parse_duration('1h30') == 5400, 'Unexpected hours and minutes'
+    assert parse_duration('01:30:00') == 5400, 'Unexpected clock time'
+    assert parse_duration('2 hours') == 7200, 'Unexpected hours'
+    assert parse_duration('45') == 2700, 'Bare numbers should be minutes'
+    assert parse_duration('soon') is None, 'Unexpected duration for text'
+    assert parse_duration(None) is None, 'Unexpected duration for no timebox'
+
+def test_stats(analytics):
+    stats = analytics.stats()
+    assert stats['sessions'] == 3, 'Unexpected session count'
+    assert stats['total_duration'] == 3 * 3600, 'Unexpected total duration'
+    assert stats['mean_duration'] == 3600, 'Unexpected mean duration'
+    assert stats['bugs'] == 3, 'Unexpected bug count'
+    assert stats['bugs_per_hour'] == 1, 'Unexpected bug rate'
+    assert stats['entries'] == 8, 'Unexpected entry count'
+    assert stats['timeboxed'] == 2, 'Unexpected timeboxed count'
+    assert stats['overrun_sessions'] == 1, 'Unexpected overrun count'
+    assert stats['total_overrun'] == 15 * 60, 'Unexpected overrun'
+
+def test_area_time(analytics):
+    """Test that session time is split evenly across its test areas"""
+    areas = analytics.stats()['areas']
+    assert areas['UI'] == {'duration': 3600, 'sessions': 2}, 'Unexpected UI time'
+    assert areas['API'] == {'duration': 1800, 'sessions': 1}, 'Unexpected API time'
+    assert areas[SessionAnalytics.NO_AREA]['duration'] == 5400, 'Unexpected unassigned time'
+
+def test_filters(analytics):
+    assert analytics.stats(pattern='log*')['sessions'] == 2, 'Unexpected pattern match'
+    stats = analytics.stats(area='API')
+    assert stats['sessions'] == 1, 'Unexpected area match'
+    assert stats['bugs'] == 2, 'Unexpected area bug count'
+    assert analytics.stats(since=2 ** 40)['sessions'] == 0, 'Unexpected date match'
+
+def test_summaries(analytics):
+    rows = analytics.summaries(pattern='log*')
+    assert [row['name'] for row in rows] == ['login', 'logout'], 'Unexpected summaries'
+    assert rows[0]['overrun'] == 15 * 60, 'Unexpected overrun'
+    assert rows[1]['overrun'] == 0, 'Unexpected overrun within timebox'
+
+def test_stats_incremental(session_dir, analytics):
+    """Test that sessions changed after being summarised are re-read"""
+    record_session(session_dir, 'search', 90, bugs=3)
+    os.utime(os.path.join(session_dir, 'search'), (0, 0))
+    assert analytics.stats()['bugs'] == 6, 'Changed session was not re-read'
@@ -0,0 +1,77 @@
+import os
+import struct
+import zlib
+import pytest
+from test_session.attachments import (AttachmentStore, PlaceholderBackend, PngCapture, RgbCapture,
+                                      ScreenshotError, encode_png, get_backend)
+
+def read_png(path):
+    """Width, height and raw scanlines of an 8 bit RGB PNG"""
+    with open(path, 'rb') as png:
+        data = png.read()
+    assert data[:8] == b'\x89PNG\r\n\x1a\n', 'Not a PNG file'
+    position = 8
+    chunks = {}
+    while position < len(data):
+        length, = struct.unpack('>I', data[position:position + 4])
+        tag = data[position + 4:position + 8]
+        body = data[position + 8:position + 8 + length]
+        crc, = struct.unpack('>I', data[position + 8 + length:position + 12 + length])
+        assert crc == zlib.crc32(tag + body), 'Bad chunk CRC'
+        chunks[tag] = chunks.get(tag, b'') + body
+        position += 12 + length
+    width, height = struct.unpack('>II', chunks[b'IHDR'][:8])
+    return width, height, zlib.decompress(chunks[b'IDAT'])
+
+def test_encode_png(tmpdir):
+    """Test that encoded PNGs hold the pixels they were given"""
+    pixels = bytes(range(2 * 3 * 3))
+    path = str(tmpdir.join('image.png'))
+    with open(path, 'wb') as png:
+        png.write(encode_png(3, 2, pixels))
+    width, height, rows = read_png(path)
+    assert (width, height) == (3, 2)
+    assert rows == b'\x00' + pixels[:9] + b'\x00' + pixels[9:]
+
+def test_put_writes_in_background(tmpdir):
+    """Test that an image and its thumbnail are stored under the capture digest"""
+    store = AttachmentStore(str(tmpdir))
+    capture = PlaceholderBackend().capture()
+    digest = store.put(capture)
+    assert digest == capture.digest()
+    store.wait()
+    assert read_png(store.path(digest))[:2] == (PlaceholderBackend.WIDTH, PlaceholderBackend.HEIGHT)
+    width, height, _ = read_png(store.thumbnail_path(digest))
+    assert width == AttachmentStore.THUMBNAIL_WIDTH
+    assert height == PlaceholderBackend.HEIGHT * width // PlaceholderBackend.WIDTH
+    store.close()
+
+def test_put_deduplicates(tmpdir):
+    """Test that identical captures are stored once and different ones apart"""
+    store = AttachmentStore(str(tmpdir))
+    first = store.put(RgbCapture(1, 1, b'\x00\x00\x00'))
+    assert store.put(RgbCapture(1, 1, b'\x00\x00\x00')) == first
+    store.wait()
+    mtime = os.stat(store.path(first)).st_mtime_ns
+    assert store.put(RgbCapture(1, 1, b'\x00\x00\x00')) == first
+    store.wait()
+    assert os.stat(store.path(first)).st_mtime_ns == mtime, 'Stored image was written again'
+    assert store.put(RgbCapture(1, 1, b'\xff\x00\x00')) != first
+    store.close()
+
+def test_png_capture_has_no_thumbnail(tmpdir):
+    """Test that captures already encoded are stored as they are"""
+    store = AttachmentStore(str(tmpdir))
+    data = encode_png(1, 1, b'\x01\x02\x03')
+    digest = store.put(PngCapture(data))
+    store.close()
+    with open(store.path(digest), 'rb') as png:
+        assert png.read() == data
+    assert not os.path.exists(store.thumbnail_path(digest))
+
+def test_get_backend(monkeypatch):
+    """Test that backends are picked by name and unknown ones refused"""
+    monkeypatch.setenv('TESTRECORDER_SCREENSHOT', 'placeholder')
+    assert isinstance(get_backend(), PlaceholderBackend)
+    with pytest.raises(ScreenshotError):
+        get_backend('missing')
@@ -0,0 +1,40 @@
+import os
+import pytest
+from test_session.batch_report import generate_reports
+from test_session.session import Session
+
+@pytest.fixture
+def dirs(tmpdir):
+    session_dir = str(tmpdir.mkdir('sessions'))
+    reports_dir = str(tmpdir.mkdir('reports'))
+    for name in ['alpha', 'beta', 'gamma']:
+        session = Session(name, session_dir)
+        session.process_session_cmd('[2020-01-01 10:00:00]', 'Entry for ' + name)
+        session.process_session_cmd('[2020-01-01 10:00:01]', Session.BUG_CMD + ' Bug in ' + name)
+        session.close()
+    return session_dir, reports_dir
+
+def test_generate_all_reports(dirs):
+    """Test that a report is generated for every session in the batch"""
+    session_dir, reports_dir = dirs
+    stats = generate_reports(['alpha', 'beta', 'gamma'], session_dir, reports_dir, 'test_session', workers=1)
+    assert stats.generated == 3, 'Unexpected number of reports'
+    assert sorted(os.listdir(reports_dir)) == ['alpha.html', 'beta.html', 'gamma.html'], 'Unexpected report files'
+    assert stats.bytes_written == sum(os.path.getsize(os.path.join(reports_dir, f)) for f in os.listdir(reports_dir))
+
+def test_generate_reports_in_pool(dirs):
+    session_dir, reports_dir = dirs
+    stats = generate_reports(['alpha', 'beta', 'gamma'], session_dir, reports_dir, 'test_session', workers=2)
+    assert stats.generated == 3, 'Unexpected number of reports'
+    with open(os.path.join(reports_dir, 'beta.html')) as report:
+        assert 'Bug in beta' in report.read(), 'Report content missing'
+
+def test_up_to_date_reports_are_skipped(dirs):
+    """Test that only sessions changed since their report are regenerated"""
+    session_dir, reports_dir = dirs
+    generate_reports(['alpha', 'beta'], session_dir, reports_dir, 'test_session', workers=1)
+    os.utime(os.path.join(session_dir, 'alpha'), (0, os.path.getmtime(os.path.join(reports_dir, 'alpha.html')) + 10))
+    stats = generate_reports(['alpha', 'beta', 'gamma'], session_dir, reports_dir, 'test_session', workers=1)
+    assert stats.skipped == 1, 'Up to date report was regenerated'
+    assert stats.generated == 2, 'Changed or new session was not reported'
+    assert generate_reports(['beta'], session_dir, reports_dir, 'test_session', force=True).generated == 1
@@ -0,0 +1,70 @@
+import csv
+import json
+import os
+import pytest
+from test_session.exporters import EXPORTERS, SessionExporter, export_sessions, register_exporter
+from test_session.session import Session
+
+@pytest.fixture
+def session_dir(tmpdir):
+    session_dir = str(tmpdir.mkdir('sessions'))
+    for name in ['Login', 'Search']:
+        session = Session(name, session_dir)
+        session.process_session_cmd('[2020-01-01 10:00:00]', Session.MISSION_CMD + ' Explore ' + name)
+        session.process_session_cmd('[2020-01-01 10:00:00]', Session.TIMEBOX_CMD + ' 30m')
+        session.process_session_cmd('[2020-01-01 10:00:01]', 'Looks *fine*')
+        session.process_session_cmd('[2020-01-01 10:00:02]', Session.BUG_CMD + ' Crash, on "submit"')
+        session.close()
+    return session_dir
+
+@pytest.fixture
+def export_path(tmpdir):
+    return os.path.join(str(tmpdir), 'export')
+
+def test_jsonl_export(session_dir, export_path):
+    assert export_sessions('jsonl', ['Login'], session_dir, export_path), 'Export failed'
+    with open(export_path) as export:
+        records = [json.loads(line) for line in export]
+    assert records[0]['type'] == 'session' and records[0]['timebox'] == 1800, 'Unexpected session record'
+    assert [(r['kind'], r['text']) for r in records[1:]] == [('note', 'Looks *fine*'), ('bug', 'Crash, on "submit"')], 'Unexpected entries'
+    assert records[1]['time'] == '2020-01-01T10:00:01', 'Unexpected entry time'
+
+def test_csv_bulk_export(session_dir, export_path):
+    """Test that many sessions go into one file with one header row"""
+    assert export_sessions('csv', ['Login', 'Search'], session_dir, export_path), 'Export failed'
+    with open(export_path, newline='') as export:
+        rows = list(csv.DictReader(export))
+    assert [row['session'] for row in rows] == ['Login', 'Login', 'Search', 'Search'], 'Unexpected rows'
+    assert rows[1]['text'] == 'Crash, on "submit"', 'Text was not quoted'
+    assert rows[2]['mission'] == ' Explore Search', 'Unexpected session fields'
+
+def test_markdown_export(session_dir, export_path):
+    assert export_sessions('md', ['Login'], session_dir, export_path), 'Export failed'
+    with open(export_path) as export:
+        markdown = export.read()
+    assert markdown.startswith('# Login\n'), 'Unexpected heading'
+    assert '- **Time Box:** 0:30:00' in markdown, 'Unexpected timebox'
+    assert 'Looks \\*fine\\*' in markdown, 'Markdown was not escaped'
+    assert markdown.index('## Bugs') < markdown.rindex('Crash'), 'Bug was not listed'
+
+def test_failed_export_keeps_previous_file(session_dir, export_path):
+    with open(export_path, 'w') as export:
+        export.write('previous')
+    assert not export_sessions('csv', ['Login', 'Missing'], session_dir, export_path), 'Unexpected success'
+    with open(export_path) as export:
+        assert export.read() == 'previous', 'Failed export replaced the file'
+    assert os.listdir(os.path.dirname(export_path)).count('export') == 1, 'Temporary file was left behind'
+
+def test_register_exporter(session_dir, export_path):
+    class CountExporter(SessionExporter):
+        FORMAT = 'count'
+        EXTENSION = '.txt'
+        def write_session(self, session_name, header):
+            self.stream.write('{} {}\n'.format(session_name, sum(1 for _ in self.iter_log(session_name))))
+    register_exporter(CountExporter)
+    try:
+        assert export_sessions('count', ['Login', 'Search'], session_dir, export_path), 'Export failed'
+        with open(export_path) as export:
+            assert export.read() == 'Login 2\nSearch 2\n', 'Unexpected plugin export'
+    finally:
+        del EXPORTERS['count']
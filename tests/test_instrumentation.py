@@ -0,0 +1,69 @@
+import json
+import pstats
+from test_session.instrumentation import Instrumentation
+from test_session.session import Session
+from test_session.session_store import JournalStore
+
+def record_session(session_dir):
+    session = Session('profiled', session_dir)
+    session.process_session_cmd(1577872800, 'Entry 1')
+    session.process_session_cmd(1577872801, Session.BUG_CMD + ' Bug 1')
+    session.close()
+    Session.get_session_data('profiled', session_dir)
+
+def test_operations_are_timed(tmpdir):
+    """Test that commands and storage are timed into a JSON histogram"""
+    path = str(tmpdir.join('profile.json'))
+    instrumentation = Instrumentation(path).start()
+    try:
+        record_session(str(tmpdir.mkdir('sessions')))
+    finally:
+        instrumentation.stop()
+    with open(path) as metrics:
+        operations = json.load(metrics)['operations']
+    assert operations['session.command']['count'] == 2, 'Commands were not counted'
+    assert operations['session.command']['buckets']['+Inf'] == 2, 'Buckets are not cumulative'
+    assert operations['store.write']['count'] >= 2, 'Storage writes were not timed'
+    assert operations['store.load']['count'] == 1, 'Storage reads were not timed'
+
+def test_prometheus_export(tmpdir):
+    """Test that a .prom path is written in the Prometheus text format"""
+    path = str(tmpdir.join('profile.prom'))
+    instrumentation = Instrumentation(path).start()
+    try:
+        record_session(str(tmpdir.mkdir('sessions')))
+    finally:
+        instrumentation.stop()
+    with open(path) as metrics:
+        lines = metrics.read().splitlines()
+    assert '# TYPE testrecorder_operation_seconds histogram' in lines
+    assert 'testrecorder_operation_seconds_count{operation="session.command"} 2' in lines
+    assert 'testrecorder_operation_seconds_bucket{operation="session.command",le="+Inf"} 2' in lines
+    assert 'testrecorder_operation_errors_total{operation="session.command"} 0' in lines
+
+def test_stop_restores_originals(tmpdir):
+    """Test that nothing stays instrumented once stopped"""
+    write = JournalStore.__dict__['write']
+    load = JournalStore.__dict__['load']
+    instrumentation = Instrumentation(str(tmpdir.join('profile.json'))).start()
+    assert JournalStore.__dict__['write'] is not write, 'Storage writes were not instrumented'
+    instrumentation.stop()
+    assert JournalStore.__dict__['write'] is write, 'Instrumented method was left behind'
+    assert JournalStore.__dict__['load'] is load, 'Instrumented classmethod was left behind'
+    from test_session.test_session_recorder import TestSessionRecorder
+    assert 'onecmd' not in vars(TestSessionRecorder), 'Inherited method was left overridden'
+
+def test_cprofile_capture(tmpdir):
+    """Test that a cProfile capture of the run is written"""
+    path = str(tmpdir.join('run.pstats'))
+    instrumentation = Instrumentation(cprofile_path=path).start()
+    record_session(str(tmpdir.mkdir('sessions')))
+    instrumentation.stop()
+    assert pstats.Stats(path).total_calls > 0, 'Empty profile'
+
+def test_disabled_by_default(monkeypatch):
+    monkeypatch.delenv(Instrumentation.PROFILE_ENV, raising=False)
+    monkeypatch.delenv(Instrumentation.CPROFILE_ENV, raising=False)
+    assert Instrumentation.from_settings() is None, 'Instrumentation on without being asked for'
+    monkeypatch.setenv(Instrumentation.PROFILE_ENV, 'metrics.prom')
+    assert Instrumentation.from_settings().path == 'metrics.prom'
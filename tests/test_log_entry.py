@@ -0,0 +1,42 @@
+import os
+from test_session.log_entry import EntryKind, LogEntry
+from test_session.session import Session
+
+def test_entry_display_date():
+    epoch = LogEntry.parse_date('[2020-01-31 09:15:00]')
+    entry = LogEntry(epoch, EntryKind.BUG, ' Bug')
+    assert entry.date == '[2020-01-31 09:15:00]', 'Unexpected display date'
+    assert entry.bug, 'Unexpected entry kind'
+
+def test_entry_from_legacy_dict():
+    """Test that entries recorded as dicts are read as LogEntry"""
+    entry = LogEntry.from_value({'date': '[2020-01-31 09:15:00]', 'entry': ' Note', 'bug': False})
+    assert entry == LogEntry(LogEntry.parse_date('[2020-01-31 09:15:00]'), EntryKind.NOTE, ' Note'), 'Unexpected converted entry'
+
+def test_compacted_session_packs_columns(tmpdir):
+    """Test that closing a large session packs its log column by column and keeps entry ids"""
+    session = Session('Compacted', str(tmpdir))
+    session.COMPACT_RECORDS = 10
+    for i in range(20):
+        session.process_session_cmd(1580462100 + i, 'Note ' + str(i))
+    session.process_session_cmd(1580462200, Session.UNDO_CMD)
+    session.process_session_cmd(1580462200, Session.BUG_CMD + ' Bug')
+    session.close()
+    path = os.path.join(str(tmpdir), 'Compacted')
+    with open(path) as journal:
+        assert len(journal.readlines()) == 3, 'Session was not compacted'
+    data = Session.get_session_data('Compacted', str(tmpdir))
+    assert len(data[Session.LOG_KEY]) == 20, 'Unexpected compacted log'
+    assert data[Session.LOG_KEY][-1] == LogEntry(1580462200, EntryKind.BUG, ' Bug'), 'Unexpected compacted entry'
+    assert [e.text for e in Session.iter_log('Compacted', str(tmpdir))] == [e.text for e in data[Session.LOG_KEY]], 'Streamed log differs'
+    session = Session('Compacted', str(tmpdir))
+    assert session.store.ids[Session.LOG_KEY][-1] == 20, 'Entry ids changed on compaction'
+    session.process_session_cmd(1580462300, 'After')
+    assert session.store.ids[Session.LOG_KEY][-1] == 21, 'Entry id was reused'
+    session.close()
+
+def test_epoch_of_persisted_forms():
+    """Test that the epoch is read from an entry and from the forms it persists in"""
+    entry = LogEntry(1580462200, EntryKind.BUG, ' Bug')
+    assert LogEntry.epoch_of(entry) == LogEntry.epoch_of([1580462200, 1, ' Bug']) == 1580462200
+    assert LogEntry.epoch_of({'date': entry.date, 'entry': ' Bug', 'bug': True}) == 1580462200
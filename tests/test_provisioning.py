@@ -0,0 +1,92 @@
+import os
+import pytest
+from test_session.provisioning import CharterError, read_charters
+from test_session.session import Session
+from test_session.session_catalog import SessionCatalog
+
+def write(tmpdir, name, text):
+    path = tmpdir.join(name)
+    path.write(text)
+    return str(path)
+
+def test_read_csv_charters(tmpdir):
+    """Test that CSV rows are read as charters"""
+    path = write(tmpdir, 'charters.csv', 'Name,Mission,Areas,Timebox\n'
+                 'login,Explore login,"Login, Accounts",90m\n'
+                 'search,,Search,\n')
+    assert read_charters(path) == [
+        {'name': 'login', 'mission': 'Explore login', 'areas': ['Login', 'Accounts'], 'timebox': 5400},
+        {'name': 'search', 'mission': None, 'areas': ['Search'], 'timebox': None}]
+
+def test_invalid_charters(tmpdir):
+    """Test that bad timeboxes, names and duplicates are refused"""
+    with pytest.raises(CharterError):
+        read_charters(write(tmpdir, 'bad.csv', 'name,timebox\nlogin,soon\n'))
+    with pytest.raises(CharterError):
+        read_charters(write(tmpdir, 'hidden.csv', 'name\n.hidden\n'))
+    with pytest.raises(CharterError):
+        read_charters(write(tmpdir, 'twice.csv', 'name\nlogin\nlogin\n'))
+    with pytest.raises(CharterError):
+        read_charters(write(tmpdir, 'charters.txt', 'name\nlogin\n'))
+
+def test_read_yaml_template(tmpdir):
+    """Test that YAML charters start from the template"""
+    pytest.importorskip('yaml')
+    path = write(tmpdir, 'charters.yaml', 'template:\n  timebox: 1h\n  areas: [Checkout]\n'
+                 'sessions:\n  - name: pay\n    mission: Pay by card\n'
+                 '  - name: refund\n    timebox: 30m\n')
+    assert read_charters(path) == [
+        {'name': 'pay', 'mission': 'Pay by card', 'areas': ['Checkout'], 'timebox': 3600},
+        {'name': 'refund', 'mission': None, 'areas': ['Checkout'], 'timebox': 1800}]
+
+def test_read_yaml_number_timeboxes(tmpdir):
+    """Test that timeboxes YAML reads as numbers are taken as seconds"""
+    pytest.importorskip('yaml')
+    path = write(tmpdir, 'charters.yaml', '- name: pay\n  timebox: 1:30:00\n'
+                 '- name: refund\n  timebox: 90\n- name: search\n  timebox: "1:30:00"\n')
+    assert [charter['timebox'] for charter in read_charters(path)] == [5400, 90, 5400]
+    with pytest.raises(CharterError):
+        read_charters(write(tmpdir, 'yes.yaml', '- name: pay\n  timebox: yes\n'))
+
+def test_provision_sessions(tmpdir):
+    """Test that provisioned sessions open with their charter and existing ones are kept"""
+    session_dir = str(tmpdir.mkdir('sessions'))
+    existing = Session('login', session_dir)
+    existing.process_session_cmd('[2020-01-01 10:00:00]', 'Entry')
+    existing.close()
+    charters = [{'name': 'charter-{}'.format(i), 'mission': 'Mission {}'.format(i),
+                 'areas': ['Area'], 'timebox': 60 * i} for i in range(500)]
+    charters.append({'name': 'login', 'mission': 'Replaced', 'areas': [], 'timebox': None})
+    created = Session.provision(session_dir, charters)
+    assert len(created) == 500
+    catalog = SessionCatalog(session_dir)
+    catalog.update_many(created)
+    assert catalog.contains('charter-499')
+    catalog.close()
+    session = Session('charter-7', session_dir)
+    assert session.store.data[Session.MISSION_KEY] == ' Mission 7', 'Mission not stored as the mission command stores it'
+    assert session.store.data[Session.TIMEBOX_KEY] == 420
+    session.process_session_cmd('[2020-01-01 10:00:00]', 'bug Found')
+    session.close()
+    header = Session.get_session_header('charter-7', session_dir)
+    assert header[Session.AREAS_KEY] == ['Area']
+    assert len(list(Session.iter_log('charter-7', session_dir))) == 1
+    assert len(list(Session.iter_log('login', session_dir))) == 1
+    assert not [name for name in os.listdir(session_dir) if name.endswith('.provisioning')]
+
+def test_provision_without_hard_links(tmpdir, monkeypatch):
+    """Test that sessions are provisioned where hard links are not supported, without syncing every filesystem"""
+    import errno
+    def no_link(source, target):
+        raise OSError(errno.EPERM, 'Operation not permitted')
+    def no_sync():
+        raise AssertionError('Every filesystem was synced')
+    monkeypatch.setattr(os, 'link', no_link)
+    monkeypatch.setattr(os, 'sync', no_sync, raising=False)
+    session_dir = str(tmpdir.mkdir('sessions'))
+    charters = [{'name': 'first', 'mission': 'Mission', 'areas': [], 'timebox': None},
+                {'name': 'second', 'mission': None, 'areas': [], 'timebox': None}]
+    assert [name for name, _ in Session.provision(session_dir, charters)] == ['first', 'second']
+    assert Session.provision(session_dir, charters) == [], 'Existing sessions were replaced'
+    assert Session.get_session_header('first', session_dir)[Session.MISSION_KEY] == ' Mission'
+    assert sorted(os.listdir(session_dir)) == ['first', 'second']
@@ -0,0 +1,131 @@
+import threading
+import pytest
+from test_session.remote import Outbox, RemoteClient, RemoteStore
+from test_session.session import Session
+from test_session.session_server import SessionServer
+from test_session.session_store import JournalStore
+
+@pytest.fixture
+def server(tmpdir):
+    """Run a session server on a free localhost port"""
+    server = SessionServer(('127.0.0.1', 0), str(tmpdir.mkdir('central')), quiet=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+def record(session, *lines):
+    for index, line in enumerate(lines):
+        session.process_session_cmd('[2020-01-01 10:00:{:02d}]'.format(index), line)
+
+def test_mirror_session(tmpdir, server):
+    """Test that a session recorded locally is mirrored to the server"""
+    session_dir = str(tmpdir.mkdir('local'))
+    client = RemoteClient(server.url, owner='alice')
+    session = Session('mirrored', session_dir)
+    record(session, 'Before mirroring')
+    remote = RemoteStore(client, session)
+    record(session, 'mission Login', 'Entry 1', 'bug Bug 2', 'Entry 3', 'undo')
+    session.close()
+    assert remote.close(), 'Outbox was not uploaded'
+    central = Session.get_session_data('alice-mirrored', server.session_dir)
+    assert central[Session.MISSION_KEY] == ' Login'
+    assert [entry.text for entry in central[Session.LOG_KEY]] == [' Before mirroring', ' Entry 1', ' Bug 2']
+    assert client.sessions() == ['alice-mirrored']
+    client.close()
+
+def test_uploads_are_idempotent(tmpdir, server):
+    """Test that records uploaded twice are only stored once"""
+    client = RemoteClient(server.url, owner='bob')
+    lines = ['{"op":"append","key":"session_log","id":0,"value":[1577872800,0," Entry"]}\n']
+    assert client.upload('twice', lines)['applied'] == 1
+    assert client.upload('twice', lines)['applied'] == 0
+    assert client.session_state('twice') == {'last_id': 0}
+    assert client.session_state('missing') is None
+    status, _ = client.request('POST', '/sessions/bob-bad/records', b'{"op":"drop"}\n')
+    assert status == 400
+    client.close()
+
+@pytest.mark.parametrize('record', [
+    '{"op":"set","key":"unknown","value":1}',
+    '{"op":"set","key":"session_log","value":"x"}',
+    '{"op":"append","key":"test_mission","id":1,"value":"x"}',
+    '{"op":"append","key":"session_log","id":1,"value":[1577872800,0]}',
+    '{"op":"replace","key":"session_log","id":1,"value":"x"}',
+    '{"op":"pop","key":"session_log"}',
+    '{"op":"set","key":"session_timebox","value":[1]}',
+    '{"op":"snapshot","value":{"session_log":"x"}}',
+    '{"op":"snapshot","value":{"unknown":1}}',
+    '{"op":"chunk","key":"session_log","ids":[0],"values":[["x"]]}',
+    '{"op":"chunk","key":"session_log","ids":[0,1],"columns":[[1577872800],[0],[" Entry"]]}',
+])
+def test_invalid_records_are_rejected(tmpdir, server, record):
+    """Test that records not matching the session data are refused before anything is written"""
+    client = RemoteClient(server.url, owner='bob')
+    status, reply = client.request('POST', '/sessions/bob-bad/records', record.encode() + b'\n')
+    assert status == 400 and reply['error'], 'Invalid record was accepted'
+    assert client.session_state('bad') is None, 'Session was created'
+    client.close()
+
+def test_failed_upload_is_reported(tmpdir, server, monkeypatch):
+    """Test that an upload failing on the server gets an error reply"""
+    def fail(session_name, records):
+        raise OSError('Disk full')
+    monkeypatch.setattr(server, 'upload', fail)
+    client = RemoteClient(server.url, owner='bob')
+    lines = ['{"op":"append","key":"session_log","id":0,"value":[1577872800,0," Entry"]}\n']
+    status, reply = client.request('POST', '/sessions/bob-full/records', ''.join(lines).encode())
+    assert status == 500 and reply['error'], 'Failure was not reported'
+    monkeypatch.undo()
+    assert client.upload('full', lines)['applied'] == 1, 'Connection was not usable after the failure'
+    client.close()
+
+def test_offline_queue(tmpdir):
+    """Test that records recorded offline are queued and uploaded by sync"""
+    session_dir = str(tmpdir.mkdir('local'))
+    server = SessionServer(('127.0.0.1', 0), str(tmpdir.mkdir('central')), quiet=True)
+    # Nothing listens on the port until the server is started
+    client = RemoteClient(server.url, owner='carol')
+    server.server_close()
+    session = Session('offline', session_dir)
+    remote = RemoteStore(client, session)
+    record(session, 'Entry 1', 'bug Bug 2')
+    session.close()
+    assert not remote.close(), 'Upload did not fail'
+    assert Outbox.pending_sessions(session_dir) == ['offline']
+    server = SessionServer(server.server_address, server.session_dir, quiet=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        sent, failed = RemoteStore.sync(client, session_dir)
+        assert failed == [] and sent > 0
+        assert Outbox.pending_sessions(session_dir) == []
+        central = Session.get_session_data('carol-offline', server.session_dir)
+        assert len(central[Session.LOG_KEY]) == 2
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+        client.close()
+
+def test_snapshot_is_uploaded_with_its_chunks(tmpdir, server, monkeypatch):
+    """Test that a snapshot is never split from its chunk records by the upload batch size"""
+    monkeypatch.setattr(JournalStore, 'CHUNK_ITEMS', 2)
+    monkeypatch.setattr(RemoteStore, 'BATCH_RECORDS', 2)
+    session_dir = str(tmpdir.mkdir('local'))
+    session = Session('chunked', session_dir)
+    record(session, *['Entry {}'.format(i) for i in range(7)])
+    client = RemoteClient(server.url, owner='dave')
+    outbox = Outbox(session_dir, 'chunked')
+    outbox.add(''.join(session.store.snapshot_lines()))
+    assert RemoteStore.upload_pending(client, outbox, RemoteStore.BATCH_RECORDS) == 5
+    assert RemoteStore.upload_pending(client, outbox, RemoteStore.BATCH_RECORDS) == 0
+    outbox.add(''.join(session.store.snapshot_lines()))
+    RemoteStore.upload_pending(client, outbox, RemoteStore.BATCH_RECORDS)
+    outbox.close()
+    session.close()
+    central = Session.get_session_data('dave-chunked', server.session_dir)
+    assert [entry.text for entry in central[Session.LOG_KEY]] == [' Entry {}'.format(i) for i in range(7)]
+    client.close()
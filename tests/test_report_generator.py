@@ -1,14 +1,16 @@
 import pytest
 import os
-from modules.report_generator import SessionReportGenerator
-from modules.session import Session
+import tracemalloc
+from test_session.report_generator import SessionReportGenerator
+from test_session.log_entry import EntryKind, LogEntry
+from test_session.session import Session
 
 @pytest.fixture(scope='session')
 def generator(tmpdir_factory):
     """Create the report generator object and pass in a temporary directory for testing"""
     global tmp_dir
     tmp_dir = tmpdir_factory.mktemp('test')
-    generator = SessionReportGenerator(str(tmp_dir), 'test_session_recorder')
+    generator = SessionReportGenerator(str(tmp_dir), 'test_session')
     return generator
 
 def test_generate_report(generator):
@@ -43,3 +45,213 @@ def test_generate_report_new_filename_with_space(generator):
     report_data = {Session.SESSION_NAME_KEY:session_name, Session.MISSION_KEY:'Test Mession', Session.AREAS_KEY:['Area 1', 'Area 2'], Session.TIMEBOX_KEY:'00:30:00', Session.DURATION_KEY:'00:20:00', Session.LOG_KEY:['Entry 1'], Session.BUG_KEY:['Bug 1', 'Bug 2'], Session.DEBRIEF_KEY:'Test Debrief'}
     generator.generate_report(filename=session_filename, **report_data)
     assert os.path.isfile(os.path.join(str(tmp_dir), session_filename + '.html')), 'Report file was not created'
+
+def test_generate_report_from_generators(generator):
+    """Test that log and bug entries can be streamed into the report"""
+    session_file_name = 'Streamed Report'
+    report_data = {Session.LOG_KEY:('Entry ' + str(i) for i in range(1000)), Session.BUG_KEY:('Bug ' + str(i) for i in range(10))}
+    assert generator.generate_report(session_name=session_file_name, **report_data), 'Generator should have returned true'
+    with open(os.path.join(str(tmp_dir), session_file_name + '.html')) as report:
+        content = report.read()
+    assert 'Entry 999' in content, 'Streamed log entries missing from report'
+    assert content.count('<h2> Bugs </h2>') == 1, 'Bug section not rendered once'
+
+def test_failed_report_leaves_no_file(generator):
+    """Test that a report failing part way through does not leave a partial file behind"""
+    def failing_log():
+        yield 'Entry 1'
+        raise IOError('Session file went away')
+    session_file_name = 'Failed Report'
+    assert not generator.generate_report(session_name=session_file_name, session_log=failing_log()), 'Generator should have returned false'
+    assert not os.path.exists(os.path.join(str(tmp_dir), session_file_name + '.html')), 'Partial report was written'
+    assert not [f for f in os.listdir(str(tmp_dir)) if f.endswith('.tmp')], 'Temporary report was left behind'
+
+def test_template_is_cached(generator):
+    """Test that generators share the compiled template instead of parsing it again"""
+    other = SessionReportGenerator(str(tmp_dir), 'test_session')
+    assert other.template is SessionReportGenerator(str(tmp_dir), 'test_session').template, 'Template was compiled twice'
+
+def test_precompiled_templates(tmpdir):
+    """Test that precompiled templates are only used while they match their source"""
+    templates_path = str(tmpdir.mkdir('templates'))
+    source = os.path.join(SessionReportGenerator.templates_path('test_session'), SessionReportGenerator.TEMPLATE)
+    with open(source) as template, open(os.path.join(templates_path, SessionReportGenerator.TEMPLATE), 'w') as copy:
+        copy.write(template.read())
+    compiled_path = SessionReportGenerator.precompile_templates(templates_path)
+    assert SessionReportGenerator.is_compiled(templates_path, compiled_path, SessionReportGenerator.TEMPLATE), 'Template was not precompiled'
+    with open(os.path.join(templates_path, SessionReportGenerator.TEMPLATE), 'a') as copy:
+        copy.write('<!-- edited -->')
+    assert not SessionReportGenerator.is_compiled(templates_path, compiled_path, SessionReportGenerator.TEMPLATE), 'Stale precompiled template was used'
+
+def record(session_dir, name, *lines, start=0):
+    session = Session(name, session_dir)
+    for index, line in enumerate(lines, start):
+        session.process_session_cmd('[2020-01-01 10:00:{:02d}]'.format(index), line)
+    session.close()
+
+def read_report(reports_dir, name):
+    with open(os.path.join(reports_dir, name + '.html')) as report:
+        return report.read()
+
+def full_report(tmpdir, session_dir, name):
+    reports_dir = str(tmpdir.mkdir('full'))
+    SessionReportGenerator(reports_dir, 'test_session').render_session_report(os.path.join(reports_dir, name + '.html'), name, session_dir)
+    return read_report(reports_dir, name)
+
+def test_incremental_report(tmpdir):
+    """Test that new entries are appended to a report and match a full render"""
+    session_dir = str(tmpdir.mkdir('sessions'))
+    reports_dir = str(tmpdir.mkdir('reports'))
+    generator = SessionReportGenerator(reports_dir, 'test_session')
+    record(session_dir, 'live', 'Entry 1', Session.BUG_CMD + ' Bug 1')
+    assert generator.generate_session_report('live', session_dir)
+    record(session_dir, 'live', 'Entry 2 -- dashes', Session.BUG_CMD + ' Bug 2', start=2)
+    rendered = []
+    generator.render = lambda *args, **kwargs: rendered.append(args)
+    inode = os.stat(os.path.join(reports_dir, 'live.html')).st_ino
+    assert generator.update_report(os.path.join(reports_dir, 'live.html'), 'live', session_dir), 'Report was not updated'
+    assert os.stat(os.path.join(reports_dir, 'live.html')).st_ino != inode, 'Report was patched in place'
+    assert os.listdir(reports_dir) == ['live.html'], 'Temporary file left behind'
+    assert generator.generate_session_report('live', session_dir)
+    assert not rendered, 'Report was rendered in full'
+    content = read_report(reports_dir, 'live')
+    assert content.index('Entry 2') < content.index('Bug 1') < content.index('Bug 2')
+    assert content.count('<h2> Bugs </h2>') == 1, 'Bug section not rendered once'
+    assert content == full_report(tmpdir, session_dir, 'live'), 'Updated report differs from a full render'
+
+def test_report_state_holds_bug_offsets(tmpdir):
+    """Test that the report state points at the bug rows rather than holding them, as bugs are added"""
+    session_dir = str(tmpdir.mkdir('sessions'))
+    reports_dir = str(tmpdir.mkdir('reports'))
+    generator = SessionReportGenerator(reports_dir, 'test_session')
+    record(session_dir, 'live', 'Entry 1')
+    assert generator.generate_session_report('live', session_dir)
+    for start, line in enumerate(['bug Bug 1', 'Entry 2', 'bug Bug 2'], 1):
+        record(session_dir, 'live', line, start=start)
+        assert generator.update_report(os.path.join(reports_dir, 'live.html'), 'live', session_dir), 'Report was not updated'
+    with open(os.path.join(reports_dir, 'live.html'), 'rb') as report:
+        state, state_start = generator.read_state(report)
+        report.seek(state['bugs'][0])
+        rows = report.read(state['bugs'][1] - state['bugs'][0]).decode()
+        report.seek(state_start)
+        assert b'Bug 1' not in report.read(), 'Bug rows kept in the report state'
+    assert rows.split() == ['[2020-01-01', '10:00:01]', 'Bug', '1', '<br>', '[2020-01-01', '10:00:03]', 'Bug', '2', '<br>']
+    assert read_report(reports_dir, 'live') == full_report(tmpdir, session_dir, 'live'), 'Updated report differs from a full render'
+
+def test_failed_update_keeps_report(tmpdir):
+    """Test that a report is left as it was when updating it fails"""
+    session_dir = str(tmpdir.mkdir('sessions'))
+    reports_dir = str(tmpdir.mkdir('reports'))
+    generator = SessionReportGenerator(reports_dir, 'test_session')
+    record(session_dir, 'live', 'Entry 1')
+    assert generator.generate_session_report('live', session_dir)
+    before = read_report(reports_dir, 'live')
+    record(session_dir, 'live', 'Entry 2', start=1)
+    def fail(row):
+        raise OSError('No space left on device')
+    generator.template.module.log_row = fail
+    with pytest.raises(OSError):
+        generator.update_report(os.path.join(reports_dir, 'live.html'), 'live', session_dir)
+    assert read_report(reports_dir, 'live') == before, 'Report was changed'
+    assert os.listdir(reports_dir) == ['live.html'], 'Temporary file left behind'
+
+def test_unchanged_report_is_skipped(tmpdir):
+    """Test that a report is left alone when its session did not change"""
+    session_dir = str(tmpdir.mkdir('sessions'))
+    reports_dir = str(tmpdir.mkdir('reports'))
+    generator = SessionReportGenerator(reports_dir, 'test_session')
+    record(session_dir, 'done', 'Entry 1')
+    assert generator.generate_session_report('done', session_dir)
+    report_path = os.path.join(reports_dir, 'done.html')
+    os.utime(report_path, (0, 0))
+    assert generator.generate_session_report('done', session_dir)
+    assert os.path.getmtime(report_path) == 0, 'Unchanged report was rewritten'
+
+def test_report_rerendered_on_header_change(tmpdir):
+    """Test that changed header fields and undone entries render the report again"""
+    session_dir = str(tmpdir.mkdir('sessions'))
+    reports_dir = str(tmpdir.mkdir('reports'))
+    generator = SessionReportGenerator(reports_dir, 'test_session')
+    record(session_dir, 'changed', 'Entry 1', 'mission First mission')
+    assert generator.generate_session_report('changed', session_dir)
+    report_path = os.path.join(reports_dir, 'changed.html')
+    record(session_dir, 'changed', 'mission Second mission')
+    assert not generator.update_report(report_path, 'changed', session_dir), 'Changed header was not detected'
+    assert generator.generate_session_report('changed', session_dir)
+    assert 'Second mission' in read_report(reports_dir, 'changed')
+    record(session_dir, 'changed', 'Entry 2', 'undo')
+    assert not generator.update_report(report_path, 'changed', session_dir), 'Undone entry was not detected'
+    assert generator.generate_session_report('changed', session_dir)
+    assert 'Entry 2' not in read_report(reports_dir, 'changed')
+
+def test_watch_report(tmpdir):
+    """Test that a watched report picks up entries recorded meanwhile"""
+    session_dir = str(tmpdir.mkdir('sessions'))
+    reports_dir = str(tmpdir.mkdir('reports'))
+    generator = SessionReportGenerator(reports_dir, 'test_session')
+    generator.POLL_SECONDS = generator.DEBOUNCE_SECONDS = 0.01
+    record(session_dir, 'watched', 'Entry 1')
+    results = []
+    recorded = []
+    def should_stop():
+        if results and not recorded:
+            record(session_dir, 'watched', 'Entry 2')
+            recorded.append(True)
+        return len(results) == 2
+    generator.watch('watched', session_dir, on_update=results.append, should_stop=should_stop)
+    assert results == [True, True], 'Report was not updated'
+    assert 'Entry 2' in read_report(reports_dir, 'watched')
+
+def test_report_screenshot(tmpdir, monkeypatch):
+    """Test that screenshots are shown as thumbnails linking to the image"""
+    monkeypatch.setenv('TESTRECORDER_SCREENSHOT', 'placeholder')
+    session_dir = str(tmpdir.mkdir('sessions'))
+    reports_dir = str(tmpdir.mkdir('reports'))
+    record(session_dir, 'shots', 'screenshot')
+    digest, = [entry.text for entry in Session.iter_log('shots', session_dir)]
+    generator = SessionReportGenerator(reports_dir, 'test_session')
+    assert generator.generate_session_report('shots', session_dir)
+    path = '../attachments/{{}}/{}/{}.png'.format(digest[:2], digest[2:])
+    assert '<a href="{}"><img src="{}"'.format(path.format('objects'), path.format('thumbnails')) in read_report(reports_dir, 'shots')
+
+def compacted_session(session_dir, name, entries):
+    session = Session(name, session_dir)
+    with session.store.batch():
+        for index in range(entries):
+            kind = EntryKind.BUG if index % 1000 == 0 else EntryKind.NOTE
+            session.store.append(Session.LOG_KEY, LogEntry(1577872800 + index, kind, ' Entry {} checked the login form'.format(index)))
+    session.close()
+
+def test_report_memory_is_flat(tmpdir):
+    """Test that rendering a compacted session streams it, ten times the entries must not take ten times the memory"""
+    session_dir = str(tmpdir.mkdir('sessions'))
+    reports_dir = str(tmpdir.mkdir('reports'))
+    generator = SessionReportGenerator(reports_dir, 'test_session')
+    peaks = []
+    for entries in (5000, 50000):
+        name = 'compacted-{}'.format(entries)
+        compacted_session(session_dir, name, entries)
+        tracemalloc.start()
+        try:
+            assert generator.generate_session_report(name, session_dir)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+    assert peaks[1] < 3 * peaks[0], 'Report memory grew with the session: {}'.format(peaks)
+
+def test_report_rerendered_for_earlier_entry(tmpdir):
+    """Test that an entry belonging before those reported renders the report again, in timestamp order"""
+    session_dir = str(tmpdir.mkdir('sessions'))
+    reports_dir = str(tmpdir.mkdir('reports'))
+    generator = SessionReportGenerator(reports_dir, 'test_session')
+    session = Session('merged', session_dir)
+    session.process_session_cmd('[2020-01-01 10:00:05]', 'Later')
+    session.close()
+    assert generator.generate_session_report('merged', session_dir)
+    session = Session('merged', session_dir)
+    session.process_session_cmd('[2020-01-01 10:00:01]', 'Earlier')
+    session.close()
+    assert not generator.update_report(os.path.join(reports_dir, 'merged.html'), 'merged', session_dir), 'Earlier entry was appended'
+    assert generator.generate_session_report('merged', session_dir)
+    content = read_report(reports_dir, 'merged')
+    assert content.index('Earlier') < content.index('Later')
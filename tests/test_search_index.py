@@ -0,0 +1,51 @@
+import os
+import pytest
+from test_session.search_index import SearchIndex
+from test_session.session import Session
+
+@pytest.fixture
+def session_dir(tmpdir):
+    return str(tmpdir)
+
+def record(session_dir, session_name, lines, index=None):
+    session = Session(session_name, session_dir)
+    if index:
+        index.watch(session)
+    for epoch, line in lines:
+        session.process_session_cmd(epoch, line)
+    session.close()
+    if index:
+        index.commit()
+
+def test_search_live_recorded_entries(session_dir):
+    """Test that entries are searchable as soon as they are recorded"""
+    index = SearchIndex(session_dir)
+    session = Session('Checkout', session_dir)
+    index.watch(session)
+    session.process_session_cmd(1580462100, 'Payment page loads slowly')
+    session.process_session_cmd(1580462200, Session.BUG_CMD + ' Payment declined twice')
+    results = index.search('payment')
+    assert sorted(row[1] for row in results) == ['bug', 'log'], 'Unexpected search results'
+    assert [row[3] for row in index.search('payment', bugs_only=True)] == [' Payment declined twice'], 'Unexpected bug results'
+    session.process_session_cmd(1580462300, Session.UNDO_CMD)
+    assert len(index.search('declined')) == 0, 'Undone entry is still indexed'
+    session.close()
+
+def test_search_filters(session_dir):
+    index = SearchIndex(session_dir)
+    record(session_dir, 'Login', [(1580462100, Session.AREAS_CMD + ' Auth, UI'), (1580462100, 'Timeout on login')], index)
+    record(session_dir, 'Search', [(1590000000, Session.AREAS_CMD + ' Search'), (1590000000, 'Timeout on search')], index)
+    assert [row[0] for row in index.search('timeout', area='auth')] == ['Login'], 'Area filter failed'
+    assert [row[0] for row in index.search('timeout', since=1585000000)] == ['Search'], 'Date filter failed'
+    assert [row[0] for row in index.search('timeout', until=1585000000)] == ['Login'], 'Date filter failed'
+    assert [row[1] for row in index.search('auth')] == ['areas'], 'Areas were not indexed'
+    assert index.search('"') == [], 'Query syntax was not escaped'
+    assert len(index.search('time*')) == 2, 'Prefix search failed'
+
+def test_refresh_picks_up_unwatched_changes(session_dir):
+    """Test that sessions recorded or deleted without the index are caught up before searching"""
+    index = SearchIndex(session_dir)
+    record(session_dir, 'Offline', [(1580462100, Session.MISSION_CMD + ' Explore offline mode')])
+    assert [row[0] for row in index.search('offline')] == ['Offline'], 'Unwatched session was not indexed'
+    os.remove(os.path.join(session_dir, 'Offline'))
+    assert index.search('offline') == [], 'Deleted session is still indexed'
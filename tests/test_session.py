@@ -2,7 +2,8 @@ import pytest
 import test
 import datetime
 import os
-from modules.session import Session
+from test_session.session import Session
+from test_session.session_timer import DurationTimer
 
 @pytest.fixture
 def session(tmpdir_factory):
@@ -56,14 +57,209 @@ def test_valid_help_cmd(session, timestamp):
     assert result[Session.TEXT_KEY] == 'mission [statement] \n        Set the Test Mission','Unexpected help command message'
 
 def test_duration_cmd(session, timestamp):
-    test_session = session
     wait_time = 2
-    wait(wait_time)
+    session.timer.start_ns -= wait_time * DurationTimer.NS_PER_SECOND
     result = session.process_session_cmd(timestamp, Session.DURATION_CMD)
     assert result[Session.CMD_KEY] == Session.PASS_THROUGH, 'Unexpected command value'
     assert result[Session.TEXT_KEY] == 'Duration: 0:00:0'+str(wait_time)
 
-def wait(duration_in_seconds):
-    start_time = datetime.datetime.now().replace(microsecond=0)
-    while not ((datetime.datetime.now().replace(microsecond=0) - start_time) == datetime.timedelta(seconds=duration_in_seconds)):
-        pass # Wait 
+def test_ingest_preserves_timestamps(session):
+    lines = ['[2020-01-31 09:15:00] Logged in\n', '2020-01-31T09:16:00.250 bug Checkout fails\n', 'mission Ingested mission\n', 'quit\n', '\n']
+    assert session.ingest(lines) == 3, 'Unexpected number of applied lines'
+    log = session.store.data[Session.LOG_KEY]
+    assert [entry.date for entry in log] == ['[2020-01-31 09:15:00]', '[2020-01-31 09:16:00]'], 'Timestamps were not preserved'
+    assert log[1].bug, 'Bug command was not applied'
+    assert session.store.data[Session.MISSION_KEY] == ' Ingested mission', 'Mission command was not applied'
+
+def test_ingest_keeps_lines_with_invalid_dates(session):
+    lines = ['2020-02-30 10:00:00 release notes look odd\n', 'Next note\n']
+    assert session.ingest(lines) == 2, 'Unexpected number of applied lines'
+    log = session.store.data[Session.LOG_KEY]
+    assert [entry.text for entry in log] == [' 2020-02-30 10:00:00 release notes look odd', ' Next note'], 'Line was not kept as a note'
+
+def test_ingest_commits_in_batches(session):
+    session.INGEST_BATCH_SIZE = 10
+    assert session.ingest('Note ' + str(i) for i in range(25)) == 25, 'Unexpected number of applied lines'
+    data = Session.get_session_data('TestSession', session.session_dir)
+    assert len(data[Session.LOG_KEY]) == 25, 'Ingested entries were not written'
+
+def test_command_prefix_is_a_note(session, timestamp):
+    """Test that a note starting with a command name is not taken as that command"""
+    session.process_session_cmd(timestamp, 'bugfix verified')
+    session.process_session_cmd(timestamp, 'undo button greyed out')
+    log = session.store.data[Session.LOG_KEY]
+    assert [entry.bug for entry in log] == [False, False], 'Note was recorded as a bug'
+    assert log[1].text == ' undo button greyed out', 'Note was taken as undo'
+
+def test_register_command(tmpdir_factory, timestamp):
+    class PluginSession(Session):
+        pass
+    def todo(session, timestamp, args):
+        return session.result('Todo:' + args)
+    PluginSession.register_command('todo', todo, 'todo [text] \n        Record a todo')
+    session = PluginSession('PluginSession', str(tmpdir_factory.mktemp('test')))
+    assert session.process_session_cmd(timestamp, 'todo retest')[Session.TEXT_KEY] == 'Todo: retest', 'Plugin command was not dispatched'
+    assert session.process_session_cmd(timestamp, Session.HELP_CMD + ' todo')[Session.TEXT_KEY].startswith('todo'), 'Plugin help missing'
+    assert 'todo' not in Session.COMMANDS, 'Plugin leaked into the base session commands'
+
+def test_timebox_is_parsed(session, timestamp):
+    session.process_session_cmd(timestamp, Session.TIMEBOX_CMD + ' 1h30')
+    assert session.store.data[Session.TIMEBOX_KEY] == 5400, 'Timebox was not saved in seconds'
+    result = session.process_session_cmd(timestamp, Session.TIMEBOX_CMD + ' after lunch')
+    assert result[Session.TEXT_KEY].startswith('Invalid time box'), 'Invalid timebox was accepted'
+    assert session.store.data[Session.TIMEBOX_KEY] == 5400, 'Invalid timebox replaced the timebox'
+
+def test_timebox_overrun_warns_once(session, timestamp):
+    session.process_session_cmd(timestamp, Session.TIMEBOX_CMD + ' 30m')
+    assert session.check_timebox() is None, 'Unexpected warning within timebox'
+    session.timer.total_ns += 45 * 60 * DurationTimer.NS_PER_SECOND
+    assert session.check_timebox() == 'Timebox of 0:30:00 exceeded by 0:15:00', 'Unexpected overrun warning'
+    assert session.check_timebox() is None, 'Overrun was warned twice'
+
+def test_pause_survives_reopen(tmpdir_factory, timestamp):
+    """Test that a session left paused resumes paused from its duration at the pause"""
+    session_dir = str(tmpdir_factory.mktemp('test'))
+    session = Session('Paused', session_dir)
+    session.timer.total_ns += 90 * DurationTimer.NS_PER_SECOND
+    session.process_session_cmd(timestamp, Session.PAUSE_CMD)
+    session.store.close()
+    session = Session('Paused', session_dir)
+    assert session.paused, 'Reopened session was not paused'
+    assert session.timer.get_duration() == datetime.timedelta(seconds=90), 'Unexpected duration after reopen'
+    session.process_session_cmd(timestamp, 'Resumed')
+    assert not session.paused, 'Session did not resume on entry'
+    events = [event[0] for event in session.store.data[Session.PAUSES_KEY]]
+    assert events == [Session.PAUSE_EVENT, Session.RESUME_EVENT], 'Unexpected pause events'
+
+def test_idle_pause(session, timestamp):
+    session.process_session_cmd(timestamp, Session.IDLE_CMD + ' 10m')
+    session.timer.last_activity_ns -= 25 * 60 * DurationTimer.NS_PER_SECOND
+    session.timer.start_ns -= 25 * 60 * DurationTimer.NS_PER_SECOND
+    result = session.process_session_cmd(timestamp, 'Back')
+    assert result[Session.TEXT_KEY] == 'Session was idle, paused for 0:15:00', 'Idle pause was not reported'
+    assert session.timer.get_duration() == datetime.timedelta(minutes=10), 'Idle time was counted'
+    assert not session.paused, 'Session did not resume on entry'
+
+def test_concurrent_sessions_merge_by_timestamp(tmpdir_factory):
+    session_dir = str(tmpdir_factory.mktemp('test'))
+    first = Session('Pair', session_dir)
+    second = Session('Pair', session_dir)
+    first.process_session_cmd('[2020-01-01 10:00:00]', 'First')
+    second.process_session_cmd('[2020-01-01 10:00:02]', 'Third')
+    first.process_session_cmd('[2020-01-01 10:00:01]', 'Second')
+    first.close()
+    second.close()
+    log = Session.get_session_data('Pair', session_dir)[Session.LOG_KEY]
+    assert [entry.text for entry in log] == [' First', ' Second', ' Third'], 'Entries were not merged by timestamp'
+    assert [entry.text for entry in Session.iter_log('Pair', session_dir)] == [' First', ' Second', ' Third'], 'Streamed entries were not merged by timestamp'
+
+def test_archived_session_header(tmpdir_factory, timestamp):
+    """Test that an archived session keeps its header, summary and log"""
+    session_dir = str(tmpdir_factory.mktemp('test'))
+    session = Session('Archived', session_dir)
+    session.process_session_cmd(timestamp, Session.MISSION_CMD + ' Mission')
+    session.process_session_cmd(timestamp, Session.TIMEBOX_CMD + ' 30m')
+    session.process_session_cmd(timestamp, 'Entry')
+    session.process_session_cmd(timestamp, Session.BUG_CMD + ' Bug')
+    session.close()
+    assert Session.archive('Archived', session_dir), 'Session was not archived'
+    header = Session.get_session_header('Archived', session_dir)
+    assert header[Session.MISSION_KEY] == ' Mission' and header[Session.TIMEBOX_KEY] == 1800, 'Unexpected archived header'
+    summary = Session.get_session_summary('Archived', session_dir)
+    assert (summary['bug_count'], summary['entry_count'], summary['archived']) == (1, 2, True), 'Unexpected archived summary'
+    assert [entry.text for entry in Session.iter_log('Archived', session_dir)] == [' Entry', ' Bug']
+    session = Session('Archived', session_dir)
+    assert len(session.store.data[Session.LOG_KEY]) == 2, 'Archived session did not reopen'
+    session.close()
+
+def test_screenshot_cmd(tmpdir, timestamp, monkeypatch):
+    """Test that a screenshot is logged by its digest and stored beside the sessions"""
+    monkeypatch.setenv('TESTRECORDER_SCREENSHOT', 'placeholder')
+    session_dir = str(tmpdir.mkdir('sessions'))
+    session = Session('Screenshots', session_dir)
+    result = session.process_session_cmd(timestamp, Session.SCREENSHOT_CMD)
+    assert result[Session.TEXT_KEY] == 'Screenshot saved', 'Unexpected command message'
+    session.close()
+    entry, = Session.iter_log('Screenshots', session_dir)
+    assert entry.screenshot, 'Screenshot was not logged'
+    assert os.path.exists(str(tmpdir.join('attachments', 'objects', entry.text[:2], entry.text[2:] + '.png')))
+
+def test_failed_screenshot_is_reported(tmpdir, timestamp, monkeypatch):
+    """Test that a screenshot whose image could not be written is reported on close and logged as a note"""
+    from test_session.attachments import AttachmentStore
+    monkeypatch.setenv('TESTRECORDER_SCREENSHOT', 'placeholder')
+    def fail(path, data):
+        raise OSError('No space left on device')
+    monkeypatch.setattr(AttachmentStore, 'write_blob', staticmethod(fail))
+    session_dir = str(tmpdir.mkdir('sessions'))
+    session = Session('Screenshots', session_dir)
+    session.process_session_cmd(timestamp, Session.SCREENSHOT_CMD)
+    messages = session.close()
+    assert len(messages) == 1 and 'No space left on device' in messages[0], 'Failure was not reported'
+    entry, = Session.iter_log('Screenshots', session_dir)
+    assert not entry.screenshot and 'could not be saved' in entry.text, 'Entry still refers to the missing image'
+
+def test_undo_empty_log(session, timestamp):
+    """Test that undo on an empty session reports there is nothing to undo"""
+    result = session.process_session_cmd(timestamp, Session.UNDO_CMD)
+    assert result[Session.TEXT_KEY] == 'Nothing to undo', 'Unexpected command message'
+    result = session.process_session_cmd(timestamp, Session.REDO_CMD)
+    assert result[Session.TEXT_KEY] == 'Nothing to redo', 'Unexpected command message'
+
+def test_undo_after_reopening_removes_latest_entry(session):
+    """Test that undo without history removes the latest entry by time, not the last one written"""
+    session.ingest(['2020-01-31 09:20:00 Late\n', '2020-01-31 09:10:00 Early\n'])
+    session.close()
+    session = Session('TestSession', session.session_dir)
+    result = session.process_session_cmd('[2020-01-31 09:30:00]', Session.UNDO_CMD)
+    assert result[Session.TEXT_KEY] == 'Last entry removed', 'Unexpected command message'
+    assert [entry.text for entry in session.store.data[Session.LOG_KEY]] == [' Early'], 'Unexpected entry removed'
+    session.close()
+
+def test_undo_redo_history(session, timestamp):
+    """Test that entries and field changes are undone and redone in order"""
+    session.process_session_cmd(timestamp, 'mission First')
+    session.process_session_cmd(timestamp, 'Entry 1')
+    session.process_session_cmd(timestamp, 'mission Second')
+    session.process_session_cmd(timestamp, 'Entry 2')
+    texts = lambda: [entry.text for entry in session.store.data[Session.LOG_KEY]]
+    for _ in range(2):
+        session.process_session_cmd(timestamp, Session.UNDO_CMD)
+    assert texts() == [' Entry 1']
+    assert session.store.data[Session.MISSION_KEY] == ' First'
+    result = session.process_session_cmd(timestamp, Session.REDO_CMD)
+    assert result[Session.TEXT_KEY] == 'Test mission change redone'
+    session.process_session_cmd(timestamp, Session.REDO_CMD)
+    assert texts() == [' Entry 1', ' Entry 2']
+    assert session.process_session_cmd(timestamp, Session.REDO_CMD)[Session.TEXT_KEY] == 'Nothing to redo'
+    session.close()
+    data = Session.get_session_data(session.session_name, session.session_dir)
+    assert [entry.text for entry in data[Session.LOG_KEY]] == [' Entry 1', ' Entry 2']
+    assert data[Session.MISSION_KEY] == ' Second'
+
+def test_edit_cmd(session, timestamp):
+    """Test that an edited entry keeps its place and kind and can be undone"""
+    session.process_session_cmd(timestamp, 'Entry 1')
+    session.process_session_cmd(timestamp, 'bug Bug 2')
+    result = session.process_session_cmd(timestamp, 'edit 2 Bug two')
+    assert result[Session.TEXT_KEY] == 'Entry 2 updated', 'Unexpected command message'
+    assert session.process_session_cmd(timestamp, 'edit 3 Missing')[Session.TEXT_KEY] == 'There is no entry 3'
+    session.store.flush()
+    entries = list(Session.iter_log(session.session_name, session.session_dir))
+    assert entries[1].bug and entries[1].text == ' Bug two'
+    session.process_session_cmd(timestamp, Session.UNDO_CMD)
+    assert session.store.data[Session.LOG_KEY][1].text == ' Bug 2'
+    session.process_session_cmd(timestamp, Session.REDO_CMD)
+    session.close()
+    data = Session.get_session_data(session.session_name, session.session_dir)
+    assert [entry.text for entry in data[Session.LOG_KEY]] == [' Entry 1', ' Bug two']
+
+def test_edit_numbers_entries_as_shown(session):
+    """Test that edit numbers entries in the timestamp order show lists them in"""
+    session.process_session_cmd('[2020-01-01 10:00:05]', 'Later')
+    session.process_session_cmd('[2020-01-01 10:00:01]', 'Earlier')
+    session.process_session_cmd('[2020-01-01 10:00:09]', 'edit 1 First')
+    session.store.flush()
+    entries = list(Session.iter_log(session.session_name, session.session_dir))
+    assert [entry.text for entry in entries] == [' First', ' Later'], 'Edit numbered entries differently from show'
+    session.close()
@@ -0,0 +1,92 @@
+import os
+import pytest
+from test_session.session import Session
+from test_session.session_catalog import SessionCatalog
+
+@pytest.fixture
+def session_dir(tmpdir):
+    return str(tmpdir)
+
+def record_session(session_dir, session_name, bugs=0):
+    session = Session(session_name, session_dir)
+    session.process_session_cmd('[2020-01-01 10:00:00]', Session.MISSION_CMD + ' Mission')
+    for _ in range(bugs):
+        session.process_session_cmd('[2020-01-01 10:00:00]', Session.BUG_CMD + ' Bug')
+    session.close()
+    return session
+
+def test_update_and_lookup(session_dir):
+    """Test that a saved session can be found, completed and listed"""
+    catalog = SessionCatalog(session_dir)
+    session = record_session(session_dir, 'Checkout', bugs=2)
+    catalog.update('Checkout', session.store.data)
+    assert catalog.contains('Checkout'), 'Session was not catalogued'
+    assert not catalog.contains('Check'), 'Unexpected partial match'
+    row = catalog.sessions()[0]
+    assert row['bug_count'] == 2, 'Unexpected bug count'
+    assert row['mission'] == ' Mission', 'Unexpected mission'
+
+def test_complete_prefix(session_dir):
+    catalog = SessionCatalog(session_dir)
+    for name in ['login', 'logout', 'search']:
+        catalog.update(name, record_session(session_dir, name).store.data)
+    assert catalog.complete('log') == ['login', 'logout'], 'Unexpected completions'
+    assert catalog.complete('') == ['login', 'logout', 'search'], 'Unexpected completions'
+    assert catalog.complete('x') == [], 'Unexpected completions'
+
+def test_rebuild_on_drift(session_dir):
+    """Test that sessions added or deleted outside the catalog are picked up"""
+    catalog = SessionCatalog(session_dir)
+    record_session(session_dir, 'external', bugs=1)
+    assert catalog.contains('external'), 'New session was not found after drift'
+    assert catalog.sessions()[0]['bug_count'] == 1, 'Drifted session was not read'
+    os.remove(os.path.join(session_dir, 'external'))
+    assert not catalog.contains('external'), 'Deleted session is still catalogued'
+
+def test_catalog_persists(session_dir):
+    catalog = SessionCatalog(session_dir)
+    catalog.update('kept', record_session(session_dir, 'kept').store.data)
+    catalog.close()
+    assert SessionCatalog(session_dir).complete('k') == ['kept'], 'Catalog was not persisted'
+
+def test_sort_by_duration_and_overrun(session_dir):
+    catalog = SessionCatalog(session_dir)
+    for name, minutes, timebox in [('a', 30, '1h'), ('b', 50, '30m'), ('c', 40, None), ('d', None, None)]:
+        session = record_session(session_dir, name)
+        if timebox:
+            session.store.data[Session.TIMEBOX_KEY] = Session.DECODERS[Session.TIMEBOX_KEY](timebox)
+        session.store.data[Session.DURATION_KEY] = minutes and minutes * 60
+        catalog.update(name, session.store.data)
+    assert [row['name'] for row in catalog.sessions('duration')] == ['b', 'c', 'a', 'd'], 'Unexpected duration order'
+    rows = catalog.sessions('overrun')
+    assert [row['name'] for row in rows][:2] == ['b', 'a'], 'Unexpected overrun order'
+    assert rows[0]['overrun'] == 20 * 60, 'Unexpected overrun'
+
+def test_archived_sessions(session_dir):
+    """Test that archived sessions stay listed and are not picked for archiving again"""
+    catalog = SessionCatalog(session_dir)
+    record_session(session_dir, 'Old', bugs=1)
+    record_session(session_dir, 'New')
+    os.utime(os.path.join(session_dir, 'Old'), (0, 1000))
+    assert catalog.unarchived(2000) == ['Old'], 'Unexpected sessions to archive'
+    Session.archive('Old', session_dir)
+    catalog.mark_archived('Old')
+    assert catalog.unarchived(2000) == [], 'Archived session picked again'
+    catalog.close()
+    os.remove(os.path.join(session_dir, SessionCatalog.FILENAME))
+    rows = {row['name']: row for row in SessionCatalog(session_dir).sessions()}
+    assert rows['Old']['archived'] and rows['Old']['bug_count'] == 1, 'Archive was not catalogued from its summary'
+    assert not rows['New']['archived']
+
+def test_rebuild_on_session_written_in_place(session_dir):
+    """Test that a session another recorder appended to is read again, though the directory did not change"""
+    catalog = SessionCatalog(session_dir)
+    catalog.update('shared', record_session(session_dir, 'shared', bugs=1).store.data)
+    path = os.path.join(session_dir, 'shared')
+    mtime = os.stat(path).st_mtime_ns
+    session = Session('shared', session_dir)
+    session.process_session_cmd('[2020-01-01 10:00:01]', Session.BUG_CMD + ' Another bug')
+    session.close()
+    # Same mtime, as on filesystems with a coarse clock, only the size differs
+    os.utime(path, ns=(mtime, mtime))
+    assert catalog.sessions()[0]['bug_count'] == 2, 'Session changed in place was not read again'
@@ -0,0 +1,85 @@
+import os
+import pytest
+from test_session.session import Session
+from test_session.session_store import JournalStore
+from test_session.test_session_recorder import TestSessionRecorder
+
+@pytest.fixture
+def recorder(tmpdir, monkeypatch):
+    """Create a recorder with its sessions in a temporary directory"""
+    monkeypatch.setattr(TestSessionRecorder, 'SESSION_DIR', str(tmpdir.mkdir('sessions')))
+    monkeypatch.setattr(TestSessionRecorder, 'columns', 80)
+    monkeypatch.setattr(TestSessionRecorder, 'rows', 5)
+    recorder = TestSessionRecorder()
+    recorder.preloop()
+    yield recorder
+    recorder.close()
+
+def record(recorder, name, *lines):
+    session = Session(name, recorder.SESSION_DIR)
+    for index, line in enumerate(lines):
+        session.process_session_cmd('[2020-01-01 10:{:02d}:00]'.format(index), line)
+    session.close()
+
+def test_show_filters(recorder, capsys):
+    """Test that show can limit the log to its tail, a start date and bugs"""
+    record(recorder, 'filtered', 'Entry 0', 'bug Bug 1', 'Entry 2', 'bug Bug 3', 'Entry 4')
+    recorder.do_show('filtered --tail 2')
+    output = capsys.readouterr().out
+    assert 'Bug 3' in output and 'Entry 4' in output and 'Entry 2' not in output
+    recorder.do_show('filtered --since "2020-01-01 10:02:00" --bugs-only')
+    output = capsys.readouterr().out
+    assert 'Bug 3' in output and 'Bug 1' not in output and 'Entry' not in output
+    recorder.do_show('missing')
+    assert 'There is no test session with that name' in capsys.readouterr().out
+
+def test_show_pager(recorder, capsys, monkeypatch):
+    """Test that the pager stops reading the log when asked to"""
+    record(recorder, 'paged', *['Entry {}'.format(index) for index in range(10)])
+    answers = iter(['', 'q'])
+    monkeypatch.setattr('builtins.input', lambda prompt='': next(answers))
+    header = Session.get_session_header('paged', recorder.SESSION_DIR)
+    read = []
+    def entries():
+        for entry in Session.iter_log('paged', recorder.SESSION_DIR):
+            read.append(entry)
+            yield entry
+    recorder.show_session(header, enumerate(entries(), 1), pager=True)
+    output = capsys.readouterr().out
+    assert 'Entry 5' in output and 'Entry 6' not in output
+    assert len(read) == 7, 'Entries were read past the page shown'
+
+def test_open_shows_tail(recorder, capsys, monkeypatch):
+    """Test that opening a long session only shows its latest entries"""
+    monkeypatch.setattr(TestSessionRecorder, 'OPEN_TAIL', 3)
+    record(recorder, 'long', *['Entry {}'.format(index) for index in range(10)])
+    recorder.do_open('long')
+    output = capsys.readouterr().out
+    assert '(7 earlier entries' in output
+    assert 'Entry 6' not in output and 'Entry 9' in output
+    assert recorder.session.session_name == 'long'
+
+def test_quit_archives_only_when_asked(recorder, capsys, monkeypatch):
+    """Test that quitting archives idle sessions only when configured to, a bounded number of them named"""
+    monkeypatch.delenv(TestSessionRecorder.ARCHIVE_DAYS_ENV, raising=False)
+    for name in ('idle-1', 'idle-2', 'idle-3'):
+        record(recorder, name, 'Entry')
+        os.utime(os.path.join(recorder.SESSION_DIR, name), (0, 0))
+    recorder.do_quit('')
+    assert not JournalStore.is_archive(os.path.join(recorder.SESSION_DIR, 'idle-1')), 'Sessions were archived without being asked to'
+    assert 'archived' not in capsys.readouterr().out
+    monkeypatch.setenv(TestSessionRecorder.ARCHIVE_DAYS_ENV, '30')
+    monkeypatch.setattr(TestSessionRecorder, 'ARCHIVE_ON_QUIT', 2)
+    recorder.do_quit('')
+    assert 'archived: idle-1, idle-2' in capsys.readouterr().out, 'Archived sessions were not named'
+    recorder.do_quit('')
+    assert 'archived: idle-3' in capsys.readouterr().out
+    assert JournalStore.is_archive(os.path.join(recorder.SESSION_DIR, 'idle-3'))
+
+def test_unbalanced_quote_is_reported(recorder, capsys):
+    """Test that arguments that can not be split are reported rather than ignored"""
+    recorder.do_report("O'Brien")
+    assert 'Invalid arguments: No closing quotation' in capsys.readouterr().out
+    record(recorder, "O'Brien", 'Entry')
+    recorder.do_show('"O\'Brien" --no-pager')
+    assert 'Entry' in capsys.readouterr().out
@@ -0,0 +1,360 @@
+import datetime
+import os
+import shelve
+import threading
+import time
+import pytest
+from test_session.session import Session
+from test_session.session_store import JournalStore
+
+@pytest.fixture
+def journal_path(tmpdir):
+    return os.path.join(str(tmpdir), 'JournalSession')
+
+def test_replay_rebuilds_session_data(journal_path):
+    """Test that every journaled change is rebuilt when the journal is replayed"""
+    store = JournalStore(journal_path, Session.new_session_data())
+    store.set(Session.MISSION_KEY, 'Mission')
+    store.append(Session.LOG_KEY, {'date': '[2020-01-01 10:00:00]', 'entry': ' Entry 1', 'bug': False})
+    store.append(Session.LOG_KEY, {'date': '[2020-01-01 10:00:01]', 'entry': ' Entry 2', 'bug': True})
+    store.pop(Session.LOG_KEY)
+    store.set(Session.DURATION_KEY, datetime.timedelta(seconds=90))
+    store.close()
+    data = JournalStore.load(journal_path, Session.new_session_data())
+    assert data[Session.MISSION_KEY] == 'Mission', 'Mission was not replayed'
+    assert [e['entry'] for e in data[Session.LOG_KEY]] == [' Entry 1'], 'Log was not replayed'
+    assert data[Session.DURATION_KEY] == datetime.timedelta(seconds=90), 'Duration was not replayed'
+
+def test_entries_survive_without_close(journal_path):
+    """Test that entries are on disk before the store is closed"""
+    store = JournalStore(journal_path, Session.new_session_data())
+    store.append(Session.LOG_KEY, {'date': '[2020-01-01 10:00:00]', 'entry': ' Entry', 'bug': False})
+    data = JournalStore.load(journal_path, Session.new_session_data())
+    assert len(data[Session.LOG_KEY]) == 1, 'Entry was not written through to the journal'
+    store.close()
+
+def test_torn_record_is_ignored(journal_path):
+    """Test that a partially written record from a crash does not break replay"""
+    store = JournalStore(journal_path, Session.new_session_data())
+    store.set(Session.MISSION_KEY, 'Mission')
+    store.close()
+    with open(journal_path, 'a') as journal:
+        journal.write('{"op":"set","key":"test_mis')
+    store = JournalStore(journal_path, Session.new_session_data())
+    store.set(Session.TIMEBOX_KEY, '30')
+    store.close()
+    data = JournalStore.load(journal_path, Session.new_session_data())
+    assert data[Session.MISSION_KEY] == 'Mission', 'Unexpected mission'
+    assert data[Session.TIMEBOX_KEY] == '30', 'Record after a torn write was lost'
+
+def test_pop_empty_log(journal_path):
+    store = JournalStore(journal_path, Session.new_session_data())
+    with pytest.raises(IndexError):
+        store.pop(Session.LOG_KEY)
+    store.close()
+
+def test_legacy_shelve_is_migrated(journal_path):
+    """Test that a session saved as a shelve is read and converted to a journal"""
+    legacy = shelve.open(journal_path)
+    data = Session.new_session_data()
+    data[Session.MISSION_KEY] = 'Legacy Mission'
+    data[Session.LOG_KEY].append({'date': '[2020-01-01 10:00:00]', 'entry': ' Old', 'bug': False})
+    legacy[Session.SESSION_KEY] = data
+    legacy.close()
+    assert Session.get_session_data('JournalSession', os.path.dirname(journal_path))[Session.MISSION_KEY] == 'Legacy Mission'
+    session = Session('JournalSession', os.path.dirname(journal_path))
+    session.process_session_cmd('[2020-01-01 10:00:01]', 'New')
+    session.close()
+    assert JournalStore.is_journal(journal_path), 'Legacy shelve was not migrated'
+    data = Session.get_session_data('JournalSession', os.path.dirname(journal_path))
+    assert [e.text for e in data[Session.LOG_KEY]] == [' Old', ' New'], 'Unexpected migrated log'
+
+def test_legacy_timebox_and_duration_are_seconds(journal_path):
+    """Test that timebox text and timedelta durations are read as seconds"""
+    legacy = shelve.open(journal_path)
+    data = Session.new_session_data()
+    data[Session.TIMEBOX_KEY] = '1h30'
+    data[Session.DURATION_KEY] = datetime.timedelta(minutes=20)
+    legacy[Session.SESSION_KEY] = data
+    legacy.close()
+    session = Session('JournalSession', os.path.dirname(journal_path))
+    session.close()
+    data = Session.get_session_data('JournalSession', os.path.dirname(journal_path))
+    assert data[Session.TIMEBOX_KEY] == 5400, 'Timebox was not parsed'
+    assert data[Session.DURATION_KEY] == 1200, 'Duration was not converted'
+    assert session.get_duration() == datetime.timedelta(minutes=20), 'Unexpected duration'
+
+def test_iter_values_streams_surviving_entries(journal_path):
+    """Test that streaming the log skips undone entries without loading the session"""
+    store = JournalStore(journal_path, Session.new_session_data())
+    for i in range(5):
+        store.append(Session.LOG_KEY, {'date': '[2020-01-01 10:00:00]', 'entry': ' ' + str(i), 'bug': False})
+    store.pop(Session.LOG_KEY)
+    store.pop(Session.LOG_KEY)
+    store.append(Session.LOG_KEY, {'date': '[2020-01-01 10:00:00]', 'entry': ' 5', 'bug': False})
+    store.set(Session.MISSION_KEY, 'Mission')
+    store.close()
+    entries = JournalStore.iter_values(journal_path, Session.LOG_KEY)
+    assert [e['entry'] for e in entries] == [' 0', ' 1', ' 2', ' 5'], 'Unexpected streamed entries'
+    header = JournalStore.load(journal_path, Session.new_session_data(), skip_keys=(Session.LOG_KEY,))
+    assert header[Session.LOG_KEY] == [], 'Skipped log was loaded'
+    assert header[Session.MISSION_KEY] == 'Mission', 'Unexpected header'
+
+def test_concurrent_writers_share_the_journal(journal_path):
+    """Test that two stores on one journal see each other's entries and undo their own"""
+    first = JournalStore(journal_path, Session.new_session_data())
+    second = JournalStore(journal_path, Session.new_session_data())
+    first.append(Session.LOG_KEY, 'first 1')
+    second.append(Session.LOG_KEY, 'second 1')
+    first.append(Session.LOG_KEY, 'first 2')
+    second.pop(Session.LOG_KEY)
+    assert JournalStore.load(journal_path, Session.new_session_data())[Session.LOG_KEY] == ['first 1', 'first 2'], 'Unexpected log'
+    second.append(Session.LOG_KEY, 'second 2')
+    assert second.data[Session.LOG_KEY] == ['first 1', 'first 2', 'second 2'], 'Writer did not catch up'
+    assert len(set(second.ids[Session.LOG_KEY])) == 3, 'Writers reused an id'
+    first.close()
+    second.close()
+    entries = list(JournalStore.iter_values(journal_path, Session.LOG_KEY))
+    assert entries == ['first 1', 'first 2', 'second 2'], 'Unexpected merged log'
+
+def test_compaction_by_another_writer(journal_path):
+    first = JournalStore(journal_path, Session.new_session_data())
+    second = JournalStore(journal_path, Session.new_session_data())
+    first.append(Session.LOG_KEY, 'first')
+    second.append(Session.LOG_KEY, 'second')
+    first.compact()
+    second.append(Session.LOG_KEY, 'after compaction')
+    first.append(Session.LOG_KEY, 'last')
+    second.pop(Session.LOG_KEY)
+    first.close()
+    second.close()
+    data = JournalStore.load(journal_path, Session.new_session_data())
+    assert data[Session.LOG_KEY] == ['first', 'second', 'last'], 'Entries were lost to compaction'
+
+def test_read_does_not_wait_for_writers(journal_path):
+    store = JournalStore(journal_path, Session.new_session_data())
+    store.append(Session.LOG_KEY, 'entry')
+    with store.batch():
+        store.append(Session.LOG_KEY, 'uncommitted')
+        data = JournalStore.load(journal_path, Session.new_session_data())
+    assert data[Session.LOG_KEY] == ['entry'], 'Unexpected read while locked'
+    store.close()
+
+def append_entries(journal_path, writer, count):
+    store = JournalStore(journal_path, Session.new_session_data())
+    for i in range(count):
+        store.append(Session.LOG_KEY, '{} {}'.format(writer, i))
+    store.close()
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='Needs fork')
+def test_concurrent_processes_lose_no_entries(journal_path):
+    import multiprocessing
+    context = multiprocessing.get_context('fork')
+    writers = [context.Process(target=append_entries, args=(journal_path, writer, 200)) for writer in range(4)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    data = JournalStore(journal_path, Session.new_session_data())
+    assert len(data.data[Session.LOG_KEY]) == 800, 'Entries were lost'
+    assert len(set(data.ids[Session.LOG_KEY])) == 800, 'Writers reused an id'
+    data.close()
+
+def test_write_behind_flushes_in_background(journal_path):
+    store = JournalStore(journal_path, Session.new_session_data())
+    store.start_write_behind(interval=0.05, max_pending=8)
+    assert store.queue.maxsize == 8, 'Unexpected queue bound'
+    store.append(Session.LOG_KEY, 'entry')
+    assert store.data[Session.LOG_KEY] == ['entry'], 'Entry was not applied straight away'
+    for _ in range(100):
+        if JournalStore.load(journal_path, Session.new_session_data())[Session.LOG_KEY]:
+            break
+        time.sleep(0.01)
+    assert JournalStore.load(journal_path, Session.new_session_data())[Session.LOG_KEY] == ['entry'], 'Entry was not flushed on the interval'
+    store.flush()
+    assert store.metrics.flushes >= 1 and store.metrics.max_seconds > 0, 'Flush latency was not recorded'
+    store.close()
+
+def test_write_behind_flush_and_close(journal_path):
+    store = JournalStore(journal_path, Session.new_session_data())
+    store.start_write_behind(interval=60)
+    for i in range(10):
+        store.append(Session.LOG_KEY, i)
+    store.pop(Session.LOG_KEY)
+    with store.batch():
+        store.append(Session.LOG_KEY, 'batched')
+    store.flush()
+    assert JournalStore.load(journal_path, Session.new_session_data())[Session.LOG_KEY] == list(range(9)) + ['batched'], 'Flush did not write every record'
+    store.set(Session.MISSION_KEY, 'Mission')
+    store.close()
+    assert JournalStore.load(journal_path, Session.new_session_data())[Session.MISSION_KEY] == 'Mission', 'Close did not flush'
+
+def test_write_behind_notifies_listeners_on_writer_thread(journal_path):
+    """Test that listeners run once records are written, off the caller's thread"""
+    store = JournalStore(journal_path, Session.new_session_data())
+    store.start_write_behind(interval=60)
+    notified = []
+    store.listeners.append(lambda record: notified.append((record['value'], threading.current_thread())))
+    store.append(Session.LOG_KEY, 'entry')
+    with store.batch():
+        store.append(Session.LOG_KEY, 'batched')
+    assert not notified, 'Listener ran before the records were written'
+    store.flush()
+    assert [value for value, _ in notified] == ['entry', 'batched'], 'Listener missed records'
+    assert all(thread is store.writer for _, thread in notified), 'Listener ran on the caller thread'
+    def fail(record):
+        raise ValueError('listener failed')
+    store.listeners.append(fail)
+    store.append(Session.LOG_KEY, 'failing')
+    with pytest.raises(ValueError):
+        store.flush()
+    store.close()
+    assert JournalStore.load(journal_path, Session.new_session_data())[Session.LOG_KEY] == ['entry', 'batched', 'failing']
+
+def test_write_behind_ids_do_not_clash(journal_path):
+    """Test that a write-behind store and a synchronous store number entries apart"""
+    background = JournalStore(journal_path, Session.new_session_data())
+    background.start_write_behind(interval=60)
+    background.append(Session.LOG_KEY, 'background')
+    store = JournalStore(journal_path, Session.new_session_data())
+    store.append(Session.LOG_KEY, 'synchronous')
+    background.append(Session.LOG_KEY, 'background 2')
+    background.close()
+    store.close()
+    data = JournalStore(journal_path, Session.new_session_data())
+    assert sorted(data.data[Session.LOG_KEY]) == ['background', 'background 2', 'synchronous'], 'Entries were lost'
+    assert len(set(data.ids[Session.LOG_KEY])) == 3, 'Writers reused an id'
+    data.close()
+
+def test_archive_reads_transparently(journal_path):
+    """Test that an archived journal is compressed, summarised and still replays"""
+    store = JournalStore(journal_path, Session.new_session_data())
+    store.set(Session.MISSION_KEY, 'Mission')
+    for index in range(200):
+        store.append(Session.LOG_KEY, 'entry {}'.format(index))
+    store.pop(Session.LOG_KEY)
+    store.close()
+    os.utime(journal_path, (0, 1000))
+    size = os.path.getsize(journal_path)
+    summarize = lambda data: {'entries': len(data[Session.LOG_KEY])}
+    assert JournalStore.archive(journal_path, Session.new_session_data(), summarize), 'Journal was not archived'
+    assert not JournalStore.archive(journal_path, Session.new_session_data(), summarize), 'Archive was archived again'
+    assert JournalStore.is_archive(journal_path) and not JournalStore.is_journal(journal_path)
+    assert os.path.getsize(journal_path) < size, 'Archive was not compressed'
+    assert os.path.getmtime(journal_path) == 1000, 'Archive did not keep the mtime'
+    assert JournalStore.read_summary(journal_path) == {'entries': 199}, 'Unexpected summary'
+    data = JournalStore.load(journal_path, Session.new_session_data())
+    assert data[Session.MISSION_KEY] == 'Mission', 'Header was not replayed from the archive'
+    assert list(JournalStore.iter_values(journal_path, Session.LOG_KEY))[-1] == 'entry 198', 'Log was not streamed from the archive'
+
+def test_archive_is_restored_for_writing(journal_path):
+    """Test that writers unpack an archive, including one archived while they were open"""
+    store = JournalStore(journal_path, Session.new_session_data())
+    store.append(Session.LOG_KEY, 'first')
+    JournalStore.archive(journal_path, Session.new_session_data(), lambda data: {})
+    store.append(Session.LOG_KEY, 'second')
+    store.close()
+    assert JournalStore.is_journal(journal_path), 'Archive was not restored'
+    JournalStore.archive(journal_path, Session.new_session_data(), lambda data: {})
+    store = JournalStore(journal_path, Session.new_session_data())
+    store.append(Session.LOG_KEY, 'third')
+    store.close()
+    data = JournalStore.load(journal_path, Session.new_session_data())
+    assert data[Session.LOG_KEY] == ['first', 'second', 'third'], 'Entries were lost to archiving'
+
+def test_replace_is_a_delta_record(journal_path):
+    """Test that replacing an item writes one record holding both values"""
+    store = JournalStore(journal_path, Session.new_session_data())
+    ids = [store.append(Session.LOG_KEY, [1577872800 + i, 0, ' ' + str(i)]) for i in range(3)]
+    assert store.replace(Session.LOG_KEY, ids[1], [1577872801, 0, ' one']) == [1577872801, 0, ' 1']
+    store.pop(Session.LOG_KEY, ids[0])
+    store.close()
+    with open(journal_path) as journal:
+        last = journal.read().splitlines()[-2]
+    assert '"op":"replace"' in last and '"previous":[1577872801,0," 1"]' in last
+    entries = JournalStore.iter_values(journal_path, Session.LOG_KEY)
+    assert [e[2] for e in entries] == [' one', ' 2'], 'Unexpected streamed entries'
+    data = JournalStore.load(journal_path, Session.new_session_data())
+    assert [e[2] for e in data[Session.LOG_KEY]] == [' one', ' 2'], 'Unexpected replayed entries'
+
+def test_snapshot_is_written_in_chunks(journal_path, monkeypatch):
+    """Test that compaction writes list items in bounded chunk records that stream and replay"""
+    monkeypatch.setattr(JournalStore, 'CHUNK_ITEMS', 4)
+    store = JournalStore(journal_path, Session.new_session_data())
+    other = JournalStore(journal_path, Session.new_session_data())
+    store.set(Session.MISSION_KEY, 'Mission')
+    for i in range(10):
+        store.append(Session.LOG_KEY, (1577872800 + i, 0, ' ' + str(i)))
+    store.append(Session.AREAS_KEY, 'Login')
+    store.compact()
+    with open(journal_path) as journal:
+        lines = journal.read().splitlines()
+    assert len(lines) == 6, 'Unexpected snapshot records'
+    assert '"chunks":4' in lines[1] and '"op":"chunk"' in lines[2]
+    other.append(Session.LOG_KEY, (1577872900, 0, ' other'))
+    assert len(other.data[Session.LOG_KEY]) == 11, 'Writer did not skip the chunks it had applied'
+    store.close()
+    other.close()
+    entries = list(JournalStore.iter_values(journal_path, Session.LOG_KEY, with_ids=True))
+    assert [item_id for item_id, _ in entries] == list(range(10)) + [11], 'Ids changed'
+    assert list(entries[4][1]) == [1577872804, 0, ' 4']
+    data = JournalStore.load(journal_path, Session.new_session_data())
+    assert data[Session.AREAS_KEY] == ['Login'] and data[Session.MISSION_KEY] == 'Mission'
+    assert len(data[Session.LOG_KEY]) == 11
+
+def test_snapshot_keeps_lists_set_whole(journal_path):
+    """Test that a list set as a whole value, which has no item ids, survives compaction"""
+    store = JournalStore(journal_path, Session.new_session_data())
+    store.set(Session.AREAS_KEY, ['Login', 'Search'])
+    store.append(Session.LOG_KEY, (1577872800, 0, ' entry'))
+    store.compact()
+    store.close()
+    store = JournalStore(journal_path, Session.new_session_data())
+    assert store.data[Session.AREAS_KEY] == ['Login', 'Search'], 'Areas were lost'
+    store.set(Session.AREAS_KEY, ['Checkout'])
+    store.compact()
+    store.close()
+    data = JournalStore.load(journal_path, Session.new_session_data())
+    assert data[Session.AREAS_KEY] == ['Checkout'] and len(data[Session.LOG_KEY]) == 1
+
+@pytest.mark.parametrize('max_runs', [16, 1])
+def test_iter_values_in_order(journal_path, monkeypatch, max_runs):
+    """Test that values added out of order are streamed sorted, merged by run or sorted in memory"""
+    monkeypatch.setattr(JournalStore, 'MAX_RUNS', max_runs)
+    store = JournalStore(journal_path, Session.new_session_data())
+    for epoch in (5, 1, 6, 2, 7, 3, 9, 0, 8):
+        store.append(Session.LOG_KEY, [epoch, 0, ' ' + str(epoch)])
+    store.pop(Session.LOG_KEY)
+    store.replace(Session.LOG_KEY, store.ids[Session.LOG_KEY][1], [1, 0, ' one'])
+    store.append(Session.LOG_KEY, [6, 0, ' 6 again'])
+    store.close()
+    entries = JournalStore.iter_values(journal_path, Session.LOG_KEY, order=lambda entry: entry[0])
+    assert [e[2] for e in entries] == [' 0', ' one', ' 2', ' 3', ' 5', ' 6', ' 6 again', ' 7', ' 9'], 'Unexpected order'
+    data = JournalStore.load(journal_path, Session.new_session_data(), orders={Session.LOG_KEY: lambda entry: entry[0]})
+    assert [e[0] for e in data[Session.LOG_KEY]] == [0, 1, 2, 3, 5, 6, 6, 7, 9], 'Unexpected loaded order'
+
+def test_compaction_sorts_ordered_lists(journal_path):
+    """Test that a snapshot writes an ordered list sorted, keeping ids"""
+    order = lambda entry: entry[0]
+    store = JournalStore(journal_path, Session.new_session_data(), orders={Session.LOG_KEY: order})
+    ids = {epoch: store.append(Session.LOG_KEY, (epoch, 0, '')) for epoch in (3, 1, 2)}
+    store.compact()
+    store.close()
+    entries = list(JournalStore.iter_values(journal_path, Session.LOG_KEY, with_ids=True))
+    assert [(item_id, entry[0]) for item_id, entry in entries] == [(ids[1], 1), (ids[2], 2), (ids[3], 3)]
+
+@pytest.mark.parametrize('max_runs', [16, 1])
+def test_iter_values_after_sorted_snapshot(journal_path, monkeypatch, max_runs):
+    """Test that sorted snapshot chunks and values appended after them stream in order"""
+    monkeypatch.setattr(JournalStore, 'MAX_RUNS', max_runs)
+    monkeypatch.setattr(JournalStore, 'CHUNK_ITEMS', 2)
+    order = lambda entry: entry[0]
+    store = JournalStore(journal_path, Session.new_session_data(), orders={Session.LOG_KEY: order})
+    for epoch in (4, 0, 6, 2, 8):
+        store.append(Session.LOG_KEY, [epoch, 0, ''])
+    store.compact()
+    for epoch in (5, 1, 9):
+        store.append(Session.LOG_KEY, [epoch, 0, ''])
+    store.close()
+    entries = JournalStore.iter_values(journal_path, Session.LOG_KEY, order=order)
+    assert [e[0] for e in entries] == [0, 1, 2, 4, 5, 6, 8, 9], 'Unexpected order'
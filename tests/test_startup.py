@@ -0,0 +1,16 @@
+import subprocess
+import sys
+
+def test_startup_does_not_import_report_dependencies():
+    """Test that starting the recorder does not import jinja2, fork a subprocess or import inspect"""
+    check = 'import sys, test_session.start; print(sorted(m for m in ("jinja2", "subprocess", "inspect") if m in sys.modules))'
+    output = subprocess.check_output([sys.executable, '-c', check], universal_newlines=True)
+    assert output.strip() == '[]', 'Unexpected modules imported at startup: ' + output
+
+def test_resize_requeries_terminal_size(monkeypatch):
+    from test_session.test_session_recorder import TestSessionRecorder
+    monkeypatch.setenv('COLUMNS', '123')
+    TestSessionRecorder.resize()
+    assert TestSessionRecorder.columns == 123, 'Terminal width was not updated'
+    monkeypatch.delenv('COLUMNS')
+    TestSessionRecorder.resize()
@@ -1,51 +1,74 @@
 import datetime
 import pytest
-from modules.session_timer import DurationTimer
+from test_session.session_timer import DurationTimer
+
+class FakeClock:
+    """Monotonic clock that only moves when the test says so"""
+    def __init__(self):
+        self.now = 10 ** 12
+
+    def __call__(self):
+        return self.now
+
+    def wait(self, duration_in_seconds):
+        self.now += int(duration_in_seconds * DurationTimer.NS_PER_SECOND)
 
 @pytest.fixture
-def timer():
-    timer = DurationTimer()
+def clock():
+    return FakeClock()
+
+@pytest.fixture
+def timer(clock):
+    timer = DurationTimer(clock=clock)
     return timer
 
 def test_timer_no_change(timer):
     assert timer.get_duration() == datetime.timedelta(0), 'Unexpected timer value'
 
-def test_timer_duration(timer):
-    test_timer = timer #Force immediate instantiation for timing
+def test_timer_duration(timer, clock):
     duration_in_seconds = 5
-    wait(duration_in_seconds)
-    assert test_timer.get_duration() == datetime.timedelta(seconds=duration_in_seconds), 'Timer duration was not ' + str(duration_in_seconds)
-
-def test_timer_duration_with_pause(timer):
-    test_timer = timer #Force immediate instantiation for timing
-    test_timer.pause()
-    wait(5)
-    test_timer.unpause()
+    clock.wait(duration_in_seconds)
+    assert timer.get_duration() == datetime.timedelta(seconds=duration_in_seconds), 'Timer duration was not ' + str(duration_in_seconds)
+
+def test_timer_duration_with_pause(timer, clock):
+    timer.pause()
+    clock.wait(5)
+    timer.unpause()
     assert timer.get_duration() == datetime.timedelta(0), 'Unexpected timer value'
 
-def test_timer_duration_with_multiple_pauses(timer):
-    test_timer = timer #Force immediate instantiation for timing
-    test_timer.pause()
-    wait(5)
-    test_timer.unpause()
-    wait(5)
-    test_timer.pause()
-    wait(5)
-    test_timer.unpause()
+def test_timer_duration_with_multiple_pauses(timer, clock):
+    timer.pause()
+    clock.wait(5)
+    timer.unpause()
+    clock.wait(5)
+    timer.pause()
+    clock.wait(5)
+    timer.unpause()
     assert timer.get_duration() == datetime.timedelta(seconds=5), 'Unexpected timer value'
 
-def test_timer_check_durations(timer):
-    test_timer = timer #Force immediate instantiation for timing
-    wait(2)
+def test_timer_check_durations(timer, clock):
+    clock.wait(2)
     assert timer.get_duration() == datetime.timedelta(seconds=2), 'Unexpected timer value'
-    wait(5)
+    clock.wait(5)
     assert timer.get_duration() == datetime.timedelta(seconds=7), 'Unexpected timer value'
-    wait(5)
+    clock.wait(5)
     assert timer.get_duration() == datetime.timedelta(seconds=12), 'Unexpected timer value'
 
-def wait(duration_in_seconds):
-    start_time = datetime.datetime.now().replace(microsecond=0)
-    while not ((datetime.datetime.now().replace(microsecond=0) - start_time) == datetime.timedelta(seconds=duration_in_seconds)):
-        pass #Wait 
+def test_timer_counts_whole_seconds(timer, clock):
+    clock.wait(1.6)
+    timer.pause()
+    timer.unpause()
+    clock.wait(1.6)
+    assert timer.get_duration() == datetime.timedelta(seconds=3), 'Partial seconds were lost across a pause'
 
+def test_timer_backdated_pause(clock):
+    timer = DurationTimer(datetime.timedelta(minutes=1), clock=clock)
+    clock.wait(30)
+    timer.pause(ago=20)
+    clock.wait(30)
+    assert timer.get_duration() == datetime.timedelta(seconds=70), 'Unexpected timer value'
 
+def test_timer_idle(timer, clock):
+    clock.wait(8)
+    assert timer.touch() == 8, 'Unexpected idle time'
+    assert timer.touch() == 0, 'Activity was not recorded'